@@ -0,0 +1,18 @@
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(location: str, mode='wb'):
+    """
+    Opens a temporary file next to location for writing, moved in place of location once written.
+    Readers, in this process or others, never see a partial file & a failed write leaves location as it was
+    """
+    temp_location = '{l}.{p}.tmp'.format(l=location, p=os.getpid())
+    try:
+        with open(temp_location, mode) as f:
+            yield f
+        os.replace(temp_location, location)
+    finally:
+        if os.path.isfile(temp_location):
+            os.remove(temp_location)
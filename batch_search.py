@@ -0,0 +1,84 @@
+import os
+import time
+import argparse
+import ujson
+from multiprocessing import Pool
+from main import index_agent, make_query_tokenizing_pipeline, vector_space_rank, parse_query, stems
+
+# Queries ranked by a worker per task, postings of their terms are fetched once per chunk
+batch_chunk_size = 500
+
+# Search state of a pool worker, set by init_batch_worker
+worker_agent = None
+worker_tokenize_ppl = None
+
+
+def init_batch_worker():
+    """Opens the index read only in a pool worker"""
+    global worker_agent, worker_tokenize_ppl
+    stems.load()
+    worker_tokenize_ppl = make_query_tokenizing_pipeline()
+    worker_agent = index_agent(read_only=True)
+
+
+def read_queries(location: str) -> [str]:
+    """Reads a query file, one query per line, blank lines are skipped"""
+    with open(location) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def search_chunk(job: ([(int, str)], int)) -> [dict]:
+    """Ranks a chunk of (position, query) pairs in a worker, each distinct term is read & decoded once for the chunk"""
+    chunk, k = job
+    a = time.perf_counter()
+    parsed = [parse_query(query, worker_tokenize_ppl) for _, query in chunk]
+    # Fetch postings of all distinct terms of the chunk up front
+    fetched_postings = {term: worker_agent.get_posting(term) for term in set(term for tokens, _ in parsed for term in tokens)}
+    fetch_ms = 1000 * (time.perf_counter() - a) / max(1, len(chunk))
+    results = []
+    for (position, query), (tokens, phrases) in zip(chunk, parsed):
+        b = time.perf_counter()
+        ranked = vector_space_rank(worker_agent, tokens, k, fetched_postings, phrases)
+        serials = list(ranked[:k]) if ranked else []
+        results.append({'position': position, 'query': query, 'total': len(ranked) if ranked else 0, 'serials': serials,
+                        'urls': worker_agent.get_urls(serials),
+                        # Ranking time plus the query's share of tokenizing & fetching the chunk's postings
+                        'time_ms': 1000 * (time.perf_counter() - b) + fetch_ms})
+    return results
+
+
+def batch_search(queries: [str], output_location: str, k=10, process_count=None, chunk_size=batch_chunk_size) -> dict:
+    """
+    Ranks queries across worker processes & writes their top k serials, urls & timings as json lines in query order.
+    Returns a summary of the replay
+    """
+    process_count = process_count or os.cpu_count() or 1
+    positioned = list(enumerate(queries))
+    chunks = [positioned[start:start + chunk_size] for start in range(0, len(positioned), chunk_size)]
+    a = time.time()
+    timings = []
+    with Pool(process_count, initializer=init_batch_worker) as pool, open(output_location, 'w') as f:
+        # Chunks come back in order, so results are written as they arrive
+        for results in pool.imap(search_chunk, [(chunk, k) for chunk in chunks]):
+            for result in results:
+                timings.append(result['time_ms'])
+                f.write(ujson.dumps(result) + '\n')
+    elapsed = time.time() - a
+    timings.sort()
+    summary = {'queries': len(queries), 'processes': process_count, 'seconds': elapsed,
+               'queries_per_second': len(queries) / max(elapsed, 1e-9)}
+    for q in (50, 95, 99):
+        summary['p{q}_ms'.format(q=q)] = timings[min(len(timings) - 1, int(q / 100 * len(timings)))] if timings else 0.
+    print("Batch search: {s}".format(s=summary))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a query file against the index in the current directory')
+    parser.add_argument('queries', help='query file, one query per line')
+    parser.add_argument('output', help='result file, one json object per query')
+    parser.add_argument('--k', type=int, default=10, help='results kept per query')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--chunk-size', type=int, default=batch_chunk_size, help='queries per worker task')
+    args = parser.parse_args()
+    batch_search(read_queries(args.queries), args.output, args.k, args.processes, args.chunk_size)
@@ -0,0 +1,58 @@
+import os
+import shutil
+import argparse
+import ujson
+from main import file_location
+from benchmarks.corpus import corpus_generator
+from benchmarks.results import write_results
+from benchmarks.build_benchmark import run_build_benchmark, clear_build_caches
+from benchmarks.query_benchmark import run_query_benchmark
+from benchmarks.tokenizer_benchmark import run_benchmark
+
+# Settings of the corpus in a working directory, it is only generated again when they change
+corpus_settings_loc = 'corpus.json'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds & searches a generated corpus, writing timings as json')
+    parser.add_argument('--workdir', default='benchmark_run', help='directory of the generated corpus & index')
+    parser.add_argument('--output', default='benchmark_results.json', help='result file, relative to the current directory')
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--zipf', type=float, default=1.0, help='exponent of the term distribution')
+    parser.add_argument('--words', type=int, default=300, help='average words per page')
+    parser.add_argument('--duplicates', type=float, default=.02, help='fraction of near duplicate pages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip', nargs='*', default=[], choices=['build', 'query', 'tokenizer'])
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    generator = corpus_generator(args.pages, args.hosts, args.vocabulary, args.zipf, args.words, args.duplicates, args.seed)
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    # Generate corpus unless the working directory already has the same one
+    settings = generator.to_json()
+    if not os.path.isfile(corpus_settings_loc) or ujson.load(open(corpus_settings_loc)) != settings:
+        if os.path.isdir(file_location):
+            shutil.rmtree(file_location)
+        clear_build_caches()
+        generator.generate(file_location)
+        with open(corpus_settings_loc, 'w') as f:
+            ujson.dump(settings, f)
+
+    results = {'corpus': settings}
+    if 'build' not in args.skip:
+        results['build'] = run_build_benchmark(args.processes)
+    if 'query' not in args.skip:
+        results['query'] = run_query_benchmark(generator.make_queries(args.queries), args.repeat)
+    if 'tokenizer' not in args.skip:
+        results['tokenizer'] = run_benchmark(args.pages, args.repeat)
+    write_results(output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import os
+import shutil
+from main import init_index_agent, list_all_pages
+from parse import record_cache_loc
+from stem_cache import stem_cache_loc
+import index_agent
+
+# Files of a built index, measured after each build
+index_files = [index_agent.index_loc, index_agent.weight_index_loc, index_agent.standalone_index_loc,
+               index_agent.dictionary_loc, index_agent.weight_dictionary_loc, index_agent.standalone_dictionary_loc]
+
+
+def clear_build_caches():
+    """Deletes parsed page records & stems, so the next build starts cold"""
+    if os.path.isdir(record_cache_loc):
+        shutil.rmtree(record_cache_loc)
+    if os.path.isfile(stem_cache_loc):
+        os.remove(stem_cache_loc)
+
+
+def run_build(cold: bool, process_count=None, fast_parser=False) -> dict:
+    """Builds the index of the corpus in the working directory, returns phase timings & throughput"""
+    if cold:
+        clear_build_caches()
+    timings = init_index_agent(fast_parser, process_count)
+    pages = len(list_all_pages())
+    return {'cold': cold, 'pages': pages, 'pages_per_second': pages / timings['total'], 'timings': timings,
+            'index_bytes': sum(os.path.getsize(i) for i in index_files if os.path.isfile(i))}
+
+
+def run_build_benchmark(process_count=None, fast_parser=False) -> dict:
+    """Measures a cold build, parsing every page, & a warm build reusing cached records & stems"""
+    return {'cold': run_build(True, process_count, fast_parser), 'warm': run_build(False, process_count, fast_parser)}
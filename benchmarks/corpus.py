@@ -0,0 +1,110 @@
+import os
+import random
+import hashlib
+import itertools
+import ujson
+
+# Words mixed into generated vocabularies, so queries on real terms find pages
+common_words = ['computer', 'science', 'informatics', 'research', 'machine', 'learning', 'student', 'faculty',
+                'course', 'project', 'software', 'engineering', 'data', 'network', 'security', 'graduate']
+
+
+def make_vocabulary(size: int, rng: random.Random) -> [str]:
+    """Generates distinct pronounceable words, most frequent first"""
+    consonants, vowels = 'bcdfghjklmnprstvwz', 'aeiou'
+    words, seen = list(common_words), set(common_words)
+    while len(words) < size:
+        word = ''.join(rng.choice(consonants) + rng.choice(vowels) for _ in range(rng.randint(1, 4)))
+        if rng.random() < .3:
+            word += rng.choice(['s', 'ing', 'ed', 'er', 'ly'])
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words[:size]
+
+
+class corpus_generator:
+
+    def __init__(self, pages=1000, hosts=10, vocabulary_size=20000, zipf_exponent=1.0, words_per_page=300,
+                 duplicate_rate=.02, seed=0):
+        """
+        Generates DEV style page files with a zipf term distribution.
+        Page lengths vary around words_per_page, duplicate_rate of pages are copies of earlier pages with a few words changed
+        """
+        self.pages, self.hosts, self.words_per_page, self.duplicate_rate = pages, hosts, words_per_page, duplicate_rate
+        self.zipf_exponent, self.seed = zipf_exponent, seed
+        self.rng = random.Random(seed)
+        self.vocabulary = make_vocabulary(vocabulary_size, self.rng)
+        # Cumulative zipf weights of vocabulary ranks, for fast sampling
+        self.cumulative_weights = list(itertools.accumulate(1 / (rank ** zipf_exponent) for rank in range(1, vocabulary_size + 1)))
+
+    def sample_words(self, count: int) -> [str]:
+        """Draws words from the zipf distribution"""
+        return self.rng.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=count)
+
+    def make_sentences(self, count: int) -> str:
+        """Generates text of about count words in sentences"""
+        words = self.sample_words(count)
+        sentences = []
+        for i in range(0, len(words), 12):
+            sentence = words[i:i + 12]
+            sentence[0] = sentence[0].capitalize()
+            sentences.append(' '.join(sentence) + self.rng.choice(['.', '.', '.', '?', '!', ',']))
+        return ' '.join(sentences)
+
+    def make_page(self, url: str) -> str:
+        """Generates the html of a page"""
+        body_words = max(10, int(self.rng.lognormvariate(0, .6) * self.words_per_page))
+        paragraphs = ['<p>{t} <b>{b}</b> {u}</p>'.format(t=self.make_sentences(body_words // 4), b=' '.join(self.sample_words(2)),
+                                                           u=self.rng.choice(['', '<a href="{u}">{u}</a>'.format(u=url), 'x=1 a/b c_d']))
+                      for _ in range(4)]
+        title = '<title>{t}</title>'.format(t=' '.join(self.sample_words(self.rng.randint(2, 6)))) if self.rng.random() < .9 else ''
+        headings = ''.join('<h{n}>{t}</h{n}>'.format(n=n, t=' '.join(self.sample_words(3))) for n in range(1, 4))
+        return '<html><head>{title}</head><body>{h}{p}</body></html>'.format(title=title, h=headings, p=''.join(paragraphs))
+
+    def mutate_page(self, content: str) -> str:
+        """Changes a few words of a page, so it stays a near duplicate"""
+        words = content.split(' ')
+        for _ in range(max(1, len(words) // 100)):
+            words[self.rng.randrange(len(words))] = self.sample_words(1)[0]
+        return ' '.join(words)
+
+    def generate(self, location: str) -> [str]:
+        """Writes all page files under location, one directory per host, returns their paths"""
+        paths, contents = [], []
+        for i in range(self.pages):
+            host = 'host{h}.ics.uci.edu'.format(h=i % self.hosts)
+            url = 'https://{host}/page/{i}'.format(host=host, i=i)
+            if contents and self.rng.random() < self.duplicate_rate:
+                content = self.mutate_page(self.rng.choice(contents))
+            else:
+                content = self.make_page(url)
+            contents.append(content)
+            directory = os.path.join(location, host.replace('.', '_'))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, hashlib.sha1(url.encode()).hexdigest() + '.json')
+            with open(path, 'w') as f:
+                ujson.dump({'url': url, 'content': content, 'encoding': 'utf-8'}, f)
+            paths.append(path)
+        return paths
+
+    def make_queries(self, count=200, max_terms=3) -> [str]:
+        """Generates queries mixing frequent & rare vocabulary words, the same ones for a seed whenever called"""
+        rng = random.Random(self.seed + 1)
+        queries = []
+        for _ in range(count):
+            terms = []
+            for _ in range(rng.randint(1, max_terms)):
+                # Half of the terms are drawn like page words, the others uniformly from the vocabulary
+                if rng.random() < .5:
+                    terms += rng.choices(self.vocabulary, cum_weights=self.cumulative_weights)
+                else:
+                    terms.append(rng.choice(self.vocabulary))
+            queries.append(' '.join(terms))
+        return queries
+
+    def to_json(self) -> dict:
+        """Gets the generator settings, recorded with benchmark results"""
+        return {'pages': self.pages, 'hosts': self.hosts, 'vocabulary_size': len(self.vocabulary),
+                'zipf_exponent': self.zipf_exponent, 'words_per_page': self.words_per_page,
+                'duplicate_rate': self.duplicate_rate, 'seed': self.seed}
@@ -0,0 +1,37 @@
+import time
+from main import index_agent, make_query_tokenizing_pipeline, vector_space_search, stems
+from query_cache import query_result_cache
+from benchmarks.results import percentile
+
+
+def time_queries(ia: index_agent, queries: [str], repeat: int, k: int, result_cache=None) -> [float]:
+    """Gets latencies in seconds of searching each query repeat times & reading its k best results"""
+    query_tokenizing_ppl = make_query_tokenizing_pipeline()
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            a = time.perf_counter()
+            results = vector_space_search(ia, query, query_tokenizing_ppl, k, result_cache)
+            # Read the k best results, ranked lazily
+            if results:
+                results[:k]
+            latencies.append(time.perf_counter() - a)
+    return latencies
+
+
+def summarize_latencies(latencies: [float]) -> dict:
+    """Gets mean & percentile latencies in milliseconds"""
+    return {'queries': len(latencies), 'mean_ms': 1000 * sum(latencies) / max(1, len(latencies)),
+            'p50_ms': 1000 * percentile(latencies, 50), 'p95_ms': 1000 * percentile(latencies, 95),
+            'p99_ms': 1000 * percentile(latencies, 99), 'queries_per_second': len(latencies) / max(sum(latencies), 1e-9)}
+
+
+def run_query_benchmark(queries: [str], repeat=3, k=10) -> dict:
+    """Measures search latency over a query set on the index in the working directory, without & with the result cache"""
+    ia = index_agent(read_only=True)
+    stems.load()
+    # One untimed pass so postings of every query were read once
+    time_queries(ia, queries, 1, k)
+    uncached = summarize_latencies(time_queries(ia, queries, repeat, k))
+    cached = summarize_latencies(time_queries(ia, queries, repeat, k, query_result_cache()))
+    return {'k': k, 'repeat': repeat, 'uncached': uncached, 'result_cache': cached}
@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+import platform
+import subprocess
+import ujson
+
+
+def percentile(values: [float], q: float) -> float:
+    """Gets the nearest rank percentile of values"""
+    if not values:
+        return 0.
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def get_environment() -> dict:
+    """Describes the machine & source tree a benchmark ran on"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': sys.version.split()[0], 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def write_results(location: str, results: dict):
+    """Writes benchmark results as json, with the environment they were measured in"""
+    results = dict(results, environment=get_environment())
+    with open(location, 'w') as f:
+        ujson.dump(results, f, indent=2)
+    print("Results written to {l}".format(l=location))
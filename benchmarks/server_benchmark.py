@@ -0,0 +1,55 @@
+import sys
+import time
+import asyncio
+from urllib.parse import quote
+from benchmarks.results import percentile
+
+
+async def run_client(host: str, port: int, queries: [str], latencies: [float], statuses: dict):
+    """Sends queries one after another over a single keep alive connection"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for query in queries:
+            a = time.perf_counter()
+            writer.write('GET /search?q={q} HTTP/1.1\r\nHost: {h}\r\n\r\n'.format(q=quote(query), h=host).encode())
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - a)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def load_server(host: str, port: int, queries: [str], concurrency: int) -> dict:
+    """Spreads queries over concurrent connections, returns throughput & latency percentiles"""
+    latencies, statuses = [], dict()
+    a = time.perf_counter()
+    await asyncio.gather(*[run_client(host, port, queries[i::concurrency], latencies, statuses) for i in range(concurrency)])
+    elapsed = time.perf_counter() - a
+    return {'requests': len(latencies), 'concurrency': concurrency, 'statuses': statuses,
+            'queries_per_second': len(latencies) / elapsed, 'p50_ms': 1000 * percentile(latencies, 50),
+            'p95_ms': 1000 * percentile(latencies, 95), 'p99_ms': 1000 * percentile(latencies, 99)}
+
+
+def run_server_benchmark(queries: [str], host='127.0.0.1', port=8080, concurrency=32) -> dict:
+    """Measures a running search server under concurrent keep alive clients"""
+    result = asyncio.run(load_server(host, port, queries, concurrency))
+    print("Server: {q:.0f} queries/s, p50/p95/p99: {p50:.1f}/{p95:.1f}/{p99:.1f}ms, statuses: {s}".format(
+        q=result['queries_per_second'], p50=result['p50_ms'], p95=result['p95_ms'], p99=result['p99_ms'], s=result['statuses']))
+    return result
+
+
+if __name__ == '__main__':
+    from benchmarks.corpus import corpus_generator
+    # Queries of the default generated corpus, sent to a server on the given port
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    run_server_benchmark(corpus_generator(pages=0, vocabulary_size=20000).make_queries(requests), port=port)
@@ -0,0 +1,53 @@
+import sys
+import time
+from main import list_all_pages, make_tokenizing_pipeline, make_legacy_tokenizing_pipeline
+from parse import load_record, html_parser
+from tokenizer import tokenize
+
+# Record fields passed through the tokenizing pipeline when indexing
+record_fields = ('raw_text', 'headings', 'bold', 'title_words')
+
+
+def load_texts(page_limit: int, parser=html_parser) -> []:
+    """Gets the tokenized fields of the first pages of the corpus"""
+    texts = []
+    for path in list_all_pages()[:page_limit]:
+        record = load_record(path, parser)
+        texts += [record[field] for field in record_fields]
+    return texts
+
+
+def time_tokenizer(func, texts: [], repeat: int) -> (float, []):
+    """Gets the best time of tokenizing all texts & the tokens of the last run"""
+    best, tokens = None, None
+    for _ in range(repeat):
+        a = time.perf_counter()
+        tokens = [func(text) for text in texts]
+        elapsed = time.perf_counter() - a
+        best = elapsed if best is None else min(best, elapsed)
+    return best, tokens
+
+
+def run_benchmark(page_limit=1000, repeat=3) -> dict:
+    """Measures tokens per second of the legacy & single pass tokenizing pipelines, checking they agree"""
+    texts = load_texts(page_limit)
+    legacy_ppl, tokenize_ppl = make_legacy_tokenizing_pipeline(), make_tokenizing_pipeline()
+    legacy_time, legacy_tokens = time_tokenizer(legacy_ppl.process_item, texts, repeat)
+    pipeline_time, pipeline_tokens = time_tokenizer(tokenize_ppl.process_item, texts, repeat)
+    tokenize_time, _ = time_tokenizer(tokenize, texts, repeat)
+    token_count = sum(len(tokens) for tokens in legacy_tokens)
+    mismatches = sum(a != b for a, b in zip(legacy_tokens, pipeline_tokens))
+    result = {'pages': min(page_limit, len(texts) // len(record_fields)), 'tokens': token_count, 'mismatched_fields': mismatches,
+              'legacy_tokens_per_second': token_count / legacy_time,
+              'pipeline_tokens_per_second': token_count / pipeline_time,
+              'tokenize_tokens_per_second': token_count / tokenize_time,
+              'speedup': legacy_time / pipeline_time}
+    print("Pages: {p}, tokens: {t}, mismatched fields: {m}".format(p=result['pages'], t=token_count, m=mismatches))
+    print("Legacy pipeline: {r:.0f} tokens/s".format(r=result['legacy_tokens_per_second']))
+    print("Single pass pipeline: {r:.0f} tokens/s ({s:.2f}x)".format(r=result['pipeline_tokens_per_second'], s=result['speedup']))
+    print("Single pass tokenizer without stemming: {r:.0f} tokens/s".format(r=result['tokenize_tokens_per_second']))
+    return result
+
+
+if __name__ == '__main__':
+    run_benchmark(*[int(i) for i in sys.argv[1:3]])
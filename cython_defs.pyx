@@ -1,10 +1,297 @@
 # Cython library optimized from python code for speed improvement. Approved by professor.
 import math
+import array
+from cpython cimport array
+from libc.math cimport floor, sqrt, powf
+from libc.stdlib cimport malloc, free
 from pipeline import pipeline
-from index_agent import index_agent
 
 selected_stopwords = {'an', 'you', 'of', 'it', 'are', 'we', 'he', 'she', 'is', 'the', 'it'}
 
+# Scores are stored as fixed point integers with this many steps per unit
+cdef double score_scale = 100000.0
+# Number of postings stored in each block, every block carries its own max score for pruning
+cdef Py_ssize_t block_size = 128
+# Empty typed arrays used as templates for fast allocation
+cdef array.array serial_template = array.array('i', [])
+cdef array.array score_template = array.array('d', [])
+cdef array.array offset_template = array.array('q', [])
+cdef array.array flag_template = array.array('b', [])
+cdef array.array signature_template = array.array('Q', [])
+# MinHash permutations are computed modulo this Mersenne prime
+cdef unsigned long long minhash_prime = (1ULL << 61) - 1
+# Hybrid ranking adds 2.5 times a cosine similarity of at most 1, with a margin for float rounding
+cdef double cosine_bound = 2.5 * 1.001
+# Number of candidates scored together by the hybrid scoring kernel
+cdef Py_ssize_t score_batch_size = 256
+
+
+cdef inline Py_ssize_t write_varint(unsigned char *buffer, Py_ssize_t pos, unsigned long long value):
+    """Writes an unsigned integer as a LEB128 varint, returns the next write position"""
+    while value >= 0x80:
+        buffer[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buffer[pos] = value
+    return pos + 1
+
+
+cdef inline unsigned long long read_varint(const unsigned char *data, Py_ssize_t *pos):
+    """Reads a LEB128 varint at pos and moves pos past it"""
+    cdef unsigned long long result = 0
+    cdef unsigned int shift = 0
+    cdef unsigned char byte
+    while True:
+        byte = data[pos[0]]
+        pos[0] += 1
+        result |= <unsigned long long>(byte & 0x7F) << shift
+        if byte < 0x80:
+            return result
+        shift += 7
+
+
+cdef inline unsigned long long quantize_score(double score):
+    """Converts a score to a zigzag encoded fixed point integer"""
+    cdef long long value = <long long>floor(score * score_scale + .5)
+    return <unsigned long long>((value << 1) ^ (value >> 63))
+
+
+cdef inline double dequantize_score(unsigned long long value):
+    """Converts a zigzag encoded fixed point integer back to a score"""
+    return (<long long>(value >> 1) ^ -<long long>(value & 1)) / score_scale
+
+
+cdef class posting_list:
+    """
+    An encoded posting, page serials in ascending order with matching scores.
+    Only the block directory is read up front, blocks are decoded when first needed
+    """
+    cdef const unsigned char[:] data
+    cdef readonly Py_ssize_t count, block_count
+    # Block directory: last serial, max score, and where serials & scores of each block start
+    cdef array.array block_last, block_max, block_serial_offset, block_score_offset
+    # Decoded serials & scores, filled block by block
+    cdef array.array decoded_serials, decoded_scores
+    cdef array.array serials_ready, scores_ready
+    cdef readonly double max_score
+
+    def __init__(self, const unsigned char[:] data):
+        cdef Py_ssize_t pos = 0, b, data_pos
+        cdef int last = 0
+        cdef unsigned long long serial_bytes, score_bytes
+        self.data = data
+        self.count = read_varint(&data[0], &pos)
+        self.block_count = (self.count + block_size - 1) // block_size
+        self.block_last = array.clone(serial_template, self.block_count, zero=False)
+        self.block_max = array.clone(score_template, self.block_count, zero=False)
+        self.block_serial_offset = array.clone(offset_template, self.block_count, zero=False)
+        self.block_score_offset = array.clone(offset_template, self.block_count, zero=False)
+        self.max_score = 0
+        # Blocks are stored right after the directory
+        data_pos = 0
+        for b in range(self.block_count):
+            last += <int>read_varint(&data[0], &pos)
+            self.block_last.data.as_ints[b] = last
+            self.block_max.data.as_doubles[b] = dequantize_score(read_varint(&data[0], &pos))
+            serial_bytes = read_varint(&data[0], &pos)
+            score_bytes = read_varint(&data[0], &pos)
+            self.block_serial_offset.data.as_longlongs[b] = data_pos
+            self.block_score_offset.data.as_longlongs[b] = data_pos + serial_bytes
+            data_pos += serial_bytes + score_bytes
+            if b == 0 or self.block_max.data.as_doubles[b] > self.max_score:
+                self.max_score = self.block_max.data.as_doubles[b]
+        for b in range(self.block_count):
+            self.block_serial_offset.data.as_longlongs[b] += pos
+            self.block_score_offset.data.as_longlongs[b] += pos
+        self.decoded_serials = None
+        self.decoded_scores = None
+
+    def __len__(self):
+        return self.count
+
+    cdef void load_block_serials(self, Py_ssize_t b):
+        """Decodes serials of block b into the decoded serial array"""
+        cdef Py_ssize_t pos, i, end
+        cdef int previous
+        if self.decoded_serials is None:
+            self.decoded_serials = array.clone(serial_template, self.count, zero=False)
+            self.serials_ready = array.clone(flag_template, self.block_count, zero=True)
+        if self.serials_ready.data.as_schars[b]:
+            return
+        pos = self.block_serial_offset.data.as_longlongs[b]
+        previous = self.block_last.data.as_ints[b - 1] if b > 0 else 0
+        end = min(self.count, (b + 1) * block_size)
+        for i in range(b * block_size, end):
+            previous += <int>read_varint(&self.data[0], &pos)
+            self.decoded_serials.data.as_ints[i] = previous
+        self.serials_ready.data.as_schars[b] = 1
+
+    cdef void load_block_scores(self, Py_ssize_t b):
+        """Decodes scores of block b into the decoded score array"""
+        cdef Py_ssize_t pos, i, end
+        if self.decoded_scores is None:
+            self.decoded_scores = array.clone(score_template, self.count, zero=False)
+            self.scores_ready = array.clone(flag_template, self.block_count, zero=True)
+        if self.scores_ready.data.as_schars[b]:
+            return
+        pos = self.block_score_offset.data.as_longlongs[b]
+        end = min(self.count, (b + 1) * block_size)
+        for i in range(b * block_size, end):
+            self.decoded_scores.data.as_doubles[i] = dequantize_score(read_varint(&self.data[0], &pos))
+        self.scores_ready.data.as_schars[b] = 1
+
+    @property
+    def serials(self) -> array.array:
+        """All page serials of the posting"""
+        cdef Py_ssize_t b
+        for b in range(self.block_count):
+            self.load_block_serials(b)
+        if self.decoded_serials is None:
+            self.decoded_serials = array.clone(serial_template, 0, zero=False)
+        return self.decoded_serials
+
+    @property
+    def scores(self) -> array.array:
+        """All scores of the posting"""
+        cdef Py_ssize_t b
+        for b in range(self.block_count):
+            self.load_block_scores(b)
+        if self.decoded_scores is None:
+            self.decoded_scores = array.clone(score_template, 0, zero=False)
+        return self.decoded_scores
+
+
+def encode_posting(serials, scores) -> bytes:
+    """
+    Encodes a posting as [count][block directory][blocks], all varints.
+    Directory entries are [last serial delta][max score][serial bytes][score bytes] for each block,
+    blocks hold serial deltas followed by quantized scores
+    """
+    cdef Py_ssize_t count = len(serials), i, b, start, end, block_count
+    cdef Py_ssize_t pos = 0, data_pos = 0, block_start, serial_bytes
+    cdef int previous = 0, previous_last = 0, serial
+    cdef unsigned long long quantized, block_max
+    block_count = (count + block_size - 1) // block_size
+    # A varint never takes more than 10 bytes
+    cdef bytearray directory = bytearray(10 * (4 * block_count + 1))
+    cdef bytearray blocks = bytearray(10 * 2 * count)
+    cdef unsigned char *directory_out = directory
+    cdef unsigned char *blocks_out = blocks
+    pos = write_varint(directory_out, pos, count)
+    for b in range(block_count):
+        start, end = b * block_size, min(count, (b + 1) * block_size)
+        # Store gaps between ascending serials
+        block_start = data_pos
+        for i in range(start, end):
+            serial = serials[i]
+            data_pos = write_varint(blocks_out, data_pos, serial - previous)
+            previous = serial
+        serial_bytes = data_pos - block_start
+        # Store scores, keeping the largest one for the directory
+        block_start = data_pos
+        block_max = 0
+        for i in range(start, end):
+            quantized = quantize_score(scores[i])
+            data_pos = write_varint(blocks_out, data_pos, quantized)
+            if i == start or dequantize_score(quantized) > dequantize_score(block_max):
+                block_max = quantized
+        pos = write_varint(directory_out, pos, previous - previous_last)
+        pos = write_varint(directory_out, pos, block_max)
+        pos = write_varint(directory_out, pos, serial_bytes)
+        pos = write_varint(directory_out, pos, data_pos - block_start)
+        previous_last = previous
+    return bytes(directory[:pos]) + bytes(blocks[:data_pos])
+
+
+def decode_posting(const unsigned char[:] data) -> posting_list:
+    """Opens a posting written by encode_posting, blocks are decoded lazily"""
+    return posting_list(data)
+
+
+def encode_serials(serials) -> bytes:
+    """Encodes a list of ascending page serials as [count][serial deltas], all varints"""
+    cdef Py_ssize_t count = len(serials), pos = 0, i
+    cdef int previous = 0, serial
+    cdef bytearray buffer = bytearray(10 * (count + 1))
+    cdef unsigned char *out = buffer
+    pos = write_varint(out, pos, count)
+    for i in range(count):
+        serial = serials[i]
+        pos = write_varint(out, pos, serial - previous)
+        previous = serial
+    return bytes(buffer[:pos])
+
+
+def decode_serials(const unsigned char[:] data) -> array.array:
+    """Decodes a list of page serials written by encode_serials"""
+    cdef Py_ssize_t pos = 0, count, i
+    cdef int previous = 0
+    count = read_varint(&data[0], &pos)
+    cdef array.array serials = array.clone(serial_template, count, zero=False)
+    cdef int *serial_data = serials.data.as_ints
+    for i in range(count):
+        previous += <int>read_varint(&data[0], &pos)
+        serial_data[i] = previous
+    return serials
+
+
+def encode_positions(serials, positions) -> bytes:
+    """
+    Encodes word positions of a term in ascending pages as [page count][last serial] followed by a record per page,
+    records are [serial delta][byte length of positions][position deltas], all varints.
+    Byte lengths let phrase matching skip pages without decoding their positions
+    """
+    cdef Py_ssize_t count = len(serials), pos = 0, i, j, start, total = 0
+    cdef int previous = 0, previous_position, position
+    for i in range(count):
+        total += len(positions[i])
+    cdef bytearray buffer = bytearray(10 * (2 + 2 * count + total))
+    cdef bytearray record = bytearray(10 * total + 1)
+    cdef unsigned char *out = buffer
+    cdef unsigned char *record_out = record
+    pos = write_varint(out, pos, count)
+    pos = write_varint(out, pos, serials[count - 1] if count else 0)
+    for i in range(count):
+        start, previous_position = 0, 0
+        for position in positions[i]:
+            start = write_varint(record_out, start, position - previous_position)
+            previous_position = position
+        pos = write_varint(out, pos, serials[i] - previous)
+        pos = write_varint(out, pos, start)
+        for j in range(start):
+            out[pos + j] = record_out[j]
+        pos += start
+        previous = serials[i]
+    return bytes(buffer[:pos])
+
+
+def concat_positions(list streams) -> bytes:
+    """
+    Joins position streams of one term written by encode_positions, each holding pages above those of the streams before it.
+    Only the first serial delta of each stream is rewritten, records are copied as they are
+    """
+    cdef Py_ssize_t pos, count, total = 0
+    cdef long long last, first, previous_last = -1
+    cdef const unsigned char[:] data
+    cdef unsigned char head[20]
+    parts = []
+    for stream in streams:
+        data = stream
+        pos = 0
+        count = read_varint(&data[0], &pos)
+        last = read_varint(&data[0], &pos)
+        if count == 0:
+            continue
+        first = read_varint(&data[0], &pos)
+        if first <= previous_last:
+            raise ValueError('Position streams must hold ascending pages, serial {s} follows {p}'.format(s=first, p=previous_last))
+        parts.append(bytes(head[:write_varint(head, 0, first - max(previous_last, 0))]))
+        parts.append(bytes(data[pos:]))
+        total += count
+        previous_last = last
+    return bytes(head[:write_varint(head, write_varint(head, 0, total), max(previous_last, 0))]) + b''.join(parts)
+
+
 # Referenced & modified from technique from https://stackoverflow.com/questions/18424228/cosine-similarity-between-2-number-lists
 cdef float cosine_similarity_2(list v1, list v2):
     """Compute cosine similarity of v1 to v2"""
@@ -30,71 +317,231 @@ def log_frequency(list a) -> list:
     cdef float i
     return [1 + math.log(abs(i), 10) for i in a]
 
-def get_term_idf(list posting):
-    """Gets the idf of a single term"""
-    return math.log(55393.0 / len(posting), 10)
+def get_term_idf(posting_list posting, doc_count):
+    """Gets the idf of a single term among doc_count pages"""
+    return get_df_idf(len(posting), doc_count)
 
-def get_union(list posting_1, list posting_2, int posting_1_len, int posting_2_len) -> []:
-    """Gets the union of two lists"""
-    cdef int index_1, index_2, item_1, item_2
-    index_1, index_2 = 0, 0
+def get_df_idf(df, doc_count):
+    """Gets the idf of a term in df of doc_count pages, doc_count must be the page count postings were scored with"""
+    return math.log(doc_count / df, 10)
 
-    result = []
-    # Iterate over both posting lists
-    while index_1 < posting_1_len and index_2 < posting_2_len:
-        # Get current item
-        item_1 = posting_1[index_1]
-        item_2 = posting_2[index_2][0]
-        # Compare items
-        if item_1 == item_2:
-            # Append to result list
-            result.append(item_1)
-            # Increment index
-            index_1 += 1
-            index_2 += 1
-        elif item_1 < item_2:
-            # Increment index
-            index_1 += 1
+cdef inline Py_ssize_t gallop(const int *values, Py_ssize_t start, Py_ssize_t end, int target) nogil:
+    """Gets the first index in [start, end) whose value is not less than target, end if there is none"""
+    cdef Py_ssize_t low = start, high, step = 1, middle
+    if low >= end or values[low] >= target:
+        return low
+    # Double the step until passing target, values[low] stays below target
+    high = low + 1
+    while high < end and values[high] < target:
+        low = high
+        step *= 2
+        high = low + step
+    if high > end:
+        high = end
+    # Binary search between last two probes
+    low += 1
+    while low < high:
+        middle = (low + high) // 2
+        if values[middle] < target:
+            low = middle + 1
         else:
-            # Increment index
-            index_2 += 1
+            high = middle
+    return low
+
+
+def get_union(int[:] posting_1, int[:] posting_2, int posting_1_len, int posting_2_len) -> array.array:
+    """Gets the intersection of two ascending serial lists, galloping through the longer one"""
+    cdef int index_1, index_2, item
+    cdef array.array result = array.clone(serial_template, min(posting_1_len, posting_2_len), zero=False)
+    cdef Py_ssize_t found = 0
+    if posting_1_len > posting_2_len:
+        posting_1, posting_2 = posting_2, posting_1
+        posting_1_len, posting_2_len = posting_2_len, posting_1_len
+    if posting_1_len == 0:
+        return result
+    index_2 = 0
+    # Search each item of the shorter list in the longer list
+    for index_1 in range(posting_1_len):
+        item = posting_1[index_1]
+        index_2 = gallop(&posting_2[0], index_2, posting_2_len, item)
+        if index_2 >= posting_2_len:
+            break
+        if posting_2[index_2] == item:
+            # Append to result list
+            result.data.as_ints[found] = item
+            found += 1
+    array.resize(result, found)
     return result
 
-def get_score_sum(list union_list, list postings, int posting_1_len, int posting_2_len) -> []:
-    """Gets the sum of scores of the union list & postings list"""
-    cdef int index_1, index_2, item_1, item_2
-    index_1, index_2 = 0, 0
+def get_score_sum(int[:] union_list, int[:] serials, double[:] scores, int posting_1_len, int posting_2_len) -> []:
+    """Gets the scores of every page in union list from a posting containing all of them"""
+    cdef int index_1, index_2 = 0
 
     result = []
-    # Iterate over both posting lists
-    while index_1 < posting_1_len and index_2 < posting_2_len:
-        # Get current item
-        item_1 = union_list[index_1]
-        item_2 = postings[index_2][0]
-        # Compare items
-        if item_1 == item_2:
+    if posting_2_len == 0:
+        return result
+    # Find each page of union list in posting
+    for index_1 in range(posting_1_len):
+        index_2 = gallop(&serials[0], index_2, posting_2_len, union_list[index_1])
+        if index_2 >= posting_2_len:
+            break
+        if serials[index_2] == union_list[index_1]:
             # Append to result list
-            result.append(postings[index_2][1])
-            # Increment index
-            index_1 += 1
-            index_2 += 1
-        elif item_1 < item_2:
-            # Increment index
-            index_1 += 1
-        else:
-            # Increment index
-            index_2 += 1
+            result.append(scores[index_2])
+    return result
+
+
+cdef inline bint ranks_before(double score_1, int serial_1, double score_2, int serial_2):
+    """Whether the first page ranks before the second, higher score first & lower serial on ties"""
+    return score_1 > score_2 or (score_1 == score_2 and serial_1 < serial_2)
+
+
+cdef void heap_sift_down(double *scores, int *serials, Py_ssize_t size, Py_ssize_t index):
+    """Restores a heap of pages whose root is the worst ranked page"""
+    cdef Py_ssize_t child
+    cdef double score = scores[index]
+    cdef int serial = serials[index]
+    while 2 * index + 1 < size:
+        child = 2 * index + 1
+        # Pick the worse ranked child
+        if child + 1 < size and ranks_before(scores[child], serials[child], scores[child + 1], serials[child + 1]):
+            child += 1
+        if ranks_before(scores[child], serials[child], score, serial):
+            break
+        scores[index], serials[index] = scores[child], serials[child]
+        index = child
+    scores[index], serials[index] = score, serial
+
+
+cdef void heap_offer(double *scores, int *serials, Py_ssize_t *size, Py_ssize_t k, double score, int serial):
+    """Offers a page to a heap keeping the k best ranked pages"""
+    cdef Py_ssize_t index, parent
+    if size[0] < k:
+        # Sift new page up
+        index = size[0]
+        size[0] += 1
+        while index > 0:
+            parent = (index - 1) // 2
+            if not ranks_before(scores[parent], serials[parent], score, serial):
+                break
+            scores[index], serials[index] = scores[parent], serials[parent]
+            index = parent
+        scores[index], serials[index] = score, serial
+    elif k > 0 and ranks_before(score, serial, scores[0], serials[0]):
+        # Replace the worst page kept so far
+        scores[0], serials[0] = score, serial
+        heap_sift_down(scores, serials, size[0], 0)
+
+
+cdef array.array heap_drain(double *scores, int *serials, Py_ssize_t size, double *ranked_scores=NULL):
+    """Empties a heap into an array of serials in ranked order, their scores are written to ranked_scores if given"""
+    cdef array.array result = array.clone(serial_template, size, zero=False)
+    # Pop worst pages to the back of result
+    while size > 0:
+        result.data.as_ints[size - 1] = serials[0]
+        if ranked_scores != NULL:
+            ranked_scores[size - 1] = scores[0]
+        size -= 1
+        scores[0], serials[0] = scores[size], serials[size]
+        heap_sift_down(scores, serials, size, 0)
     return result
 
-def get_ranked_doc_ids(list postings) -> [int]:
-    """Takes in a list of postings and returns with a list of page serials"""
+
+cdef array.array select_top(array.array candidates, array.array candidate_scores, Py_ssize_t k):
+    """Gets serials of the k best ranked candidates in ranked order using a bounded heap"""
+    cdef Py_ssize_t n = len(candidates), size = 0, i
+    if k > n:
+        k = n
+    cdef array.array heap_scores = array.clone(score_template, k, zero=False)
+    cdef array.array heap_serials = array.clone(serial_template, k, zero=False)
+    for i in range(n):
+        heap_offer(heap_scores.data.as_doubles, heap_serials.data.as_ints, &size, k,
+                   candidate_scores.data.as_doubles[i], candidates.data.as_ints[i])
+    return heap_drain(heap_scores.data.as_doubles, heap_serials.data.as_ints, size)
+
+
+cdef class ranked_results:
+    """
+    Ranked page serials of a query, only the top of the ranking is computed until more is requested.
+    Holds a complete ranking as is, subclasses rank lazily by overriding rank
+    """
+    cdef Py_ssize_t total
+    cdef array.array ranked
+
+    def __init__(self, array.array ranked):
+        self.ranked = ranked
+        self.total = len(ranked)
+
+    cdef array.array rank(self, Py_ssize_t k):
+        """Gets serials of the k best ranked pages in ranked order, a complete ranking already holds them all"""
+        return self.ranked[:k]
+
+    def __len__(self):
+        return self.total
+
+    def expand(self, Py_ssize_t k):
+        """Makes sure at least the k best pages are ranked, doubling the ranked window to keep paging cheap"""
+        k = min(k, self.total)
+        if k > len(self.ranked):
+            self.ranked = self.rank(max(k, min(self.total, 2 * len(self.ranked))))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.total)
+            self.expand(stop if step > 0 else start + 1)
+            return list(self.ranked[index])
+        if index < 0:
+            index += self.total
+        if not 0 <= index < self.total:
+            raise IndexError('ranked_results index out of range')
+        self.expand(index + 1)
+        return self.ranked[index]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def snapshot(self) -> array.array:
+        """Gets serials ranked so far, best first"""
+        return self.ranked
+
+
+cdef class frozen_results(ranked_results):
+    """Ranking restored from a snapshot of its top pages, ranking deeper calls back to recompute the query"""
+    cdef object recompute
+
+    def __init__(self, array.array ranked, Py_ssize_t total, recompute):
+        self.ranked = ranked
+        self.total = total
+        self.recompute = recompute
+
+    cdef array.array rank(self, Py_ssize_t k):
+        return self.recompute(k).snapshot()
+
+
+cdef class scored_results(ranked_results):
+    """Ranking of candidates whose scores are all computed"""
+    cdef array.array candidates
+    cdef array.array scores
+
+    def __init__(self, array.array candidates, array.array scores, Py_ssize_t k):
+        self.candidates = candidates
+        self.scores = scores
+        self.total = len(candidates)
+        self.ranked = self.rank(k)
+
+    cdef array.array rank(self, Py_ssize_t k):
+        return select_top(self.candidates, self.scores, k)
+
+
+def get_ranked_doc_ids(list postings, Py_ssize_t k=10) -> ranked_results:
+    """Takes in a list of postings and returns with ranked page serials, k best are ranked up front"""
     # Sort postings by ascending order
     postings.sort(key=len)
     # Initialize union list as contents in postings[0]
-    union = [i[0] for i in postings[0]]
+    union = postings[0].serials
     # Iteratively get union of postings
     for i in postings[1:]:
-        union = get_union(union, i, len(union), len(i))
+        union = get_union(union, i.serials, len(union), len(i))
 
     cdef int index, temp
 
@@ -102,86 +549,446 @@ def get_ranked_doc_ids(list postings) -> [int]:
     union_size = len(union)
     # Get the sum of scores for each document
     for i in postings:
-        scores.append(get_score_sum(union, i, union_size, len(i)))
+        scores.append(get_score_sum(union, i.serials, i.scores, union_size, len(i)))
     index = 0
-    result = {}
+    cdef array.array result = array.clone(score_template, union_size, zero=False)
 
     # Calculated score sum from processed list
     while index < union_size:
         temp = 0
         for i in scores:
             temp += i[index]
-        result[union[index]] = temp
+        result[index] = temp
         index += 1
-    # Sort by score and return ranked page serials
-    return [i[0] for i in sorted(result.items(), key=lambda kv: kv[1], reverse=True)]
+    # Rank page serials by score
+    return scored_results(union, result, k)
 
 
-def vector_space_ranking_2(list postings) -> [int]:
-    """Calculates ranking based on cosine similarity of each document in union of documents"""
+def vector_space_ranking_2(list postings, Py_ssize_t doc_count, Py_ssize_t k=10) -> ranked_results:
+    """Calculates ranking based on cosine similarity of each document in union of documents, idf is taken among doc_count pages"""
     # Sort postings by ascending order & get union of all postings
     postings.sort(key=len)
-    union = [i[0] for i in postings[0]]
+    union = postings[0].serials
     for i in postings[1:]:
-        union = get_union(union, i, len(union), len(i))
+        union = get_union(union, i.serials, len(union), len(i))
 
     postings_in_union = []
     cdef int union_size, I
     union_size = len(union)
     # Get tf-idf of all elements
     for posting in postings:
-        postings_in_union.append(get_score_sum(union, posting, union_size, len(posting)))
+        postings_in_union.append(get_score_sum(union, posting.serials, posting.scores, union_size, len(posting)))
 
     # Prepare query matrix
-    query_matrix = length_normalize([1 + get_term_idf(posting) for posting in postings])
+    query_matrix = length_normalize([1 + get_term_idf(posting, doc_count) for posting in postings])
 
     # Invert the list
-    document_similarity = {}
+    cdef array.array document_similarity = array.clone(score_template, union_size, zero=False)
     I = 0
 
     while I < union_size:
         # Prepare each matrix and calculate distance to query matrix
-        document_similarity[union[I]] = cosine_similarity_2(
+        document_similarity[I] = cosine_similarity_2(
             length_normalize([x[I] for x in postings_in_union]), query_matrix)
         I += 1
 
     # Return serial of pages ranked in decreasing order of cosine_similarity
-    return [i[0] for i in sorted(document_similarity.items(), key=lambda kv: kv[1], reverse=True)]
+    return scored_results(union, document_similarity, k)
 
 
-def vector_space_ranking_hybrid(list postings) -> [int]:
-    """Calculates ranking based on cosine similarity of each document in union of documents"""
-    # Sort postings by ascending order & get union of all postings
-    postings.sort(key=len)
-    union = [i[0] for i in postings[0]]
-    for i in postings[1:]:
-        union = get_union(union, i, len(union), len(i))
+def intersect_postings(list postings) -> tuple:
+    """
+    Gets page serials contained in all postings, along with their position in each posting.
+    Postings must be sorted by length, candidates from the shortest one are searched in the others
+    by galloping over block last serials first and over decoded serials within the block second,
+    so only blocks that may hold a candidate are decoded
+    """
+    cdef posting_list first = postings[0], posting
+    cdef Py_ssize_t n = first.count, found, t, i, j, block, position, block_start, block_end
+    cdef int candidate
+    cdef const int *block_last
+    cdef array.array candidates = array.copy(first.serials)
+    cdef array.array kept = array.clone(serial_template, n, zero=False)
+    cdef array.array current_positions
+    positions = [array.array('i', range(n))]
+    for t in range(1, len(postings)):
+        posting = postings[t]
+        block_last = posting.block_last.data.as_ints
+        current_positions = array.clone(serial_template, n, zero=False)
+        found, block, position = 0, 0, 0
+        for i in range(n):
+            candidate = candidates.data.as_ints[i]
+            # Skip blocks whose serials are all below candidate
+            block = gallop(block_last, block, posting.block_count, candidate)
+            if block >= posting.block_count:
+                break
+            posting.load_block_serials(block)
+            block_start = block * block_size
+            block_end = min(posting.count, block_start + block_size)
+            if position < block_start:
+                position = block_start
+            position = gallop(posting.decoded_serials.data.as_ints, position, block_end, candidate)
+            if posting.decoded_serials.data.as_ints[position] == candidate:
+                kept.data.as_ints[found] = i
+                current_positions.data.as_ints[found] = position
+                found += 1
+        # Compact candidates & their positions in previous postings
+        for j in range(found):
+            candidates.data.as_ints[j] = candidates.data.as_ints[kept.data.as_ints[j]]
+        array.resize(candidates, found)
+        for previous_positions in positions:
+            for j in range(found):
+                (<array.array>previous_positions).data.as_ints[j] = (<array.array>previous_positions).data.as_ints[kept.data.as_ints[j]]
+            array.resize(previous_positions, found)
+        array.resize(current_positions, found)
+        positions.append(current_positions)
+        n = found
+    return candidates, positions
 
-    postings_in_union = []
-    cdef int union_size, I
-    union_size = len(union)
-    # Get tf-idf of all elements
-    for posting in postings:
-        postings_in_union.append(get_score_sum(union, posting, union_size, len(posting)))
 
-    # Prepare query matrix
-    query_matrix = length_normalize([1 + get_term_idf(posting) for posting in postings])
+cdef class position_cursor:
+    """Walks the pages of a position stream in ascending order, decoding positions of a page only when asked to"""
+    cdef const unsigned char[:] data
+    cdef Py_ssize_t remaining, start, end
+    cdef int serial
+    cdef bint loaded
 
-    # Invert the list
-    document_similarity = {}
-    I = 0
+    def __init__(self, const unsigned char[:] data):
+        cdef Py_ssize_t pos = 0
+        self.data = data
+        self.remaining = read_varint(&data[0], &pos)
+        read_varint(&data[0], &pos)
+        self.start, self.end, self.serial, self.loaded = pos, pos, 0, False
 
-    # while I < union_size:
-    #     # Prepare each matrix and calculate distance to query matrix
-    #     document_similarity[union[I]] = cosine_similarity_2(
-    #         length_normalize([x[I] for x in postings_in_union]), query_matrix)
-    #     I += 1
+    cdef bint seek(self, int target):
+        """Moves to the record of page target or past it, returns whether the stream holds the page"""
+        cdef Py_ssize_t pos
+        while not self.loaded or self.serial < target:
+            if self.remaining == 0:
+                return False
+            # Skip positions of the current page
+            pos = self.end
+            self.serial += <int>read_varint(&self.data[0], &pos)
+            self.end = read_varint(&self.data[0], &pos)
+            self.start = pos
+            self.end += pos
+            self.remaining -= 1
+            self.loaded = True
+        return self.serial == target
 
-    while I < union_size:
-        temp = [x[I] for x in postings_in_union]
-        document_similarity[union[I]] = sum(temp) + 2.5 * cosine_similarity_2(
-            length_normalize([x[I] for x in postings_in_union]), query_matrix)
-        I += 1
+    cdef Py_ssize_t decode(self, array.array out):
+        """Decodes positions of the current page into out, returns their count"""
+        cdef Py_ssize_t pos = self.start, count = 0
+        cdef int position = 0
+        # A position takes at least a byte
+        if len(out) < self.end - self.start:
+            array.resize(out, self.end - self.start)
+        while pos < self.end:
+            position += <int>read_varint(&self.data[0], &pos)
+            out.data.as_ints[count] = position
+            count += 1
+        return count
 
-    # Return serial of pages ranked in decreasing order of cosine_similarity
-    return [i[0] for i in sorted(document_similarity.items(), key=lambda kv: kv[1], reverse=True)]
+
+cdef bint match_phrase(int **lists, const Py_ssize_t *counts, Py_ssize_t *heads, const int *offsets, Py_ssize_t term_count):
+    """Whether some position p of the first term has every term t at p - offsets[0] + offsets[t]"""
+    cdef Py_ssize_t i, t
+    cdef int start
+    cdef bint found
+    for t in range(term_count):
+        heads[t] = 0
+    for i in range(counts[0]):
+        start = lists[0][i] - offsets[0]
+        found = True
+        for t in range(1, term_count):
+            # Targets only grow, so each list is galloped through once
+            heads[t] = gallop(lists[t], heads[t], counts[t], start + offsets[t])
+            if heads[t] == counts[t]:
+                return False
+            if lists[t][heads[t]] != start + offsets[t]:
+                found = False
+                break
+        if found:
+            return True
+    return False
+
+
+cdef bint match_window(int **lists, const Py_ssize_t *counts, Py_ssize_t *heads, Py_ssize_t term_count, int window):
+    """Whether a position of every term falls within window positions of each other, in any order"""
+    cdef Py_ssize_t t, lowest
+    cdef int low, high
+    for t in range(term_count):
+        heads[t] = 0
+    # Slide over positions in ascending order, always advancing the term with the lowest position
+    while True:
+        lowest, low, high = 0, lists[0][heads[0]], lists[0][heads[0]]
+        for t in range(1, term_count):
+            if lists[t][heads[t]] < low:
+                lowest, low = t, lists[t][heads[t]]
+            if lists[t][heads[t]] > high:
+                high = lists[t][heads[t]]
+        if high - low <= window:
+            return True
+        heads[lowest] += 1
+        if heads[lowest] == counts[lowest]:
+            return False
+
+
+def phrase_match(list streams, offsets, array.array candidates, int window=0, int covered=0) -> array.array:
+    """
+    Gets the candidates whose word positions hold a phrase, from position streams of its terms & ascending candidate serials.
+    Without window terms must appear at their offsets in the phrase, with it they must fall within window positions
+    of each other in any order. Candidates from covered on are kept, the streams hold no positions of their pages
+    """
+    cdef Py_ssize_t term_count = len(streams), n = len(candidates), found = 0, i, t
+    cdef int candidate
+    cdef bint matched
+    cdef array.array kept = array.clone(serial_template, n, zero=False)
+    if len(offsets) != term_count:
+        raise ValueError('A phrase needs an offset for each of its {n} terms'.format(n=term_count))
+    if term_count == 0:
+        return array.copy(candidates)
+    cursors = [position_cursor(stream) for stream in streams]
+    buffers = [array.clone(serial_template, 16, zero=False) for _ in range(term_count)]
+    cdef array.array phrase_offsets = array.array('i', offsets)
+    # Positions, position counts & match heads of each term for the current candidate
+    cdef int **list_data = <int **>malloc(term_count * sizeof(int *))
+    cdef Py_ssize_t *count_data = <Py_ssize_t *>malloc(2 * term_count * sizeof(Py_ssize_t))
+    cdef Py_ssize_t *head_data = count_data + term_count
+    if list_data == NULL or count_data == NULL:
+        free(list_data)
+        free(count_data)
+        raise MemoryError()
+    try:
+        for i in range(n):
+            candidate = candidates.data.as_ints[i]
+            if candidate >= covered:
+                kept.data.as_ints[found] = candidate
+                found += 1
+                continue
+            matched = True
+            for t in range(term_count):
+                if not (<position_cursor>cursors[t]).seek(candidate):
+                    matched = False
+                    break
+            if not matched:
+                continue
+            for t in range(term_count):
+                count_data[t] = (<position_cursor>cursors[t]).decode(buffers[t])
+                # Decoding may move the buffer
+                list_data[t] = (<array.array>buffers[t]).data.as_ints
+                if count_data[t] == 0:
+                    matched = False
+            if not matched:
+                continue
+            if window:
+                matched = match_window(list_data, count_data, head_data, term_count, window)
+            else:
+                matched = match_phrase(list_data, count_data, head_data, phrase_offsets.data.as_ints, term_count)
+            if matched:
+                kept.data.as_ints[found] = candidate
+                found += 1
+    finally:
+        free(list_data)
+        free(count_data)
+    array.resize(kept, found)
+    return kept
+
+
+cdef void hybrid_kernel(const double[:, ::1] matrix, const float[::1] query, const double[::1] multipliers, double[::1] out) noexcept nogil:
+    """
+    Scores each row of a (documents x terms) tf-idf matrix as its sum times the multiplier of its page plus 2.5 times
+    its cosine similarity to the query. Float widths follow sum, length_normalize & cosine_similarity_2 so rankings are unchanged
+    """
+    cdef Py_ssize_t rows = matrix.shape[0], terms = matrix.shape[1], row, term
+    cdef double total, squares
+    cdef float norm, x, y, sumxx, sumyy = 0, sumxy, cosine
+    for term in range(terms):
+        sumyy += query[term] * query[term]
+    for row in range(rows):
+        total, squares = 0, 0
+        for term in range(terms):
+            total += matrix[row, term]
+            x = <float>matrix[row, term]
+            squares += powf(x, 2.0)
+        norm = <float>sqrt(squares)
+        sumxx, sumxy = 0, 0
+        # A row of zeros has no direction
+        if norm != 0:
+            for term in range(terms):
+                x = <float>matrix[row, term] / norm
+                y = query[term]
+                sumxx += x * x
+                sumxy += x * y
+        if sumxx * sumyy != 0:
+            cosine = <float>(sumxy / sqrt(sumxx * sumyy))
+        else:
+            cosine = 0
+        out[row] = total * multipliers[row] + 2.5 * cosine
+
+
+cdef class hybrid_results(ranked_results):
+    """
+    Hybrid ranking of tf-idf sum plus cosine similarity.
+    Pages whose block max scores can not beat the current top k are skipped without decoding their scores,
+    the rest are gathered into a matrix and scored in batches.
+    Multipliers indexed by serial scale tf-idf sums of pages, they must not exceed 1 for block max scores to stay bounds.
+    A candidate filter gets the serials of pages in all postings & returns those worth scoring, in the same order.
+    Query idf is taken among doc_count pages, the live page count postings were scored with
+    """
+    cdef list postings, positions
+    cdef array.array candidates, query, multipliers
+    cdef readonly array.array ranked_scores
+
+    def __init__(self, list postings, Py_ssize_t k, Py_ssize_t doc_count, list dfs=None, array.array multipliers=None, candidate_filter=None):
+        self.postings = postings
+        self.multipliers = multipliers
+        self.candidates, self.positions = intersect_postings(postings)
+        if candidate_filter is not None:
+            self.keep_candidates(candidate_filter(self.candidates))
+        # Prepare query matrix, from document frequencies of the whole index if postings are of one shard
+        if dfs is None:
+            self.query = array.array('f', length_normalize([1 + get_term_idf(posting, doc_count) for posting in postings]))
+        else:
+            self.query = array.array('f', length_normalize([1 + get_df_idf(df, doc_count) for df in dfs]))
+        self.total = len(self.candidates)
+        self.ranked = self.rank(k)
+
+    cdef void keep_candidates(self, array.array kept):
+        """Drops candidates not in kept along with their positions in each posting"""
+        cdef Py_ssize_t n = len(self.candidates), kept_count = len(kept), found = 0, i, j = 0
+        cdef array.array posting_positions
+        for i in range(n):
+            if j < kept_count and kept.data.as_ints[j] == self.candidates.data.as_ints[i]:
+                self.candidates.data.as_ints[found] = self.candidates.data.as_ints[i]
+                for posting_positions in self.positions:
+                    posting_positions.data.as_ints[found] = posting_positions.data.as_ints[i]
+                found += 1
+                j += 1
+        array.resize(self.candidates, found)
+        for posting_positions in self.positions:
+            array.resize(posting_positions, found)
+
+    cdef void flush(self, double[:, ::1] matrix, Py_ssize_t rows, array.array batch_serials, double[::1] batch_multipliers,
+                    double[::1] batch_scores, array.array heap_scores, array.array heap_serials, Py_ssize_t *size, Py_ssize_t k):
+        """Scores gathered rows and offers them to the heap"""
+        cdef Py_ssize_t row
+        cdef const float[::1] query = self.query
+        with nogil:
+            hybrid_kernel(matrix[:rows], query, batch_multipliers[:rows], batch_scores[:rows])
+        for row in range(rows):
+            heap_offer(heap_scores.data.as_doubles, heap_serials.data.as_ints, size, k,
+                       batch_scores[row], batch_serials.data.as_ints[row])
+
+    cdef array.array rank(self, Py_ssize_t k):
+        cdef Py_ssize_t n = self.total, size = 0, term_count = len(self.postings), rows = 0, i, t, position
+        cdef posting_list posting
+        cdef double bound, max_bound = cosine_bound, threshold = 0, multiplier = 1
+        cdef Py_ssize_t multiplier_count = 0 if self.multipliers is None else len(self.multipliers)
+        cdef int serial
+        if k > n:
+            k = n
+        cdef array.array heap_scores = array.clone(score_template, k, zero=False)
+        cdef array.array heap_serials = array.clone(serial_template, k, zero=False)
+        # Scores of ranked pages, so partial rankings of shards can be merged
+        self.ranked_scores = array.clone(score_template, k, zero=False)
+        if k == 0:
+            return heap_serials
+        # Rows of tf-idf gathered for the scoring kernel
+        cdef array.array matrix_data = array.clone(score_template, score_batch_size * term_count, zero=False)
+        cdef double[:, ::1] matrix = <double[:score_batch_size, :term_count]> matrix_data.data.as_doubles
+        cdef array.array batch_serials = array.clone(serial_template, score_batch_size, zero=False)
+        cdef double[::1] batch_multipliers = array.clone(score_template, score_batch_size, zero=False)
+        cdef double[::1] batch_scores = array.clone(score_template, score_batch_size, zero=False)
+        # Best score any page could reach
+        for posting in self.postings:
+            max_bound += posting.max_score
+        for i in range(n):
+            serial = self.candidates.data.as_ints[i]
+            # Pages without statistics are not scaled
+            multiplier = self.multipliers.data.as_doubles[serial] if serial < multiplier_count else 1
+            # Threshold is refreshed after every batch, a stale threshold only prunes less
+            if size == k:
+                # No remaining page can enter the top k
+                if max_bound <= threshold:
+                    break
+                # Bound the score by max scores of the blocks this page is in
+                bound = 0
+                for t in range(term_count):
+                    posting = self.postings[t]
+                    position = (<array.array>self.positions[t]).data.as_ints[i]
+                    bound += posting.block_max.data.as_doubles[position // block_size]
+                if cosine_bound + multiplier * bound <= threshold:
+                    continue
+            # Gather tf-idf of each term, decoding score blocks as needed
+            for t in range(term_count):
+                posting = self.postings[t]
+                position = (<array.array>self.positions[t]).data.as_ints[i]
+                posting.load_block_scores(position // block_size)
+                matrix[rows, t] = posting.decoded_scores.data.as_doubles[position]
+            batch_serials.data.as_ints[rows] = serial
+            batch_multipliers[rows] = multiplier
+            rows += 1
+            if rows == score_batch_size:
+                self.flush(matrix, rows, batch_serials, batch_multipliers, batch_scores, heap_scores, heap_serials, &size, k)
+                rows = 0
+                if size == k:
+                    threshold = heap_scores.data.as_doubles[0]
+        self.flush(matrix, rows, batch_serials, batch_multipliers, batch_scores, heap_scores, heap_serials, &size, k)
+        array.resize(self.ranked_scores, size)
+        return heap_drain(heap_scores.data.as_doubles, heap_serials.data.as_ints, size, self.ranked_scores.data.as_doubles)
+
+
+def vector_space_ranking_hybrid(list postings, Py_ssize_t doc_count, Py_ssize_t k=10, list dfs=None, array.array multipliers=None, candidate_filter=None) -> ranked_results:
+    """
+    Calculates ranking based on tf-idf sum & cosine similarity of each document in union of documents,
+    query idf is taken among doc_count live pages, those of all shards for a shard.
+    Postings of one shard come with document frequencies of their terms across all shards,
+    tf-idf sums are scaled by per page multipliers indexed by serial if given.
+    A candidate filter narrows pages in all postings before any is scored, like phrase matching
+    """
+    if dfs is None:
+        # Sort postings by ascending order
+        postings.sort(key=len)
+        return hybrid_results(postings, k, doc_count, None, multipliers, candidate_filter)
+    # Order terms by global document frequency, like the postings of a single index
+    order = sorted(range(len(postings)), key=lambda i: dfs[i])
+    return hybrid_results([postings[i] for i in order], k, doc_count, [dfs[i] for i in order], multipliers, candidate_filter)
+
+
+cdef inline unsigned int fnv1a_hash(const unsigned char[:] data) nogil:
+    """Gets the 32 bit FNV-1a hash of bytes, stable across processes unlike hash()"""
+    cdef unsigned int result = 2166136261
+    cdef Py_ssize_t i
+    for i in range(data.shape[0]):
+        result = (result ^ data[i]) * 16777619
+    return result
+
+
+def minhash_signature(tokens, const unsigned long long[::1] a, const unsigned long long[::1] b) -> array.array:
+    """
+    Gets the MinHash signature of a set of tokens, for each permutation i the minimum of (a[i] * hash + b[i]) mod 2^61 - 1.
+    Multipliers must stay below 2^31 so the products fit in 64 bits
+    """
+    cdef Py_ssize_t count = a.shape[0], i
+    cdef array.array signature = array.clone(signature_template, count, zero=False)
+    cdef unsigned long long *values = signature.data.as_ulonglongs
+    cdef unsigned long long token_hash, value
+    for i in range(count):
+        values[i] = minhash_prime
+    for token in tokens:
+        token_hash = fnv1a_hash(token.encode())
+        for i in range(count):
+            value = (a[i] * token_hash + b[i]) % minhash_prime
+            if value < values[i]:
+                values[i] = value
+    return signature
+
+
+def signature_similarity(const unsigned long long[::1] signature_1, const unsigned long long[::1] signature_2) -> float:
+    """Estimates the Jaccard similarity of two token sets as the fraction of equal MinHash values"""
+    cdef Py_ssize_t i, equal = 0
+    for i in range(signature_1.shape[0]):
+        if signature_1[i] == signature_2[i]:
+            equal += 1
+    return equal / <double>signature_1.shape[0]
@@ -0,0 +1,98 @@
+import os
+import sys
+import struct
+from array import array
+from atomic_file import atomic_write
+
+# Default location of the page statistics of an index
+doc_stats_loc = 'doc_stats.bin'
+
+# File layout, all numbers little endian, every column indexed by page serial:
+#   header:         magic, page count
+#   field lengths:  4 x count x u32, tokens of raw text, headings, bold text & title
+#   flags:          count x u8, has_title_flag if the page has a title
+header_format = struct.Struct('<4sI')
+magic = b'ICD2'
+fields = ('raw_text', 'heading', 'bold', 'title')
+has_title_flag = 1
+# Score multiplier of pages without title
+no_title_penalty = .5
+
+
+def get_multiplier(flags: int) -> float:
+    """Gets the query time multiplier of tf-idf sums of a page"""
+    if not flags & has_title_flag:
+        return no_title_penalty
+    return 1.
+
+
+class doc_stats:
+
+    def __init__(self, location=doc_stats_loc):
+        """
+        Per page statistics kept as numeric columns indexed by serial, loaded from location if it exists.
+        Multipliers never exceed 1, so block max scores of postings stay upper bounds of page scores
+        """
+        self.location = location
+        self.field_lengths = [array('I') for _ in fields]
+        self.flags = array('B')
+        # Query time multiplier of each page, pages without statistics keep 1
+        self.multipliers = array('d')
+        if os.path.isfile(location):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.flags)
+
+    def grow(self, count: int):
+        """Makes room for count pages, columns are replaced rather than resized so rankings holding them are unaffected"""
+        extra = count - len(self.flags)
+        if extra <= 0:
+            return
+        self.field_lengths = [column + array('I', bytes(4 * extra)) for column in self.field_lengths]
+        self.flags = self.flags + array('B', bytes(extra))
+        self.multipliers = self.multipliers + array('d', [1.] * extra)
+
+    def set(self, serial: int, lengths: [int], has_title: bool):
+        """Records statistics of a page"""
+        self.grow(serial + 1)
+        for column, length in zip(self.field_lengths, lengths):
+            column[serial] = length
+        self.flags[serial] = has_title_flag if has_title else 0
+        self.multipliers[serial] = get_multiplier(self.flags[serial])
+
+    def get(self, serial: int) -> dict:
+        """Gets statistics of a page, None if not recorded"""
+        if serial >= len(self.flags):
+            return None
+        stats = {field + '_length': column[serial] for field, column in zip(fields, self.field_lengths)}
+        stats['has_title'] = bool(self.flags[serial] & has_title_flag)
+        return stats
+
+    def load(self):
+        """Loads statistics from file"""
+        with open(self.location, 'rb') as f:
+            data = f.read()
+        file_magic, count = header_format.unpack_from(data, 0)
+        if file_magic != magic:
+            raise ValueError('Not a page statistics file: {l}'.format(l=self.location))
+        columns = [array('I') for _ in fields] + [array('B')]
+        position = header_format.size
+        for column in columns:
+            size = column.itemsize * count
+            column.frombytes(data[position: position + size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            position += size
+        self.field_lengths, self.flags = columns[:len(fields)], columns[-1]
+        self.multipliers = array('d', [get_multiplier(flags) for flags in self.flags])
+
+    def save(self):
+        """Persists statistics"""
+        with atomic_write(self.location) as f:
+            f.write(header_format.pack(magic, len(self.flags)))
+            for column in self.field_lengths + [self.flags]:
+                if sys.byteorder == 'big':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                f.write(column.tobytes())
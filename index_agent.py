@@ -1,14 +1,53 @@
 import os
 import ujson
 import math
+import struct
+import re
+import fnmatch
+import threading
+from cython_defs import encode_posting, decode_posting, encode_serials, decode_serials, encode_positions, concat_positions, phrase_match
+from term_dictionary import term_dictionary, write_term_dictionary, replace_term_dictionary
+from posting_cache import posting_cache
+from doc_stats import doc_stats, doc_stats_loc
+from page_store import page_store, write_page_store, page_store_loc
+from segment import index_segment, write_merged_index, read_at, segment_index_loc, segment_dictionary_loc
 
 # Parameters for index agent file locations
 index_agent_file_loc = 'index_agent.json'
-index_loc = 'reverse_index.txt'
-standalone_index_loc = 'reverse_standalone_index.txt'
-temp_index_loc = 'temp_index.txt'
-# For faster processing speed
-total_doc_count = 55393
+index_loc = 'reverse_index.bin'
+weight_index_loc = 'reverse_weight_index.bin'
+standalone_index_loc = 'reverse_standalone_index.bin'
+# Text index of older versions, holding page serials in configuration
+legacy_index_locs = ('reverse_index.txt', 'reverse_standalone_index.txt')
+temp_index_loc = 'temp_index.bin'
+temp_weight_index_loc = 'temp_weight_index.bin'
+dictionary_loc = 'index_dictionary.bin'
+weight_dictionary_loc = 'weight_dictionary.bin'
+standalone_dictionary_loc = 'standalone_dictionary.bin'
+temp_dictionary_loc = 'temp_dictionary.bin'
+temp_weight_dictionary_loc = 'temp_weight_dictionary.bin'
+# Word positions of terms in pages, only read for phrase & proximity queries
+position_index_loc = 'reverse_position_index.bin'
+position_dictionary_loc = 'position_dictionary.bin'
+temp_position_index_loc = 'temp_position_index.bin'
+temp_position_dictionary_loc = 'temp_position_dictionary.bin'
+# Sorted partial index files written during indexing, merged once at the end
+run_loc = 'index_run_{i}.bin'
+position_run_loc = 'position_run_{i}.bin'
+# Record header of run files: term byte length, posting byte length, document frequency
+run_record_header = struct.Struct('<III')
+# Names of segments holding pages added after the main index was built
+segment_name = 'segment_{i}'
+# Merge policy: merge the smallest segments once there are this many
+segment_merge_factor = 4
+# Merge policy: fold segments & deletions into main index once they reach this fraction of its pages
+segment_fold_ratio = .05
+# Wildcard of pattern terms like informat*, tokens never contain it
+wildcard = '*'
+# Patterns are expanded into at most this many terms, those in most pages
+max_pattern_terms = 50
+# Characters a pattern must start with, so it never expands over much of the dictionary
+min_pattern_prefix = 2
 
 
 def merge_reverse_index(a: dict, b: dict) -> dict:
@@ -17,281 +56,648 @@ def merge_reverse_index(a: dict, b: dict) -> dict:
     return a
 
 
+def iter_partial_index(new_dict: dict):
+    """Iterates over (term, encoded posting, document frequency) of a partial index in ascending order"""
+    for key in sorted(new_dict.keys()):
+        item = dict(sorted(new_dict[key].items()))
+        yield key, encode_posting(list(item.keys()), list(item.values())), len(item)
+
+
+def iter_partial_positions(new_dict: dict):
+    """Iterates over (term, encoded positions, document frequency) of partial word positions in ascending order"""
+    for key in sorted(new_dict.keys()):
+        item = sorted(new_dict[key].items())
+        yield key, encode_positions([serial for serial, _ in item], [positions for _, positions in item]), len(item)
+
+
+def iter_index_file(dictionary: term_dictionary, location: str):
+    """Iterates over (term, encoded posting, document frequency) of an index file in ascending order, with a file handle of its own"""
+    with open(location, 'rb') as f:
+        for key, offset, length, df in dictionary.items():
+            f.seek(offset)
+            yield key, f.read(length), df
+
+
+def write_records(location: str, records):
+    """Writes (term, encoded data, document frequency) records in ascending term order to a run file"""
+    with open(location, 'wb') as f:
+        for key, data, df in records:
+            encoded_key = key.encode()
+            f.write(run_record_header.pack(len(encoded_key), len(data), df))
+            f.write(encoded_key)
+            f.write(data)
+
+
+def write_run(location: str, new_dict: dict):
+    """Writes a partial index to file as records of [term][encoded posting] in ascending term order"""
+    write_records(location, iter_partial_index(new_dict))
+
+
+def write_position_run(location: str, new_dict: dict):
+    """Writes partial word positions to file as records of [term][encoded positions] in ascending term order"""
+    write_records(location, iter_partial_positions(new_dict))
+
+
+def read_run(location: str):
+    """Iterates over (term, encoded posting, document frequency) of a run file in ascending order"""
+    with open(location, 'rb') as f:
+        while True:
+            header = f.read(run_record_header.size)
+            if len(header) < run_record_header.size:
+                return
+            key_length, data_length, df = run_record_header.unpack(header)
+            key = f.read(key_length).decode()
+            yield key, f.read(data_length), df
+
+
+def merge_raw_postings(items: [], deleted=frozenset()) -> (bytes, int):
+    """Merges postings of one term from several sources, later sources take precedence & deleted pages are dropped"""
+    if len(items) == 1 and not deleted:
+        # Copy encoded posting as is
+        return items[0][1], items[0][2]
+    merged_posting = dict()
+    for _, data, _ in items:
+        posting = decode_posting(data)
+        merged_posting = merge_reverse_index(merged_posting, dict(zip(posting.serials, posting.scores)))
+    merged_posting = dict(sorted((serial, score) for serial, score in merged_posting.items() if serial not in deleted))
+    if not merged_posting:
+        return None
+    return encode_posting(list(merged_posting.keys()), list(merged_posting.values())), len(merged_posting)
+
+
+def merge_position_streams(items: []) -> (bytes, int):
+    """Joins word positions of one term from several sources, sources hold ascending ranges of pages"""
+    if len(items) == 1:
+        return items[0][1], items[0][2]
+    return concat_positions([data for _, data, _ in items]), sum(df for _, _, df in items)
+
+
+def get_tf_idf(weight: float, idf: float) -> float:
+    """Gets the tf-idf score of a term weight, per page multipliers like the no title penalty are applied when ranking"""
+    return round((1 + math.log(weight, 10)) * idf, 4)
+
+
+def score_raw_postings(items: [], deleted: set, doc_count: int, df=None) -> (bytes, int):
+    """
+    Scores raw weight postings of one term from several sources with tf-idf, idf is computed from live pages.
+    A shard passes the document frequency of the term across all shards
+    """
+    weights = dict()
+    for _, data, _ in items:
+        posting = decode_posting(data)
+        for serial, weight in zip(posting.serials, posting.scores):
+            if serial not in deleted:
+                weights[serial] = weight
+    if not weights:
+        return None
+    idf = math.log(doc_count / (df or len(weights)), 10)
+    serials = sorted(weights.keys())
+    scores = [get_tf_idf(weights[serial], idf) for serial in serials]
+    return encode_posting(serials, scores), len(serials)
+
+
 class index_agent:
 
-    def __init__(self, init=False):
-        """An manager object for file system & index"""
+    def __init__(self, init=False, cache_byte_budget=64 * 1024 * 1024, cache_policy='tinylfu', read_only=False, location=''):
+        """
+        An manager object for file system & index, a read only agent never initializes a missing index.
+        Index files are kept in the location directory, the working directory by default
+        """
+        self.location = location
+        # Never mistake an index of older versions for a missing one, initializing would wipe its configuration
+        if not init and not os.path.isfile(self.locate(index_loc)) and os.path.isfile(self.locate(legacy_index_locs[0])):
+            raise ValueError('Index at {l} is in the text format of older versions, rebuild it with start_index.py'.format(l=self.locate(legacy_index_locs[0])))
         # Check if database directory exsists
-        if not (os.path.isfile(index_agent_file_loc) and os.path.isfile(index_loc)):
+        if not (os.path.isfile(self.locate(index_agent_file_loc)) and os.path.isfile(self.locate(index_loc)) and os.path.isfile(self.locate(dictionary_loc))):
+            if read_only:
+                raise FileNotFoundError('No index at {l1} and configuration at {l2}'.format(l1=self.locate(index_loc), l2=self.locate(index_agent_file_loc)))
             # If not, construct database
             init = True
+        if init and read_only:
+            raise AttributeError('A read only index agent can not initialize an index')
 
         if init:
             print("Warning, initializing index!")
+            if location:
+                os.makedirs(location, exist_ok=True)
             # Remove database if exists
-            if os.path.isfile(index_agent_file_loc):
-                os.remove(index_agent_file_loc)
-            if os.path.isfile(index_loc):
-                os.remove(index_loc)
+            if os.path.isfile(self.locate(index_agent_file_loc)):
+                # Remove segments of old index
+                with open(self.locate(index_agent_file_loc)) as file:
+                    for description in ujson.load(file).get('segments', []):
+                        for loc in (segment_index_loc, segment_dictionary_loc):
+                            if os.path.isfile(self.locate(loc.format(name=description['name']))):
+                                os.remove(self.locate(loc.format(name=description['name'])))
+                os.remove(self.locate(index_agent_file_loc))
+            for loc in (index_loc, doc_stats_loc, position_index_loc, position_dictionary_loc) + legacy_index_locs:
+                if os.path.isfile(self.locate(loc)):
+                    os.remove(self.locate(loc))
             # Store empty dict to json
-            store_dict = {'single_index_table': {}, 'standalone_single_table_index': {}, 'cache': {}, 'standalone_cache': {}, 'page_serial': {}, 'page_titles': {}}
-            with open(index_agent_file_loc, 'w') as file:
+            store_dict = {'generation': 0, 'idf_doc_count': None, 'segments': [], 'next_segment': 0, 'deleted': [], 'shard': None, 'position_serial_count': None}
+            with open(self.locate(index_agent_file_loc), 'w') as file:
                 ujson.dump(store_dict, file)
-            f = open(index_loc, "w+")
-            f.close()
+            for loc in (index_loc, weight_index_loc, standalone_index_loc):
+                f = open(self.locate(loc), "wb+")
+                f.close()
+            # Store empty term dictionaries & page store
+            for loc in (dictionary_loc, weight_dictionary_loc, standalone_dictionary_loc):
+                write_term_dictionary(self.locate(loc), [], [], [], [])
+            write_page_store(self.locate(page_store_loc), {}, {})
         else:
-            print("Using existing index at {l1} and configuration at {l2}".format(l1=index_loc, l2=index_agent_file_loc))
+            print("Using existing index at {l1} and configuration at {l2}".format(l1=self.locate(index_loc), l2=self.locate(index_agent_file_loc)))
 
         # Load data from json file
-        f = open(index_agent_file_loc)
+        f = open(self.locate(index_agent_file_loc))
         store_dict = ujson.load(f)
         f.close()
         # This is the main index of the search engine
-        self.reverse_index = open(index_loc, 'r')
+        self.reverse_index = open(self.locate(index_loc), 'rb')
         # This is a simplified index containing only page serial
-        self.standalone_index = open(standalone_index_loc, 'r')
-        # This is a reference table from page serial to posting location in line
-        self.single_table_index = store_dict['single_index_table']
-        # This is a reference table from page serial to posting location in line
-        self.standalone_single_table_index = store_dict['standalone_single_table_index']
-        # This is a cache containing 100 postings, approved by professor
-        self.cache = store_dict['cache']
-        # This is a cache of standalone index, containing same 100 postings as main cache
-        self.standalone_cache = store_dict['standalone_cache']
-        # This is a reference table from serial to url
-        self.page_serial = {int(key): store_dict['page_serial'][key] for key in store_dict['page_serial'].keys()}
-        # This is a reference table from serial to page titles
-        self.page_titles = {int(key): store_dict['page_titles'][key] for key in store_dict['page_titles'].keys()}
+        self.standalone_index = open(self.locate(standalone_index_loc), 'rb')
+        # This is a memory mapped table from term to (byte offset, byte length, df) of its posting
+        self.single_table_index = term_dictionary(self.locate(dictionary_loc))
+        # This is a memory mapped table from term to (byte offset, byte length, df) of its simplified posting
+        self.standalone_single_table_index = term_dictionary(self.locate(standalone_dictionary_loc))
+        # This is the main index before tf-idf, holding raw term weights for rescoring with live statistics
+        self.weight_index = open(self.locate(weight_index_loc), 'rb')
+        self.weight_table_index = term_dictionary(self.locate(weight_dictionary_loc))
+        # This is a counter increased whenever postings change, for invalidating derived results
+        self.generation = store_dict.get('generation', 0)
+        # This is a cache of postings filled as terms are searched, approved by professor
+        self.cache = posting_cache(cache_byte_budget, cache_policy)
+        # This is a cache of standalone index, with the same policy as main cache
+        self.standalone_cache = posting_cache(cache_byte_budget // 4, cache_policy)
+        # This is a list of run files not yet merged into main index
+        self.runs = []
+        # This is a list of word position run files not yet merged into the position index
+        self.position_runs = []
+        # This is the live page count main index scores were computed with
+        self.idf_doc_count = store_dict['idf_doc_count']
+        # This is a list of immutable segments of pages added after main index was built, oldest first
+        self.segments = [index_segment(description['name'], description['doc_count'], location) for description in store_dict['segments']]
+        self.next_segment = store_dict['next_segment']
+        # This is a set of tombstones, serials of deleted or replaced pages still present in postings
+        self.deleted = set(store_dict['deleted'])
+        # This is the position & count of shards if the index is one shard of a document partitioned index, scored with global idf
+        self.shard = store_dict.get('shard')
+        # Guards index files & segments against the background merge
+        self.lock = threading.RLock()
+        self.merge_thread = None
+        # This is a memory mapped table from serial to url & page title
+        self.pages = page_store(self.locate(page_store_loc))
+        # This is a table of page statistics indexed by serial, holding query time score multipliers
+        self.doc_stats = doc_stats(self.locate(doc_stats_loc))
+        # This is the count of serials the optional index of word positions covers, None without one
+        self.position_serial_count = store_dict.get('position_serial_count')
+        if self.position_serial_count is not None:
+            self.position_index = open(self.locate(position_index_loc), 'rb')
+            self.position_table_index = term_dictionary(self.locate(position_dictionary_loc))
+        else:
+            self.position_index, self.position_table_index = None, None
+
+    def locate(self, loc: str) -> str:
+        """Gets the path of an index file in the location of the agent"""
+        return os.path.join(self.location, loc)
 
     def get_standalone_posting(self, index: str) -> []:
-        """Gets simplified postings for given page serial"""
-        # Try cache first
-        if index in self.standalone_cache:
-            return self.standalone_cache[index]
-        # Load data from file
-        if index in self.standalone_single_table_index:
-            # Seek to line
-            self.standalone_index.seek(self.standalone_single_table_index[index])
-            # Decode string into 2d list from read information
-            return ujson.loads(self.standalone_index.readline())
-        return None
+        """Gets simplified postings for given term"""
+        with self.lock:
+            # Try cache first
+            posting = self.standalone_cache.get(index)
+            if posting is not None:
+                return posting
+            # Load data from file
+            entry = self.standalone_single_table_index.get(index)
+            if entry:
+                # Decode bytes read at posting into array of page serials
+                posting = decode_serials(read_at(self.standalone_index, entry[0], entry[1]))
+                self.standalone_cache.put(index, posting, 4 * entry[2])
+                return posting
+            return None
 
     def get_posting(self, index: str) -> []:
-        """Gets full posting for given page serial"""
-        # Try cache first
-        if index in self.cache:
-            return self.cache[index]
-        # Load data from file
-        if index in self.single_table_index:
-            # Seek to line
-            self.reverse_index.seek(self.single_table_index[index])
-            # Decode string into 2d list from read information
-            return ujson.loads(self.reverse_index.readline())
-        return None
+        """Gets full posting for given term across main index & segments, a pattern term gets the union of its terms"""
+        if wildcard in index:
+            return self.get_pattern_posting(index)
+        with self.lock:
+            # Try cache first
+            posting = self.cache.get(index)
+            if posting is not None:
+                return posting
+            if not self.scores_outdated():
+                # Main index is up to date
+                entry = self.single_table_index.get(index)
+                if not entry:
+                    return None
+                # Decode bytes into posting list
+                data, df = self.read_reverse_index(entry[0], entry[1]), entry[2]
+            else:
+                # Rescore raw weights of main index & every segment containing the term with live statistics
+                items = []
+                entry = self.weight_table_index.get(index)
+                if entry:
+                    items.append((0, read_at(self.weight_index, entry[0], entry[1]), entry[2]))
+                for i, segment in enumerate(self.segments):
+                    found = segment.get(index)
+                    if found:
+                        items.append((i + 1, found[0], found[1]))
+                combined = score_raw_postings(items, self.deleted, self.live_doc_count())
+                if combined is None:
+                    return None
+                data, df = combined
+            posting = decode_posting(data)
+            # Encoded bytes plus serials & scores once fully decoded
+            self.cache.put(index, posting, len(data) + 12 * df)
+            return posting
+
+    def has_positions(self) -> bool:
+        """Whether the index holds word positions for phrase & proximity queries"""
+        return self.position_index is not None
+
+    def get_positions(self, index: str) -> bytes:
+        """Gets encoded word positions of a term in pages of main index, None if no page holds it"""
+        with self.lock:
+            entry = self.position_table_index.get(index)
+            if not entry:
+                return None
+            return read_at(self.position_index, entry[0], entry[1])
+
+    def match_phrases(self, phrases: [([str], int)], candidates):
+        """
+        Gets the candidate serials holding every (terms, window) phrase, terms in order without window
+        or within window positions of each other with it. Pages added since positions were indexed are kept
+        """
+        for terms, window in phrases:
+            if window:
+                # Order does not matter, a term repeated in the phrase is found once
+                terms = sorted(set(terms))
+            # A term without positions matches no indexed page
+            streams = [self.get_positions(term) or encode_positions([], []) for term in terms]
+            candidates = phrase_match(streams, range(len(terms)), candidates, window, self.position_serial_count)
+            if not candidates:
+                break
+        return candidates
+
+    def expand_pattern(self, pattern: str) -> [str]:
+        """Gets the terms matching a pattern, at most max_pattern_terms of those in most pages"""
+        # Characters up to the first character fnmatch treats specially
+        prefix = re.split(r'[*?\[]', pattern)[0]
+        if len(prefix) < min_pattern_prefix:
+            return []
+        with self.lock:
+            # Terms only in segments are found in their dictionaries
+            if self.scores_outdated():
+                dictionaries = [self.weight_table_index] + [segment.dictionary for segment in self.segments]
+            else:
+                dictionaries = [self.single_table_index]
+            dfs = dict()
+            for dictionary in dictionaries:
+                # Only terms sharing the prefix are visited
+                for term, _, _, df in dictionary.prefix_items(prefix):
+                    if fnmatch.fnmatchcase(term, pattern):
+                        dfs[term] = dfs.get(term, 0) + df
+        return sorted(dfs.keys(), key=lambda term: (-dfs[term], term))[:max_pattern_terms]
+
+    def get_pattern_posting(self, pattern: str) -> []:
+        """Gets the union of postings of terms matching a pattern, scores of a page are summed over its matching terms"""
+        with self.lock:
+            # Try cache first, patterns never collide with terms
+            posting = self.cache.get(pattern)
+            if posting is not None:
+                return posting
+            scores = dict()
+            for term in self.expand_pattern(pattern):
+                posting = self.get_posting(term)
+                if posting:
+                    for serial, score in zip(posting.serials, posting.scores):
+                        scores[serial] = scores.get(serial, 0) + score
+            if not scores:
+                return None
+            serials = sorted(scores.keys())
+            data = encode_posting(serials, [scores[serial] for serial in serials])
+            posting = decode_posting(data)
+            self.cache.put(pattern, posting, len(data) + 12 * len(serials))
+            return posting
+
+    def scores_outdated(self) -> bool:
+        """Whether main index scores miss segments, deletions or pages added since idf was computed"""
+        if self.shard is not None:
+            # Scores were computed with statistics of all shards
+            return False
+        return bool(self.segments or self.deleted) or self.live_doc_count() != self.idf_doc_count
+
+    def read_reverse_index(self, offset: int, length: int) -> bytes:
+        """Reads an encoded posting from main index without decoding, safe for concurrent readers"""
+        return read_at(self.reverse_index, offset, length)
 
     def get_page_title(self, serial: int) -> str:
         """Gets page title for given page serial"""
-        if serial in self.page_titles:
-            return self.page_titles[serial]
-        return None
+        return self.pages.get_title(serial)
 
     def merge_to(self, new_dict: dict):
-        """Merge a partial index into main index file"""
-        # Init variables
-        global_index, global_len = 0, len(self.single_table_index)
-        new_index, new_len = 0, len(new_dict)
-        # Get iter objects for existing reference tables from serial to location
-        iter_global_dict, iter_new_dict = iter(sorted(self.single_table_index.keys())), iter(sorted(new_dict.keys()))
-        if len(self.single_table_index) == 0:
-            global_key = None
-        else:
-            global_key = next(iter_global_dict)
-        new_key = next(iter_new_dict)
-        # Create temp file for storing the new merged index
-        merged = open(temp_index_loc, "w+")
-        # Create new reference table from serial to location
-        new_single_table_index = dict()
-        # Index for keeping write locations
-        merged_write_index = 0
-        # Iterate through both index
-        while global_index < global_len or new_index < new_len:
-            # Decide to merge or to load one of the postings
-            # Global index done
-            if global_index >= global_len:
-                operation = 'dump_new'
-            # New index done
-            elif new_index >= new_len:
-                operation = 'dump_global'
-            # Compare keys
-            else:
-                if not global_key:
-                    operation = 'dump_new'
-                else:
-                    if global_key < new_key:
-                        operation = 'dump_global'
-                    elif global_key > new_key:
-                        operation = 'dump_new'
-                    else:
-                        operation = 'merge'
-
-            # Dump global postings
-            if operation == 'dump_global':
-                # Store index location
-                new_single_table_index[global_key] = merged_write_index
-                # Seek posting from global index file
-                self.reverse_index.seek(self.single_table_index[global_key])
-                # Load data
-                item = self.reverse_index.readline().replace('\n', '')
-                # Increment global index
-                global_index += 1
-                if global_index < global_len:
-                    global_key = next(iter_global_dict)
-            # Dump new postings
-            elif operation == 'dump_new':
-                # Store index location
-                new_single_table_index[new_key] = merged_write_index
-                # Get posting
-                item = dict(sorted(new_dict[new_key].items()))
-                # Increment new index
-                new_index += 1
-                if new_index < new_len:
-                    new_key = next(iter_new_dict)
-            # Merge both postings
-            else:
-                # Store index location
-                new_single_table_index[global_key] = merged_write_index
-                # Get both postings
-                self.reverse_index.seek(self.single_table_index[global_key])
-                item_1 = ujson.loads(self.reverse_index.readline())
-                item_1 = {pair[0]: pair[1] for pair in item_1}
-                item_2 = new_dict[new_key]
-                # Merge both postings and sort
-                item = dict(sorted(merge_reverse_index(item_1, item_2).items()))
-                # Increment both index
-                global_index += 1
-                new_index += 1
-                if global_index < global_len:
-                    global_key = next(iter_global_dict)
-                if new_index < new_len:
-                    new_key = next(iter_new_dict)
-
-            # Process data into json string
-            if operation != 'dump_global':
-                item = ujson.dumps([i for i in item.items()])
-            # Write information
-            merged.write(item + "\n")
-            merged_write_index += len(item + '\n')
-
-        # Close new file
-        merged.close()
-        # Update single table index
-        self.single_table_index = new_single_table_index
-        # Store updates to json
+        """Merge a partial index into raw weights of main index, construct_tf_idf rebuilds main index from them"""
+        self.flush_run(new_dict)
+        self.merge_runs()
+
+    def flush_run(self, new_dict: dict):
+        """Writes a partial index to a sorted run file, runs are merged into main index by merge_runs"""
+        write_run(self.reserve_runs(1)[0], new_dict)
+
+    def reserve_runs(self, count: int) -> [str]:
+        """Gets locations for new run files, which are merged into main index by merge_runs once written"""
+        locations = [self.locate(run_loc.format(i=len(self.runs) + i)) for i in range(count)]
+        self.runs += locations
+        return locations
+
+    def merge_runs(self):
+        """Merges raw weights of main index & all run files in a single streaming k-way merge"""
+        if not self.runs:
+            return
+        self.wait_for_merge()
+        # Main index comes first, so postings of later runs take precedence like in merge_reverse_index
+        sources = [iter_index_file(self.weight_table_index, self.locate(weight_index_loc))] + [read_run(location) for location in self.runs]
+        write_merged_index(sources, self.locate(temp_weight_index_loc), self.locate(temp_weight_dictionary_loc), lambda key, items: merge_raw_postings(items))
+        self.replace_weight_index()
+        # Remove merged runs
+        for location in self.runs:
+            os.remove(location)
+        self.runs = []
+        self.bump_generation()
+
+    def enable_positions(self):
+        """Makes the index record word positions of pages indexed from now on, for phrase & proximity queries"""
+        if self.has_positions():
+            return
+        f = open(self.locate(position_index_loc), 'wb')
+        f.close()
+        write_term_dictionary(self.locate(position_dictionary_loc), [], [], [], [])
+        self.position_index = open(self.locate(position_index_loc), 'rb')
+        self.position_table_index = term_dictionary(self.locate(position_dictionary_loc))
+        self.position_serial_count = 0
         self.update_json_config()
+
+    def reserve_position_runs(self, count: int) -> [str]:
+        """Gets locations for new word position run files, which are merged into the position index by merge_position_runs"""
+        if not self.has_positions():
+            raise AttributeError('Index records no word positions, enable them before indexing')
+        locations = [self.locate(position_run_loc.format(i=len(self.position_runs) + i)) for i in range(count)]
+        self.position_runs += locations
+        return locations
+
+    def merge_position_runs(self):
+        """
+        Merges word positions of the position index & all position run files, runs must hold ascending ranges of pages
+        above those already indexed. Positions then cover all pages given serials so far
+        """
+        if not self.position_runs:
+            return
+        sources = [iter_index_file(self.position_table_index, self.locate(position_index_loc))] + [read_run(location) for location in self.position_runs]
+        write_merged_index(sources, self.locate(temp_position_index_loc), self.locate(temp_position_dictionary_loc), lambda key, items: merge_position_streams(items))
+        with self.lock:
+            self.position_index.close()
+            os.replace(self.locate(temp_position_index_loc), self.locate(position_index_loc))
+            self.position_table_index = replace_term_dictionary(self.position_table_index, self.locate(temp_position_dictionary_loc))
+            self.position_index = open(self.locate(position_index_loc), 'rb')
+            self.position_serial_count = self.get_next_serial()
+        for location in self.position_runs:
+            os.remove(location)
+        self.position_runs = []
+        self.update_json_config()
+
+    def replace_reverse_index(self):
+        """Moves an index & dictionary written to temp locations in place of main index"""
         # Delete old reverse index & move new one
         self.reverse_index.close()
-        os.remove(index_loc)
-        os.rename(temp_index_loc, index_loc)
+        os.replace(self.locate(temp_index_loc), self.locate(index_loc))
+        self.single_table_index = replace_term_dictionary(self.single_table_index, self.locate(temp_dictionary_loc))
         # Open new reverse index
-        self.reverse_index = open(index_loc, 'r')
+        self.reverse_index = open(self.locate(index_loc), 'rb')
+
+    def replace_weight_index(self):
+        """Moves a raw weight index & dictionary written to temp locations in place of the current ones"""
+        self.weight_index.close()
+        os.replace(self.locate(temp_weight_index_loc), self.locate(weight_index_loc))
+        self.weight_table_index = replace_term_dictionary(self.weight_table_index, self.locate(temp_weight_dictionary_loc))
+        self.weight_index = open(self.locate(weight_index_loc), 'rb')
 
     def process_standalone_single_index(self):
         """Process standalone index from full index"""
-        # Create standalone table index
-        standalone_single_table_index = dict()
+        # Create columns of standalone table index
+        terms, offsets, lengths, dfs = [], [], [], []
         # Counter variable
         index = 0
         # Create file
-        if os.path.isfile(standalone_index_loc):
-            os.remove(standalone_index_loc)
-        f = open(standalone_index_loc, 'w')
-        # Iterate over data
-        for key in self.single_table_index:
-            standalone_single_table_index[key] = index
-            data = self.get_posting(key)
-            data = [i[0] for i in data]
-            data = ujson.dumps(data) + '\n'
+        self.standalone_index.close()
+        if os.path.isfile(self.locate(standalone_index_loc)):
+            os.remove(self.locate(standalone_index_loc))
+        f = open(self.locate(standalone_index_loc), 'wb')
+        # Iterate over data, raw weights hold the same serials as main index
+        for key, data, df in iter_index_file(self.weight_table_index, self.locate(weight_index_loc)):
+            data = encode_serials(decode_posting(data).serials)
+            terms.append(key)
+            offsets.append(index)
+            lengths.append(len(data))
+            dfs.append(df)
             f.write(data)
             index += len(data)
-        self.standalone_single_table_index = standalone_single_table_index
-        self.update_json_config()
+        f.close()
+        self.standalone_index = open(self.locate(standalone_index_loc), 'rb')
+        write_term_dictionary(self.locate(temp_dictionary_loc), terms, offsets, lengths, dfs)
+        self.standalone_single_table_index = replace_term_dictionary(self.standalone_single_table_index, self.locate(temp_dictionary_loc))
+        self.standalone_cache.clear()
 
     def add_page_serial(self, page_serial_in: dict):
         """Add page serial lookup table"""
-        self.page_serial = {int(key): page_serial_in[key] for key in page_serial_in.keys()}
-        self.update_json_config()
+        self.write_pages({int(key): page_serial_in[key] for key in page_serial_in.keys()},
+                         {serial: title for serial, _, title in self.pages.items()})
 
     def add_page_titles(self, page_titles_in: dict):
         """Add page title lookup table"""
-        self.page_titles = page_titles_in
+        self.write_pages({serial: url for serial, url, _ in self.pages.items()}, page_titles_in)
+
+    def write_pages(self, urls: dict, titles: dict, serial_count=None):
+        """Replaces the page store, readers holding the old one keep using it"""
+        write_page_store(self.locate(page_store_loc), urls, titles, serial_count)
+        self.pages = page_store(self.locate(page_store_loc))
+
+    def add_doc_stats(self, page_stats: [(int, [int], bool)]):
+        """Records (serial, field lengths, whether the page has a title) of indexed pages & persists them"""
+        with self.lock:
+            # Grow columns once, growing them page by page copies them for every page
+            if page_stats:
+                self.doc_stats.grow(max(serial for serial, _, _ in page_stats) + 1)
+            for serial, lengths, has_title in page_stats:
+                self.doc_stats.set(serial, lengths, has_title)
+            self.doc_stats.save()
+
+    def get_multipliers(self):
+        """Gets query time score multipliers indexed by serial"""
+        return self.doc_stats.multipliers
+
+    def bump_generation(self):
+        """Marks postings as changed"""
+        self.generation += 1
+        self.cache.clear()
         self.update_json_config()
 
     def update_json_config(self):
         """Stores all index agent files to json"""
-        store_dict = {'single_index_table': self.single_table_index, 'standalone_single_table_index': self.standalone_single_table_index, 'cache': self.cache, 'standalone_cache': self.standalone_cache, 'page_serial': self.page_serial, 'page_titles': self.page_titles}
-        with open(index_agent_file_loc, 'w') as file:
+        store_dict = {'generation': self.generation, 'idf_doc_count': self.idf_doc_count,
+                      'segments': [segment.to_json() for segment in self.segments], 'next_segment': self.next_segment,
+                      'deleted': list(self.deleted), 'shard': self.shard,
+                      'position_serial_count': self.position_serial_count}
+        with open(self.locate(index_agent_file_loc), 'w') as file:
             ujson.dump(store_dict, file)
 
-    def construct_tf_idf(self):
-        """Process tf-idf score for the main index"""
-        # Create temp file
-        converted = open(temp_index_loc, "w+")
-        new_single_table_index = dict()
-        current_write_index = 0
-        # Iterate over all keywords in index
-        for key in self.single_table_index.keys():
-            # Get posting information
-            posting = self.get_posting(key)
-            # Calculate idf score
-            idf = math.log(55393 / len(posting), 10)
-            # Multiply posting by idf score
-            for i in posting:
-                # Add penalty for no title
-                if self.get_page_title(i[0]) == None:
-                    i[1] = round((1 + math.log(i[1], 10)) * idf, 4) * .5
-                else:
-                    i[1] = round((1 + math.log(i[1], 10)) * idf, 4)
-            # Append information to new table index
-            new_single_table_index[key] = current_write_index
-            # Convert postings to string for storage
-            item = ujson.dumps(posting)
-            # Write
-            converted.write(item + "\n")
-            # Increment current write index
-            current_write_index += len(item + '\n')
-        # Close new file
-        converted.close()
-        # Update single table index
-        self.single_table_index = new_single_table_index
-        # Store updates to json
-        self.update_json_config()
-        # Delete old reverse index & move new one
-        self.reverse_index.close()
-        os.remove(index_loc)
-        os.rename(temp_index_loc, index_loc)
-        # Open new reverse index
-        self.reverse_index = open(index_loc, 'r')
-
-    def update_cache(self, n_largest=100):
-        """Update cache from main index"""
-        # Declare list for sizes of all postings
-        sizes = {}
-        # Get length of each posting
-        for key in self.single_table_index.keys():
-            sizes[key] = len(self.get_posting(key))
-        # Get n largest postings
-        to_cache = [i[0] for i in sorted(sizes.items(), key=lambda kv: kv[1], reverse=True)[:n_largest]]
-        # Init cache
-        self.cache = {}
-        self.standalone_cache = {}
-        # Load to cache
-        for i in to_cache:
-            self.cache[i] = self.get_posting(i)
-            self.standalone_cache[i] = [x[0] for x in self.cache[i]]
-        # Update config file
+    def construct_tf_idf(self, doc_count=None, dfs: term_dictionary = None):
+        """
+        Process tf-idf score for the main index from its raw weights.
+        A shard is scored with the page count & document frequencies of all shards
+        """
+        self.wait_for_merge()
+        # Compute idf from live page count
+        if doc_count is None:
+            doc_count = self.live_doc_count()
+        get_df = (lambda key: None) if dfs is None else (lambda key: dfs[key][2])
+        write_merged_index([iter_index_file(self.weight_table_index, self.locate(weight_index_loc))], self.locate(temp_index_loc), self.locate(temp_dictionary_loc),
+                           lambda key, items: score_raw_postings(items, self.deleted, doc_count, get_df(key)))
+        self.replace_reverse_index()
+        self.idf_doc_count = doc_count
+        self.bump_generation()
+
+    def live_doc_count(self) -> int:
+        """Gets the number of pages not deleted"""
+        return len(self.pages) - len(self.deleted)
+
+    def get_next_serial(self) -> int:
+        """Gets the serial of the next added page"""
+        return self.pages.serial_count
+
+    def set_shard(self, position: int, count: int):
+        """Marks the index as one of count shards of a document partitioned index"""
+        self.shard = {'position': position, 'count': count}
         self.update_json_config()
 
+    def check_segments_supported(self):
+        """Makes sure scores can be recomputed with live statistics"""
+        if self.shard is not None:
+            raise AttributeError('Index is a shard scored with global statistics, rebuild all shards with shard.py to add or delete pages')
+
+    def add_segment(self, new_dict: dict, page_serial_in: dict, page_titles_in: dict, replaced_serials=()):
+        """Adds a partial index of new pages as a segment, replaced serials are older versions of the pages"""
+        self.check_segments_supported()
+        with self.lock:
+            name = segment_name.format(i=self.next_segment)
+            self.next_segment += 1
+        # Segments hold raw weights, scored with live idf when searched
+        write_merged_index([iter_partial_index(new_dict)], self.locate(segment_index_loc.format(name=name)),
+                           self.locate(segment_dictionary_loc.format(name=name)), lambda key, items: merge_raw_postings(items))
+        with self.lock:
+            self.segments.append(index_segment(name, len(page_serial_in), self.location))
+            urls, titles = dict(), dict()
+            for serial, url, title in self.pages.items():
+                urls[serial], titles[serial] = url, title
+            urls.update(page_serial_in)
+            titles.update(page_titles_in)
+            self.write_pages(urls, titles)
+            self.deleted.update(serial for serial in replaced_serials if serial in self.pages)
+            self.bump_generation()
+        self.maybe_merge()
+
+    def delete_pages(self, serials: [int]):
+        """Deletes pages by recording tombstones, postings are cleaned up by merges"""
+        self.check_segments_supported()
+        with self.lock:
+            self.deleted.update(serial for serial in serials if serial in self.pages)
+            self.bump_generation()
+        self.maybe_merge()
+
+    def maybe_merge(self, background=True):
+        """
+        Merge policy, folds segments & deletions into main index once they reach segment_fold_ratio of its pages,
+        otherwise merges the smallest segments once there are segment_merge_factor of them
+        """
+        if self.merge_thread is not None and self.merge_thread.is_alive():
+            return
+        with self.lock:
+            if not (self.segments or self.deleted):
+                return
+            segment_doc_count = sum(segment.doc_count for segment in self.segments)
+            if segment_doc_count + len(self.deleted) >= segment_fold_ratio * (len(self.pages) - segment_doc_count):
+                target, args = self.fold_segments, ()
+            elif len(self.segments) >= segment_merge_factor:
+                smallest = sorted(self.segments, key=lambda segment: segment.doc_count)[:segment_merge_factor]
+                target, args = self.merge_segments, (smallest,)
+            else:
+                return
+        if background:
+            self.merge_thread = threading.Thread(target=target, args=args, daemon=True)
+            self.merge_thread.start()
+        else:
+            target(*args)
+
+    def wait_for_merge(self):
+        """Waits for a background merge to finish"""
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+            self.merge_thread = None
+
+    def merge_segments(self, segments: []):
+        """Merges segments into a single segment, dropping deleted pages"""
+        with self.lock:
+            name = segment_name.format(i=self.next_segment)
+            self.next_segment += 1
+            deleted = set(self.deleted)
+        write_merged_index([segment.items() for segment in segments], self.locate(segment_index_loc.format(name=name)),
+                           self.locate(segment_dictionary_loc.format(name=name)), lambda key, items: merge_raw_postings(items, deleted))
+        with self.lock:
+            merged = index_segment(name, sum(segment.doc_count for segment in segments), self.location)
+            self.segments = [segment for segment in self.segments if segment not in segments] + [merged]
+            for segment in segments:
+                segment.remove()
+            self.update_json_config()
+
+    def fold_segments(self):
+        """Rewrites main index with all segments folded in & deleted pages dropped, scored with live idf"""
+        with self.lock:
+            segments, deleted = list(self.segments), set(self.deleted)
+            doc_count = self.live_doc_count()
+            sources = [iter_index_file(self.weight_table_index, self.locate(weight_index_loc))] + [segment.items() for segment in segments]
+        # Merge raw weights, then score them like construct_tf_idf
+        write_merged_index(sources, self.locate(temp_weight_index_loc), self.locate(temp_weight_dictionary_loc),
+                           lambda key, items: merge_raw_postings(items, deleted))
+        weights = term_dictionary(self.locate(temp_weight_dictionary_loc))
+        write_merged_index([iter_index_file(weights, self.locate(temp_weight_index_loc))], self.locate(temp_index_loc), self.locate(temp_dictionary_loc),
+                           lambda key, items: score_raw_postings(items, set(), doc_count))
+        weights.close()
+        with self.lock:
+            self.replace_weight_index()
+            self.replace_reverse_index()
+            self.segments = [segment for segment in self.segments if segment not in segments]
+            for segment in segments:
+                segment.remove()
+            # Deleted pages are gone from postings, their serials stay reserved
+            urls, titles = dict(), dict()
+            for serial, url, title in self.pages.items():
+                if serial not in deleted:
+                    urls[serial], titles[serial] = url, title
+            self.write_pages(urls, titles, self.pages.serial_count)
+            self.deleted -= deleted
+            self.idf_doc_count = doc_count
+            self.process_standalone_single_index()
+            self.bump_generation()
+
+    def warm_cache(self, terms: [str]):
+        """Warm up posting cache with terms of past queries, most frequent terms are admitted first"""
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in sorted(counts.items(), key=lambda kv: kv[1], reverse=True):
+            # Let the cache see how often the term was searched before offering it
+            for _ in range(count - 1):
+                self.cache.record_request(term)
+            self.get_posting(term)
+
     def get_urls(self, serials: [int]) -> [str]:
         """Get urls of pages"""
-        return [self.page_serial[i] for i in serials]
-
+        return [self.pages.get_url(i) for i in serials]
@@ -3,14 +3,17 @@ import nltk
 import ujson
 from nltk.stem.snowball import SnowballStemmer
 from pipeline import pipeline
-from parse import get_raw_text, remove_contents, get_headings, get_title, get_bold, get_title_text
-from index_agent import index_agent
-from multiprocessing import Process, Manager
+from tokenizer import tokenize
+from stem_cache import stem_cache
+from parse import remove_contents, load_record, get_html_parser, html_parser
+from index_agent import index_agent, write_run, write_position_run, wildcard
+from multiprocessing import Pool
+from functools import partial
 import time
 import re
-from cython_defs import vector_space_ranking_hybrid
-from bs4 import BeautifulSoup
-from page_similarity import near_duplicate_db
+from cython_defs import vector_space_ranking_hybrid, frozen_results
+from query_cache import query_result_cache
+from page_similarity import near_duplicate_db, get_signature
 
 selected_stopwords = {'an', 'you', 'of', 'it', 'are', 'we', 'he', 'she', 'is', 'the', 'it'}
 
@@ -18,12 +21,22 @@ import warnings
 warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
 
 file_location = 'DEV/'
+# Past queries used for warming up the posting cache, one query per line
+query_log_loc = 'query_log.txt'
 stemmer = SnowballStemmer("english")
+# Memo of stems, loaded from disk so builds & queries start warm
+stems = stem_cache(stemmer)
 
 weights = {'raw_text_tokens': 1,
           'heading_tokens' : .5,
           'bold_tokens': .5,
           'title_tokens': 2}
+# Word positions of a page run through raw text, headings, bold text & title, fields are this many positions apart
+field_position_gap = 100
+# Widest proximity window of a query like "machine learning"~5, kept below the gap so matches never span fields
+max_phrase_window = 50
+# Quoted phrase of a query, with an optional proximity window
+phrase_regex = re.compile(r'"([^"]*)"(?:~(\d+))?')
 
 
 def to_lower(sentence: str) -> str:
@@ -54,7 +67,7 @@ def remove_punctuations(words: [str]) -> [str]:
 
 def stem_all(tokens: [str]) -> [str]:
     """Wrapper functions, stem all strings in list"""
-    return [stemmer.stem(i) for i in tokens]
+    return stems.stem_all(tokens)
 
 
 def get_file(file_location: str) -> str:
@@ -74,14 +87,21 @@ def make_query_tokenizing_pipeline() -> pipeline:
     """
     Constructs a pipeline for query tokenizing
     """
-    return pipeline('tokenize', [remove_contents, to_lower, nltk.word_tokenize, remove_punctuations, break_by, stem_all, remove_junk], protected=False, error_behavior=['all' for _ in range(7)], error_return_object=[])
+    return pipeline('tokenize', [tokenize, stem_all], protected=False, error_behavior=['all' for _ in range(2)], error_return_object=[])
 
 
-def make_tokenizing_pipeline() -> pipeline:
+def make_tokenizing_pipeline(instrument=False) -> pipeline:
     """
     Constructs a pipeline for tokenizing
     """
-    return pipeline('tokenize', [remove_contents, to_lower, nltk.word_tokenize, remove_punctuations, break_by, stem_all, remove_junk], protected=False, error_behavior=['all' for _ in range(7)], error_return_object=[])
+    return pipeline('tokenize', [tokenize, stem_all], protected=False, error_behavior=['all' for _ in range(2)], error_return_object=[], instrument=instrument)
+
+
+def make_legacy_tokenizing_pipeline() -> pipeline:
+    """
+    Constructs the original stage by stage tokenizing pipeline, the reference for the single pass tokenizer
+    """
+    return pipeline('tokenize_legacy', [remove_contents, to_lower, nltk.word_tokenize, remove_punctuations, break_by, stem_all, remove_junk], protected=False, error_behavior=['all' for _ in range(7)], error_return_object=[])
 
 
 def add_to_index(reverse_index: dict, serial: int, tokens: [str], multiplier=1):
@@ -102,54 +122,76 @@ def add_to_index(reverse_index: dict, serial: int, tokens: [str], multiplier=1):
             reverse_index[token] = {serial: round(1 * multiplier, 3)}
 
 
-def get_all_paths():
-    """Serialize all pages, get all pages, urls, and page titles"""
+def add_positions(positions: dict, serial: int, tokens: [str], start=0):
+    """Adds word positions of a list of tokens to partial positions, the first token is at start"""
+    for position, token in enumerate(tokens, start):
+        if token in positions:
+            if serial in positions[token]:
+                positions[token][serial].append(position)
+            else:
+                positions[token][serial] = [position]
+        else:
+            positions[token] = {serial: [position]}
+
+
+def list_all_pages() -> [str]:
+    """Lists all page files in corpus"""
     pages = []
-    page_serial, inverse_page_serial, page_titles = dict(), dict(), dict()
-    index = 0
     for path in [i for i in os.listdir(file_location) if not i.startswith('.')]:
         site_path = file_location + path + '/'
-        if index % 1 == 0:
+        pages += [site_path + page for page in os.listdir(site_path) if not page.startswith('.')]
+    return pages
+
+
+def get_page_summary(path: str, parser=html_parser, signature_size=None) -> (str, str, []):
+    """Gets url, title & near duplicate signature of a page if signature size is given, run by pool workers"""
+    record = load_record(path, parser)
+    signature = get_signature(record['raw_text'], signature_size) if signature_size else None
+    return record['url'], record['title'], signature
+
+
+def iter_page_summaries(paths: [str], process_count=None, parser=html_parser, signature_size=None):
+    """Gets summaries of pages in order with a process pool, each page is parsed once & its record cached on disk"""
+    with Pool(process_count or os.cpu_count() or 1) as pool:
+        for summary in pool.imap(partial(get_page_summary, parser=parser, signature_size=signature_size), paths, chunksize=16):
+            yield summary
+
+
+def get_all_paths(process_count=None, parser=html_parser):
+    """Serialize all pages, get all pages, urls, and page titles"""
+    pages = list_all_pages()
+    page_serial, inverse_page_serial, page_titles = dict(), dict(), dict()
+    for index, (path, (url, title, _)) in enumerate(zip(pages, iter_page_summaries(pages, process_count, parser))):
+        if index % 1000 == 0:
             print("Current index: " + str(index))
-        for page in [i for i in os.listdir(site_path) if not i.startswith('.')]:
-            pages.append(site_path + page)
-            with open(site_path + page) as f:
-                json_content = ujson.load(f)
-                url = json_content['url']
-                page_title = get_title_text(json_content['content'])
-            page_serial[index] = url
-            page_titles[index] = page_title
-            inverse_page_serial[site_path + page] = index
-            index += 1
+        page_serial[index] = url
+        page_titles[index] = title
+        inverse_page_serial[path] = index
     return pages, page_serial, inverse_page_serial, page_titles
 
 
-def get_all_paths_remove_duplicates():
+def get_all_paths_remove_duplicates(process_count=None, parser=html_parser):
     """Serialize all pages, get all pages, urls, and page titles"""
     nd_db = near_duplicate_db()
+    all_pages = list_all_pages()
     pages = []
     page_serial, inverse_page_serial, page_titles = dict(), dict(), dict()
     index = 0
-    for path in [i for i in os.listdir(file_location) if not i.startswith('.')]:
-        site_path = file_location + path + '/'
-        if index % 1 == 0:
-            print("Current index: " + str(index))
-        for page in [i for i in os.listdir(site_path) if not i.startswith('.')]:
-            with open(site_path + page) as f:
-                json_content = ujson.load(f)
-                url = json_content['url']
-                # Check for near duplicate
-                is_duplicate, x = nd_db.check_duplicate(url, json_content['content'])
-                if not is_duplicate:
-                    page_title = get_title_text(json_content['content'])
-                if is_duplicate:
-                    print("Duplicate found at: " + url)
-            if not is_duplicate:
-                pages.append(site_path + page)
-                page_serial[index] = url
-                page_titles[index] = page_title
-                inverse_page_serial[site_path + page] = index
-                index += 1
+    # Signatures are computed by workers, only looking them up is serial
+    summaries = iter_page_summaries(all_pages, process_count, parser, signature_size=nd_db.num_perm)
+    for i, (path, (url, title, signature)) in enumerate(zip(all_pages, summaries)):
+        if i % 1000 == 0:
+            print("Current index: " + str(i))
+        # Check for near duplicate
+        is_duplicate, x = nd_db.check_signature(url, signature)
+        if is_duplicate:
+            print("Duplicate found at: " + url)
+        else:
+            pages.append(path)
+            page_serial[index] = url
+            page_titles[index] = title
+            inverse_page_serial[path] = index
+            index += 1
     return pages, page_serial, inverse_page_serial, page_titles
 
 
@@ -166,112 +208,149 @@ def merge_reverse_index(a: dict, b: dict) -> dict:
     return a
 
 
-def manager_to_dict(x) -> dict:
-    """Copies a dictionary"""
-    result = dict()
-    for key in x.keys():
-        result[key] = x[key]
-    return result
-
-
-def multicore_worker(process_index: int, tokenize_ppl: pipeline, paths: [], inverse_page_serial: {}, result_index: {}):
-    """A worker process for the multiprocessing indexer"""
-    print("Process [{i}] started".format(i=process_index))
+def index_record(local_index: dict, serial: int, record: dict, tokenize_ppl: pipeline, local_positions: dict = None) -> [int]:
+    """
+    Adds tokens of a page record to a partial index & their word positions to local positions if given.
+    Returns token counts of raw text, headings, bold text & title
+    """
+    # Collect different types of tokens in one batch
+    raw_text_tokens, heading_tokens, bold_tokens, title_tokens = tokenize_ppl.process_batch(
+        [record['raw_text'], record['headings'], record['bold'], record['title_words']])
+
+    # Add tokens to partial index with given weights
+    add_to_index(local_index, serial, raw_text_tokens, multiplier=weights['raw_text_tokens'])
+    add_to_index(local_index, serial, heading_tokens, multiplier=weights['heading_tokens'])
+    add_to_index(local_index, serial, bold_tokens, multiplier=weights['bold_tokens'])
+    add_to_index(local_index, serial, title_tokens, multiplier=weights['title_tokens'])
+    if local_positions is not None:
+        # Number positions through all fields, leaving a gap between fields
+        start = 0
+        for tokens in (raw_text_tokens, heading_tokens, bold_tokens, title_tokens):
+            add_positions(local_positions, serial, tokens, start)
+            start += len(tokens) + field_position_gap
+    return [len(raw_text_tokens), len(heading_tokens), len(bold_tokens), len(title_tokens)]
+
+
+# Tokenizing pipeline & html parser of a pool worker, set by init_multicore_worker
+worker_tokenize_ppl = None
+worker_parser = html_parser
+
+
+def init_multicore_worker(tokenize_ppl: pipeline, parser: str):
+    """Initializer of pool workers for the multiprocessing indexer"""
+    global worker_tokenize_ppl, worker_parser
+    worker_tokenize_ppl, worker_parser = tokenize_ppl, parser
+    # Forked workers inherit the loaded stems, spawned ones load them here
+    stems.load()
+
+
+def multicore_worker(job: ([], str, str)) -> (int, [], [], []):
+    """
+    A pool worker of the multiprocessing indexer, indexes a chunk of (path, serial) pairs into a run file,
+    & word positions into a position run file if given one.
+    Returns the chunk length, the stems learned while indexing it, pipeline stats & page statistics of the chunk
+    """
+    chunk, run_location, position_run_location = job
     # Create local index
     local_index = dict()
-    while len(paths) > 0:
-        # Get new path
-        try:
-            current_path = paths.pop()
-        except:
-            break
+    local_positions = dict() if position_run_location else None
+    page_stats = []
+    for current_path, serial in chunk:
+        # Get record of website, cached when serials were assigned
+        record = load_record(current_path, worker_parser)
+        page_stats.append((serial, index_record(local_index, serial, record, worker_tokenize_ppl, local_positions), record['title'] is not None))
+
+    # Spill local index to its run file instead of sending it back through a pipe
+    write_run(run_location, local_index)
+    if position_run_location:
+        write_position_run(position_run_location, local_positions)
+    return len(chunk), stems.take_new(), worker_tokenize_ppl.take_stats(), page_stats
 
-        # Get content of website
-        content = get_file(current_path)
-        # Make soup
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # Collect different types of tokens
-        raw_text_tokens = tokenize_ppl.process_item(get_raw_text(soup))
-        heading_tokens = tokenize_ppl.process_item(get_headings(soup))
-        bold_tokens = tokenize_ppl.process_item(get_bold(soup))
-        title_tokens = tokenize_ppl.process_item(get_title(soup))
-
-        # Add tokens to partial index with given weights
-        add_to_index(local_index, inverse_page_serial[current_path], raw_text_tokens, multiplier=weights['raw_text_tokens'])
-        add_to_index(local_index, inverse_page_serial[current_path], heading_tokens, multiplier=weights['heading_tokens'])
-        add_to_index(local_index, inverse_page_serial[current_path], bold_tokens, multiplier=weights['bold_tokens'])
-        add_to_index(local_index, inverse_page_serial[current_path], title_tokens, multiplier=weights['title_tokens'])
-
-    print("Process [{i}] moving local variable for return".format(i=process_index))
-    for key in local_index.keys():
-        result_index[key] = local_index[key]
-
-
-def multicore_reporting_worker(initial_length: int, paths: [], report_freq=1):
-    """Reporting thread for multiprocessing indexer"""
-    percentages = set()
-    path_size = len(paths)
-    while path_size > 1:
-        path_size = len(paths)
-        completed = initial_length - len(paths)
-        percentage = int((completed / initial_length) * 100)
-        if (percentage not in percentages) and percentage % report_freq == 0:
-            print("{p}% completed [{c}/{t}]".format(p=percentage, c=completed, t=initial_length))
-            percentages.add(percentage)
-
-
-def multicore_indexer(agent: index_agent, all_paths: [], page_serial: dict, inverse_page_serial: dict, process_count=4, batch_size=10000):
-    """Multiprocessing indexer"""
+
+def multicore_indexer(agent: index_agent, all_paths: [], page_serial: dict, inverse_page_serial: dict, process_count=None, chunk_size=500, parser=html_parser, instrument=True, timings=None):
+    """
+    Multiprocessing indexer, prints a per stage breakdown of the tokenizing pipeline if instrumented.
+    Seconds spent in each phase & stage stats are added to timings if given
+    """
+    if timings is None:
+        timings = dict()
+    # Use all available cores by default
+    if process_count is None:
+        process_count = os.cpu_count() or 1
     # Create pipeline object
-    tokenize_ppl = make_tokenizing_pipeline()
+    tokenize_ppl = make_tokenizing_pipeline(instrument)
     # Count all paths
     num_paths = len(all_paths)
-    print("Total size: {b}".format(b=num_paths))
-    # Process paths in batches
-    for i in range(0, num_paths, batch_size):
-        if i + batch_size > num_paths:
-            current_batch = all_paths[i:]
-        else:
-            current_batch = all_paths[i:i+batch_size]
-        print("Current batch size: {b}".format(b=len(current_batch)))
-        # Create multiprocessing shared variable manager
-        manager = Manager()
-        # Create shared variable
-        shared_paths = manager.list(current_batch)
-        shared_inverse_serial = manager.dict(inverse_page_serial)
-        # Create list of local index
-        local_indices = [manager.dict() for _ in range(process_count)]
-        # Create reporting thread
-        jobs = []
-        p = Process(target=multicore_reporting_worker, args=(len(shared_paths), shared_paths))
-        jobs.append(p)
-        p.start()
-
-        # Create processing thread
-        for i in range(process_count):
-            p = Process(target=multicore_worker,
-                        args=(i, tokenize_ppl, shared_paths, shared_inverse_serial, local_indices[i]))
-            jobs.append(p)
-            p.start()
-
-        for proc in jobs:
-            proc.join()
-
-        # Gather all data
-        print("Converting local indices")
-        local_indices = [manager_to_dict(i) for i in local_indices]
-        result = local_indices[0]
-        for i, index in enumerate(local_indices[1:]):
-            print("Merging local indices: [{i}/{t}]".format(i=i, t=process_count - 1))
-            result = merge_reverse_index(result, index)
-
-        # Merge to global index
-        agent.merge_to(result)
-    # Add page serial to indexing agent
+    print("Total size: {b}, processes: {p}".format(b=num_paths, p=process_count))
+    # Split paths into contiguous chunks of (path, serial) pairs, each chunk is indexed into its own run file
+    chunks = [[(path, inverse_page_serial[path]) for path in all_paths[i:i + chunk_size]] for i in range(0, num_paths, chunk_size)]
+    run_locations = agent.reserve_runs(len(chunks))
+    # Chunks hold ascending serials, so position runs are joined in chunk order
+    position_run_locations = agent.reserve_position_runs(len(chunks)) if agent.has_positions() else [None] * len(chunks)
+    completed, percentages, page_stats = 0, set(), []
+    a = time.time()
+    # Load stems before forking so every worker starts warm
+    stems.load()
+    with Pool(process_count, initializer=init_multicore_worker, initargs=(tokenize_ppl, parser)) as pool:
+        for chunk_length, new_stems, stats, chunk_page_stats in pool.imap_unordered(multicore_worker, zip(chunks, run_locations, position_run_locations)):
+            # Collect stems learned & stats recorded by workers
+            stems.update(new_stems)
+            tokenize_ppl.merge_stats(stats)
+            page_stats += chunk_page_stats
+            completed += chunk_length
+            percentage = int((completed / num_paths) * 100)
+            if percentage not in percentages:
+                print("{p}% completed [{c}/{t}]".format(p=percentage, c=completed, t=num_paths))
+                percentages.add(percentage)
+    # Persist stems for later builds & queries
+    stems.save()
+    print("Stem cache: {s}".format(s=len(stems)))
+    timings['tokenize'] = time.time() - a
+    if instrument:
+        print(tokenize_ppl.format_stats())
+        timings['stages'] = [stats.to_json() for stats in tokenize_ppl.stats]
+    a = time.time()
+    # Merge all run files into global index at once
+    agent.merge_runs()
+    timings['merge'] = time.time() - a
+    a = time.time()
+    # Add page serial & statistics to indexing agent
     agent.add_page_serial(page_serial)
+    agent.add_doc_stats(page_stats)
+    # Word positions cover all pages given serials
+    agent.merge_position_runs()
     # Process standalone index from full index
     agent.process_standalone_single_index()
+    timings['standalone'] = time.time() - a
+
+
+def add_pages(agent: index_agent, paths: [str], tokenize_ppl: pipeline, parser=html_parser):
+    """
+    Indexes new or recrawled pages into a new segment, older versions of recrawled pages are deleted.
+    Word positions are not recorded for segments, phrases are not checked on added pages until the index is rebuilt
+    """
+    # Find live pages by url
+    live_serials = {url: serial for serial, url, _ in agent.pages.items() if serial not in agent.deleted}
+    local_index, page_serial, page_titles, replaced_serials, page_stats = dict(), dict(), dict(), [], []
+    serial = agent.get_next_serial()
+    stems.load()
+    for path in paths:
+        record = load_record(path, parser)
+        if record['url'] in live_serials:
+            replaced_serials.append(live_serials[record['url']])
+        page_serial[serial] = record['url']
+        page_titles[serial] = record['title']
+        page_stats.append((serial, index_record(local_index, serial, record, tokenize_ppl), record['title'] is not None))
+        serial += 1
+    stems.save()
+    agent.add_doc_stats(page_stats)
+    agent.add_segment(local_index, page_serial, page_titles, replaced_serials)
+
+
+def delete_pages(agent: index_agent, urls: [str]):
+    """Removes pages from search results by url"""
+    urls = set(urls)
+    agent.delete_pages([serial for serial, url, _ in agent.pages.items() if url in urls])
 
 
 def convert_to_html(paths: [str], target_loc= 'web_pages/'):
@@ -283,16 +362,21 @@ def convert_to_html(paths: [str], target_loc= 'web_pages/'):
         file.close()
 
 
-def vector_space_search(ia: index_agent, user_input: str, query_tokenizing_ppl: pipeline) -> [str]:
-    """Performs a vector space search with user query"""
-    # Split input and tokenize with tokenizing pipeline
-    query = query_tokenizing_ppl.process_item(user_input.split(' '))
+def vector_space_rank(ia: index_agent, query: [str], k=10, fetched_postings: dict = None, phrases: [([str], int)] = None) -> [int]:
+    """
+    Ranks pages for a tokenized query, the k best results are ranked up front, fetched postings are used before reading index.
+    Pages must hold the (terms, window) phrases of the query if the index has word positions, checked before scoring
+    """
+    get_posting = ia.get_posting
+    if fetched_postings is not None:
+        def get_posting(term: str):
+            return fetched_postings[term] if term in fetched_postings else ia.get_posting(term)
     # Remove selected stopwords
     stopword_removed = [i for i in query if i not in selected_stopwords]
     # Collect posting
     postings = []
     for i in stopword_removed:
-        posting = ia.get_posting(i)
+        posting = get_posting(i)
         if posting:
             postings.append(posting)
     # Check if postings are all empty
@@ -305,7 +389,9 @@ def vector_space_search(ia: index_agent, user_input: str, query_tokenizing_ppl:
         # Try including stopwords
         stopwords_in_query = [i for i in query if i in selected_stopwords]
         for s in stopwords_in_query:
-            postings.append(ia.get_posting(s))
+            posting = get_posting(s)
+            if posting:
+                postings.append(posting)
         for i in postings:
             if len(i) > 0:
                 is_empty = False
@@ -313,27 +399,103 @@ def vector_space_search(ia: index_agent, user_input: str, query_tokenizing_ppl:
         # Return None if still empty
         if is_empty:
             return None
-    x = vector_space_ranking_hybrid(postings)
+    candidate_filter = None
+    if phrases and ia.has_positions():
+        def candidate_filter(candidates):
+            return ia.match_phrases(phrases, candidates)
+    # Query idf is taken among live pages, like postings rescored after pages are added or deleted
+    x = vector_space_ranking_hybrid(postings, ia.live_doc_count(), k, multipliers=ia.get_multipliers(), candidate_filter=candidate_filter)
 
     return x
 
 
-def init_index_agent():
-    """Initialize index agent"""
+def split_patterns(user_input: str) -> ([str], [str]):
+    """Splits a user query into words to tokenize & lower cased pattern terms, words with a wildcard like informat*"""
+    words, patterns = [], []
+    for word in user_input.split(' '):
+        if wildcard in word:
+            # Keep characters terms are made of
+            pattern = re.sub(r'[^a-z0-9*]', '', word.lower())
+            if pattern.strip(wildcard):
+                patterns.append(pattern)
+        else:
+            words.append(word)
+    return words, patterns
+
+
+def split_phrases(user_input: str) -> (str, [(str, int)]):
+    """
+    Splits quoted phrases out of a user query, returns the rest of the query & (phrase, window) pairs.
+    A phrase like "machine learning" has window 0, "machine learning"~5 has its words within 5 positions in any order
+    """
+    phrases = [(match.group(1), min(int(match.group(2) or 0), max_phrase_window)) for match in phrase_regex.finditer(user_input)]
+    return phrase_regex.sub(' ', user_input), phrases
+
+
+def parse_query(user_input: str, query_tokenizing_ppl: pipeline) -> ([str], [([str], int)]):
+    """Tokenizes a user query into terms & (terms, window) phrases, terms of phrases are ranked like the other terms"""
+    rest, phrases = split_phrases(user_input)
+    # Patterns are matched against terms as they are
+    words, patterns = split_patterns(rest)
+    phrases = [(query_tokenizing_ppl.process_item(phrase.split(' ')), window) for phrase, window in phrases]
+    query = query_tokenizing_ppl.process_item(words) + [term for terms, _ in phrases for term in terms] + patterns
+    # A phrase of one term is an ordinary term
+    return query, [(terms, window) for terms, window in phrases if len(terms) > 1]
+
+
+def vector_space_search(ia: index_agent, user_input: str, query_tokenizing_ppl: pipeline, k=10, result_cache: query_result_cache = None) -> [int]:
+    """Performs a vector space search with user query, the k best results are ranked up front"""
+    # Split input and tokenize with tokenizing pipeline
+    query, phrases = parse_query(user_input, query_tokenizing_ppl)
+    if result_cache is None:
+        return vector_space_rank(ia, query, k, phrases=phrases)
+    # Serve repeated queries from cache, paging past the cached ranking recomputes it, phrases are keyed as quoted terms
+    key = tuple(query + ['"{t}"~{w}'.format(t=' '.join(terms), w=window) for terms, window in phrases])
+    cached = result_cache.get(key, ia.generation)
+    if cached:
+        ranked, total = cached
+        return frozen_results(ranked, total, lambda depth: vector_space_rank(ia, query, depth, phrases=phrases))
+    x = vector_space_rank(ia, query, k, phrases=phrases)
+    if x is not None:
+        result_cache.put(key, ia.generation, x.snapshot(), len(x))
+    return x
+
+
+def warm_up_posting_cache(ia: index_agent, query_tokenizing_ppl: pipeline, log_location=query_log_loc):
+    """Warm up posting cache with terms from a query log, one query per line"""
+    if not os.path.isfile(log_location):
+        return
+    terms = []
+    with open(log_location) as f:
+        for tokens in query_tokenizing_ppl.process_stream(line.strip().split(' ') for line in f):
+            terms += tokens
+    ia.warm_cache(terms)
+    print("Posting cache warmed up: {s}".format(s=ia.cache.stats()))
+
+
+def init_index_agent(fast_parser=False, process_count=None, positions=False) -> dict:
+    """Initialize index agent, recording word positions for phrase queries if asked to, returns seconds spent in each phase of the build"""
     # Wipe agent file
     ia = index_agent(init=True)
-    # Get all info from files
-    all_paths, page_serial, inverse_page_serial, page_titles = get_all_paths()
+    if positions:
+        ia.enable_positions()
+    parser = get_html_parser(fast_parser)
+    timings = dict()
     a = time.time()
+    # Get all info from files, parsing each page once
+    all_paths, page_serial, inverse_page_serial, page_titles = get_all_paths(process_count, parser=parser)
+    timings['parse'] = time.time() - a
     # Index all websites
-    multicore_indexer(ia, all_paths, page_serial, inverse_page_serial, process_count=6, batch_size=10000)
+    multicore_indexer(ia, all_paths, page_serial, inverse_page_serial, process_count, parser=parser, timings=timings)
+    b = time.time()
     # Add titles to pages
     ia.add_page_titles(page_titles)
     # Construct tf-idf
     ia.construct_tf_idf()
-    # Update cache
-    ia.update_cache()
-    print("Time used: " + str(time.time() - a))
+    timings['tf_idf'] = time.time() - b
+    timings['total'] = time.time() - a
+    print("Time used: " + str(timings['total']))
+    return timings
 
 
 def terminal_ui():
@@ -342,6 +504,12 @@ def terminal_ui():
     ia = index_agent()
     # Create tokenizing pipeline
     query_tokenizing_ppl = make_query_tokenizing_pipeline()
+    # Start with stems of the last build
+    stems.load()
+    # Warm up posting cache with past queries
+    warm_up_posting_cache(ia, query_tokenizing_ppl)
+    # Create cache for rankings of repeated queries
+    result_cache = query_result_cache()
     # Warm up
     vector_space_search(ia, 'hello world', query_tokenizing_ppl)
     # Set page to 0
@@ -352,6 +520,7 @@ def terminal_ui():
     while 1:
         user_in = input("Please enter a query (<, > for swapping pages, >quit for quit):")
         if user_in == ">quit":
+            print("Result cache: {s}".format(s=result_cache.stats()))
             break
         # Swap page
         if result_serials and (user_in == "<" or user_in == ">"):
@@ -368,7 +537,7 @@ def terminal_ui():
             # Reset Current Page
             current_page = 0
             # Get results
-            result_serials = vector_space_search(ia, user_in, query_tokenizing_ppl)
+            result_serials = vector_space_search(ia, user_in, query_tokenizing_ppl, result_cache=result_cache)
             time_taken = time.time() - a
         # If no result found
         if not result_serials:
@@ -384,11 +553,8 @@ def terminal_ui():
                 "|Time Used: {t}ms | {pc} results| Page {cp} / {tp}".format(t=1000 * time_taken, pc=len(result_serials),
                                                                             cp=current_page + 1,
                                                                             tp=int(len(result_serials) / 10)))
-            # Display page
-            if (current_page + 1) * 10 >= len(result_serials):
-                display_serials = result_serials[current_page * 10:]
-            else:
-                display_serials = result_serials[current_page * 10: (current_page + 1) * 10]
+            # Display page, ranking is expanded lazily when paging past ranked results
+            display_serials = result_serials[current_page * 10: (current_page + 1) * 10]
             display_urls = ia.get_urls(display_serials)
             display_titles = [ia.get_page_title(i) for i in display_serials]
             for i in range(10):
@@ -1,9 +1,17 @@
 import re
+import random
+from array import array
 
 from urllib.parse import urlparse
 
 from parse import get_raw_text
 from bs4 import BeautifulSoup
+from cython_defs import minhash_signature, signature_similarity
+
+# Seed of MinHash permutations, signatures are only comparable when computed with the same seed & size
+minhash_seed = 1
+# Permutations by signature size
+minhash_permutations = {}
 
 # A set of English stopwords as provided on assignment link
 stopwords = {'a', 'about', 'above', 'after', 'again', 'against', 'all', 'am', 'an', 'and', 'any', 'are', "aren't", 'as', 'at', 'be', 'because', 'been', 'before', 'being', 'below', 'between', 'both', 'but', 'by', "can't", 'cannot', 'could', "couldn't", 'did', "didn't", 'do', 'does', "doesn't", 'doing', "don't", 'down', 'during', 'each', 'few', 'for', 'from', 'further', 'had', "hadn't", 'has', "hasn't", 'have', "haven't", 'having', 'he', "he'd", "he'll", "he's", 'her', 'here', "here's", 'hers', 'herself', 'him', 'himself', 'his', 'how', "how's", 'i', "i'd", "i'll", "i'm", "i've", 'if', 'in', 'into', 'is', "isn't", 'it', "it's", 'its', 'itself', "let's", 'me', 'more', 'most', "mustn't", 'my', 'myself', 'no', 'nor', 'not', 'of', 'off', 'on', 'once', 'only', 'or', 'other', 'ought', 'our', 'ours', 'ourselves', 'out', 'over', 'own', 'same', "shan't", 'she', "she'd", "she'll", "she's", 'should', "shouldn't", 'so', 'some', 'such', 'than', 'that', "that's", 'the', 'their', 'theirs', 'them', 'themselves', 'then', 'there', "there's", 'these', 'they', "they'd", "they'll", "they're", "they've", 'this', 'those', 'through', 'to', 'too', 'under', 'until', 'up', 'very', 'was', "wasn't", 'we', "we'd", "we'll", "we're", "we've", 'were', "weren't", 'what', "what's", 'when', "when's", 'where', "where's", 'which', 'while', 'who', "who's", 'whom', 'why', "why's", 'with', "won't", 'would', "wouldn't", 'you', "you'd", "you'll", "you're", "you've", 'your', 'yours', 'yourself', 'yourselves'}
@@ -35,19 +43,9 @@ def get_intersection_union(tokenSet1: set, tokenSet2: set) -> int:
     Returns the intersection and the union of two sets.
     Modified from Assignment 1
     """
-    # Determine the sizes of sets
-    if len(tokenSet1) < len(tokenSet2):
-        smallerSet = tokenSet1
-        largerSet = tokenSet2
-    else:
-        smallerSet = tokenSet2
-        largerSet = tokenSet1
-    # Memorize initial length of largerSet
-    largerSet_original_length = len(largerSet)
-    # Add all tokens in smallerSet to largerSet
-    for token in smallerSet:
-        largerSet.add(token)
-    return len(smallerSet) + largerSet_original_length - len(largerSet), len(largerSet)
+    # Count shared tokens without modifying either set
+    intersection = len(tokenSet1 & tokenSet2)
+    return intersection, len(tokenSet1) + len(tokenSet2) - intersection
 
 
 def token_simularity(tokenSet1: set, tokenSet2: set) -> float:
@@ -59,21 +57,55 @@ def token_simularity(tokenSet1: set, tokenSet2: set) -> float:
     return intersection / union
 
 
+def get_minhash_permutations(num_perm: int) -> (array, array):
+    """Gets multipliers & offsets of MinHash permutations, the same for every process"""
+    if num_perm not in minhash_permutations:
+        generator = random.Random(minhash_seed)
+        a = array('Q', [generator.randrange(1, 1 << 31) for _ in range(num_perm)])
+        b = array('Q', [generator.randrange(0, 1 << 61) for _ in range(num_perm)])
+        minhash_permutations[num_perm] = (a, b)
+    return minhash_permutations[num_perm]
+
+
+def get_signature(raw_text: [str], num_perm=128, remove_stopwords_in_text=True) -> array:
+    """
+    Gets the MinHash signature of a page from text extracted with get_raw_text, empty if it has no tokens.
+    Cheap to store & compare, computed by indexing workers
+    """
+    current_content = ' '.join(raw_text)
+    # Remove stopwords
+    if remove_stopwords_in_text:
+        current_content = remove_stopwords(current_content)
+    # Tokenize content
+    current_token = tokenizeWithSet(current_content)
+    if len(current_token) == 0:
+        return array('Q')
+    a, b = get_minhash_permutations(num_perm)
+    return minhash_signature(current_token, a, b)
+
+
 class near_duplicate_db:
 
-    def __init__(self, similarity_cutoff=.9, compare_to_past=50, remove_stopwords=True, ban_limit=3, ban_percentage_limit=.05):
+    def __init__(self, similarity_cutoff=.9, num_perm=128, bands=16, remove_stopwords=True, ban_limit=3, ban_percentage_limit=.05):
         """
-        Class for comparing for near duplicates, compares to past web sites with same netloc
+        Class for comparing for near duplicates across all pages, with MinHash signatures & LSH banding.
+        Pages sharing all values of any band are candidates, duplicates when their estimated similarity passes the cutoff
         """
-        self.netlocs = {}
+        if num_perm % bands != 0:
+            raise AttributeError('Signature size {n} not divisible into {b} bands'.format(n=num_perm, b=bands))
         self.similarity_cutoff = similarity_cutoff
-        self.compare_to_past = compare_to_past
+        self.num_perm, self.bands = num_perm, bands
+        self.rows = num_perm // bands
         self.remove_stopwords=remove_stopwords
         self.ban_limit = ban_limit
         self.ban_percentage_limit = ban_percentage_limit
         self.duplicates = {}
         self.banned_paths = set()
         self.visited_paths = {}
+        # Urls & signatures of unique pages, by page id
+        self.urls, self.signatures = [], []
+        # For each band, a table from band values to ids of pages
+        self.buckets = [dict() for _ in range(bands)]
 
     def add_duplicate(self, url: str):
         """
@@ -92,43 +124,42 @@ class near_duplicate_db:
         """
         Checks a new web page against database
         """
-        # Get netloc of new web site
-        netloc = urlparse(url).netloc
         # Process current content
-        current_content = get_raw_text(BeautifulSoup(content, 'html.parser'))
-        current_content = ' '.join(current_content)
-        # Remove stopwords
-        if self.remove_stopwords:
-            current_content = remove_stopwords(current_content)
-        # Tokenize content
-        current_token = tokenizeWithSet(current_content)
+        return self.check_duplicate_text(url, get_raw_text(BeautifulSoup(content, 'html.parser')))
 
+    def check_duplicate_text(self, url: str, raw_text: [str]) -> (bool, str):
+        """
+        Checks a new web page against database, using text already extracted with get_raw_text
+        """
+        return self.check_signature(url, get_signature(raw_text, self.num_perm, self.remove_stopwords))
+
+    def check_signature(self, url: str, signature: array) -> (bool, str):
+        """
+        Checks a new web page against database by its signature, adds it to database if unique
+        """
         # Detect empty file
-        if len(current_token) == 0:
+        if len(signature) == 0:
             self.add_duplicate(url)
             return (True, 'Empty token')
 
-        # Check is netloc in database's key
-        if netloc in self.netlocs.keys():
-            # Limit comparison to last 50
-            if len(self.netlocs[netloc]) > self.compare_to_past:
-                to_compare = self.netlocs[netloc][-self.compare_to_past:]
-            else:
-                to_compare = self.netlocs[netloc]
-
-            # Compare token sets
-            for url_in_db, token_in_db in to_compare:
-                if token_simularity(token_in_db, current_token) > self.similarity_cutoff:
-                    # matched
-                    self.add_duplicate(url)
-                    return True, url_in_db
-
-            # If no match, append to db
-            self.netlocs[netloc].append((url, current_token))
-            # No match
-            return False, None
-
-        # Append current url to db if unseen
-        else:
-            self.netlocs[netloc] = [(url, current_token)]
-            return False, None
+        # Collect earlier pages sharing a band
+        band_keys = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        candidates = set()
+        for band, key in enumerate(band_keys):
+            candidates.update(self.buckets[band].get(key, ()))
+
+        # Compare signatures, oldest page first
+        for candidate in sorted(candidates):
+            if signature_similarity(self.signatures[candidate], signature) > self.similarity_cutoff:
+                # matched
+                self.add_duplicate(url)
+                return True, self.urls[candidate]
+
+        # If no match, append to db
+        page_id = len(self.urls)
+        self.urls.append(url)
+        self.signatures.append(signature)
+        for band, key in enumerate(band_keys):
+            self.buckets[band].setdefault(key, []).append(page_id)
+        # No match
+        return False, None
@@ -0,0 +1,151 @@
+import sys
+import mmap
+import struct
+from array import array
+from atomic_file import atomic_write
+
+# Default location of the url & title store of an index
+page_store_loc = 'page_store.bin'
+
+# File layout, all integers little endian:
+#   header:          magic, serial count, page count, restart interval, url data byte length
+#   block offsets:   ceil(serial count / restart interval) x u64, start of each url block in url data
+#   title offsets:   serial count x u64, start of each title in title data
+#   url data:        per serial, varint shared prefix length with the previous url of its block, varint suffix length, suffix
+#   title data:      per serial, varint byte length + 1 (0 for no title), utf-8 title
+# Urls are front coded in serial order, pages of a host get neighbouring serials so they share long prefixes.
+# Every restart interval urls a block starts with a full url, so a lookup decodes at most one block.
+# A serial without page has an empty url
+header_format = struct.Struct('<4sIIIQ')
+magic = b'ICPS'
+u64 = struct.Struct('<Q')
+default_restart_interval = 16
+
+
+def encode_varint(value: int) -> bytes:
+    """Encodes an unsigned integer in 7 bit groups, low group first"""
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def read_varint(data, position: int) -> (int, int):
+    """Reads a varint at position, returns its value & the position after it"""
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def write_page_store(location: str, urls: dict, titles: dict, serial_count=None, restart_interval=default_restart_interval):
+    """
+    Writes urls & titles by serial to a page store.
+    Serials stay reserved up to serial_count even if their pages are gone
+    """
+    if serial_count is None:
+        serial_count = max(urls.keys()) + 1 if urls else 0
+    block_offsets, title_offsets = array('Q'), array('Q')
+    url_data, title_data = bytearray(), bytearray()
+    previous = b''
+    for serial in range(serial_count):
+        if serial % restart_interval == 0:
+            block_offsets.append(len(url_data))
+            previous = b''
+        url = urls.get(serial, '').encode()
+        # Length of prefix shared with the previous url
+        shared = 0
+        for a, b in zip(previous, url):
+            if a != b:
+                break
+            shared += 1
+        url_data += encode_varint(shared) + encode_varint(len(url) - shared) + url[shared:]
+        previous = url
+        title_offsets.append(len(title_data))
+        title = titles.get(serial)
+        if title is None:
+            title_data += encode_varint(0)
+        else:
+            title = title.encode()
+            title_data += encode_varint(len(title) + 1) + title
+    with atomic_write(location) as f:
+        f.write(header_format.pack(magic, serial_count, len(urls), restart_interval, len(url_data)))
+        for column in (block_offsets, title_offsets):
+            if sys.byteorder == 'big':
+                column.byteswap()
+            f.write(column.tobytes())
+        f.write(url_data)
+        f.write(title_data)
+
+
+class page_store:
+
+    def __init__(self, location=page_store_loc):
+        """A read only, memory mapped table from page serial to url & title, only pages looked up are touched"""
+        self.location = location
+        with open(location, 'rb') as f:
+            # The map stays valid once the file is closed, so a store replaced on disk keeps serving its readers
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, self.serial_count, self.page_count, self.restart_interval, url_bytes = header_format.unpack_from(self.map, 0)
+        if file_magic != magic:
+            raise ValueError('Not a page store: {l}'.format(l=location))
+        # Locate each section
+        block_count = (self.serial_count + self.restart_interval - 1) // self.restart_interval
+        self.block_offsets_base = header_format.size
+        self.title_offsets_base = self.block_offsets_base + 8 * block_count
+        self.urls_base = self.title_offsets_base + 8 * self.serial_count
+        self.titles_base = self.urls_base + url_bytes
+
+    def __len__(self) -> int:
+        return self.page_count
+
+    def __contains__(self, serial: int) -> bool:
+        return self.get_url(serial) is not None
+
+    def get_url(self, serial: int) -> str:
+        """Gets url of a page, None if there is no page with serial"""
+        if not 0 <= serial < self.serial_count:
+            return None
+        block = serial // self.restart_interval
+        position = self.urls_base + u64.unpack_from(self.map, self.block_offsets_base + 8 * block)[0]
+        # Decode urls from the start of the block up to serial
+        url = b''
+        for _ in range(serial - block * self.restart_interval + 1):
+            shared, position = read_varint(self.map, position)
+            length, position = read_varint(self.map, position)
+            url = url[:shared] + self.map[position: position + length]
+            position += length
+        return url.decode() if url else None
+
+    def get_title(self, serial: int) -> str:
+        """Gets title of a page, None if it has none"""
+        if not 0 <= serial < self.serial_count:
+            return None
+        position = self.titles_base + u64.unpack_from(self.map, self.title_offsets_base + 8 * serial)[0]
+        length, position = read_varint(self.map, position)
+        if not length:
+            return None
+        return self.map[position: position + length - 1].decode()
+
+    def items(self):
+        """Iterates over (serial, url, title) of all pages in serial order"""
+        position = self.urls_base
+        url = b''
+        for serial in range(self.serial_count):
+            # Blocks start with a url sharing nothing, so urls decode in a single pass
+            shared, position = read_varint(self.map, position)
+            length, position = read_varint(self.map, position)
+            url = url[:shared] + self.map[position: position + length]
+            position += length
+            if url:
+                yield serial, url.decode(), self.get_title(serial)
+
+    def close(self):
+        """Releases the memory map"""
+        self.map.close()
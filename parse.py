@@ -1,9 +1,18 @@
 from bs4 import BeautifulSoup
 from urllib.parse import urldefrag
 from urllib.parse import urlparse
+import os
 import re
+import ujson
+import hashlib
 
 from pipeline import pipeline
+from atomic_file import atomic_write
+
+# Default BeautifulSoup parser backend, matches the tokens of existing indexes
+html_parser = 'html.parser'
+# Directory of parsed page records, so rebuilding an index skips html parsing
+record_cache_loc = 'record_cache/'
 
 # A list of valid paths
 def get_links(url: str, content: bytes, debug=False) -> [str]:
@@ -146,6 +155,52 @@ def remove_contents(texts: list) -> str:
     return texts
 
 
+def get_html_parser(fast=False) -> str:
+    """Gets the BeautifulSoup parser backend, lxml if fast & installed"""
+    if fast:
+        try:
+            import lxml
+            return 'lxml'
+        except ImportError:
+            print("lxml not installed, using {p}".format(p=html_parser))
+    return html_parser
+
+
+def extract_record(url: str, content: str, parser=html_parser) -> dict:
+    """Parses a page once, extracting every field used for indexing"""
+    soup = BeautifulSoup(content, parser)
+    title = soup.title.text.replace("\n", " ") if soup.title else None
+    return {'url': url, 'title': title, 'raw_text': get_raw_text(soup), 'headings': get_headings(soup),
+            'bold': get_bold(soup), 'title_words': get_title(soup), 'parser': parser}
+
+
+def get_record_cache_path(path: str) -> str:
+    """Gets the location of the cached record of a page file"""
+    return record_cache_loc + hashlib.sha1(path.encode()).hexdigest() + '.json'
+
+
+def load_record(path: str, parser=html_parser) -> dict:
+    """Gets the record of a page file, parsing it only if no up to date record is cached"""
+    stat = os.stat(path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    cache_path = get_record_cache_path(path)
+    # Try cache first
+    if os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            record = ujson.load(f)
+        if record['source'] == source and record['parser'] == parser:
+            return record
+    with open(path) as f:
+        json_content = ujson.load(f)
+    record = extract_record(json_content['url'], json_content['content'], parser)
+    record['source'] = source
+    # Store record
+    os.makedirs(record_cache_loc, exist_ok=True)
+    with atomic_write(cache_path, 'w') as f:
+        ujson.dump(record, f)
+    return record
+
+
 def get_content_extraction_pipeline() -> pipeline:
     """
     Constructs a pipeline for content extraction
@@ -1,10 +1,80 @@
+import math
+import time
+
+# Stage latencies are counted in buckets growing by this ratio, so histograms of workers add up exactly
+latency_bucket_ratio = 2 ** .25
+latency_bucket_log = math.log(latency_bucket_ratio)
+# Latencies reported by stage stats
+reported_percentiles = (50, 90, 99)
+
+
+def get_size(item) -> int:
+    """Counts elements of a list or string passed between stages, other items count as one"""
+    return len(item) if hasattr(item, '__len__') else 1
+
+
+class stage_stats:
+
+    def __init__(self, name: str):
+        """Counters & latency histogram of one pipeline stage"""
+        self.name = name
+        self.calls, self.exceptions, self.total_time = 0, 0, 0.
+        # Total size of items going in & coming out of the stage
+        self.items_in, self.items_out = 0, 0
+        # Latency bucket -> number of calls
+        self.histogram = dict()
+
+    def record(self, elapsed: float, item, result=None, failed=False):
+        """Records one call of the stage"""
+        self.calls += 1
+        self.total_time += elapsed
+        self.items_in += get_size(item)
+        if failed:
+            self.exceptions += 1
+        else:
+            self.items_out += get_size(result)
+        bucket = int(math.log(elapsed * 1e9) / latency_bucket_log) if elapsed > 1e-9 else 0
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """Adds counters of another stats object of the same stage"""
+        self.calls += other.calls
+        self.exceptions += other.exceptions
+        self.total_time += other.total_time
+        self.items_in += other.items_in
+        self.items_out += other.items_out
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def percentile(self, q: float) -> float:
+        """Gets the latency in seconds below which q percent of calls finished, upper bound of its bucket"""
+        if not self.calls:
+            return 0.
+        rank, seen = q / 100 * self.calls, 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return latency_bucket_ratio ** (bucket + 1) / 1e9
+        return latency_bucket_ratio ** (max(self.histogram) + 1) / 1e9
+
+    def to_json(self) -> dict:
+        """Gets counters & latency percentiles of the stage"""
+        result = {'stage': self.name, 'calls': self.calls, 'exceptions': self.exceptions, 'total_time': self.total_time,
+                  'items_in': self.items_in, 'items_out': self.items_out}
+        for q in reported_percentiles:
+            result['p{q}'.format(q=q)] = self.percentile(q)
+        return result
+
+
 class pipeline:
 
-    def __init__(self, name: str, process: [], error_behavior=[], vb=True, protected=True, allow_crash_on_unanticipated=True, error_return_object=None):
-        """Creating a pipeline for easy processing of data"""
+    def __init__(self, name: str, process: [], error_behavior=[], vb=True, protected=True, allow_crash_on_unanticipated=True, error_return_object=None, instrument=False):
+        """Creating a pipeline for easy processing of data, instrument records per stage stats"""
         self.name, self.process = name, process
         self.vb, self.allow_crash_on_unanticipated = vb, allow_crash_on_unanticipated
         self.vars = dict()
+        # Per stage stats, None when not instrumented
+        self.stats = [stage_stats(func.__name__) for func in process] if instrument else None
         # Error handling disables
         if len(error_behavior) == 0 or not protected:
             self.error_handling = False
@@ -24,53 +94,169 @@ class pipeline:
         """Imports variable to pipeline"""
         self.vars.update(vars)
 
+    def run_stage(self, step_index: int, func, item):
+        """Runs a stage on an item, recording its stats"""
+        a = time.perf_counter()
+        try:
+            result = func(item)
+        except Exception:
+            self.stats[step_index].record(time.perf_counter() - a, item, failed=True)
+            raise
+        self.stats[step_index].record(time.perf_counter() - a, item, result)
+        return result
+
+    def take_stats(self) -> [stage_stats]:
+        """Gets stats recorded so far & starts counting from zero, so pool workers can hand them to the parent"""
+        stats = self.stats
+        if stats is not None:
+            self.stats = [stage_stats(func.__name__) for func in self.process]
+        return stats
+
+    def merge_stats(self, stats: [stage_stats]):
+        """Adds stats recorded by another copy of the pipeline"""
+        if self.stats is None or stats is None:
+            return
+        for own, other in zip(self.stats, stats):
+            own.merge(other)
+
+    def format_stats(self) -> str:
+        """Gets a per stage breakdown of recorded stats"""
+        if self.stats is None:
+            return "Pipeline {name} is not instrumented".format(name=self.name)
+        total_time = sum(stats.total_time for stats in self.stats) or 1
+        lines = ["Pipeline {name} stages:".format(name=self.name)]
+        for step_index, stats in enumerate(self.stats):
+            lines.append("Stage #{stg} {op}: {t:.3f}s ({pct:.1f}%), calls: {c}, exceptions: {e}, items in/out: {i}/{o}, "
+                         "p50/p90/p99: {p50:.1f}/{p90:.1f}/{p99:.1f}us".format(
+                             stg=step_index, op=stats.name, t=stats.total_time, pct=100 * stats.total_time / total_time,
+                             c=stats.calls, e=stats.exceptions, i=stats.items_in, o=stats.items_out,
+                             p50=stats.percentile(50) * 1e6, p90=stats.percentile(90) * 1e6, p99=stats.percentile(99) * 1e6))
+        return '\n'.join(lines)
+
+    def handle_exception(self, step_index: int, func, e: Exception):
+        """Handles an exception raised by a stage according to its error behavior, re-raises it if not handled"""
+        # Fetch error handling instruction
+        error_handling_instr = self.error_behavior[step_index]
+        # Print message
+        if self.vb:
+            print("Pipeline {name} encountered exception at stage [{stg}] : {e} {args}".format(stg=func.__name__, name=self.name, e=type(e).__name__, args=e.args[0]), end='')
+        # Handle all error types
+        if error_handling_instr == 'all':
+            if self.vb:
+                print(" Result: handled according to instruction: all")
+        # Handle partial error types
+        elif type(error_handling_instr) == list:
+            # If error is instructed to skip
+            if type(e) in error_handling_instr:
+                print(" Result: handled according to instruction to handle type: {e_type}".format(e_type=type(e)))
+            # If not allowed to crash on unanticipated errors
+            elif not self.allow_crash_on_unanticipated:
+                print(" Result: handled due to not allowing crash on unanticipated")
+            # If allows for crash, stop operation
+            else:
+                print(" Result: Crashing due to unprotected type {e_type}".format(e_type=type(e)))
+                raise e
+        # No handling instruction
+        elif error_handling_instr == None:
+            if self.allow_crash_on_unanticipated:
+                print(" Result: Crashing due to no protection strategy")
+                raise e
+            else:
+                print(" Result: handled due to not allowing crash on unanticipated")
+        # Invalid input
+        else:
+            if self.allow_crash_on_unanticipated:
+                raise AttributeError("Invalid error handling instruction: {instr}".format(instr=error_handling_instr))
+            else:
+                print(" Result: Invalid error handling instruction: {instr}, Please fix immediately!".format(instr=error_handling_instr))
+
     def process_item(self, item, dev_mode=False):
         """Passes an item through constructed pipeline"""
+        stats = self.stats
         for step_index, func in enumerate(self.process):
             if self.error_handling:
                 # Run with protection
                 try:
-                    item = func(item)
+                    item = func(item) if stats is None else self.run_stage(step_index, func, item)
                 except Exception as e:
-                    # Fetch error handling instruction
-                    error_handling_instr = self.error_behavior[step_index]
-                    # Print message
-                    if self.vb:
-                        print("Pipeline {name} encountered exception at stage [{stg}] : {e} {args}".format(stg=func.__name__, name=self.name, e=type(e).__name__, args=e.args[0]), end='')
-                    # Handle all error types
-                    if error_handling_instr == 'all':
-                        if self.vb:
-                            print(" Result: handled according to instruction: all")
-                    # Handle partial error types
-                    elif type(error_handling_instr) == list:
-                        # If error is instructed to skip
-                        if type(e) in error_handling_instr:
-                            print(" Result: handled according to instruction to handle type: {e_type}".format(e_type=type(e)))
-                        # If not allowed to crash on unanticipated errors
-                        elif not self.allow_crash_on_unanticipated:
-                            print(" Result: handled due to not allowing crash on unanticipated")
-                        # If allows for crash, stop operation
-                        else:
-                            print(" Result: Crashing due to unprotected type {e_type}".format(e_type=type(e)))
-                            raise e
-                    # No handling instruction
-                    elif error_handling_instr == None:
-                        if self.allow_crash_on_unanticipated:
-                            print(" Result: Crashing due to no protection strategy")
-                            raise e
-                        else:
-                            print(" Result: handled due to not allowing crash on unanticipated")
-                    # Invalid input
-                    else:
-                        if self.allow_crash_on_unanticipated:
-                            raise AttributeError("Invalid error handling instruction: {instr}".format(instr=error_handling_instr))
-                        else:
-                            print(" Result: Invalid error handling instruction: {instr}, Please fix immediately!".format(instr=error_handling_instr))
+                    self.handle_exception(step_index, func, e)
                     # Return default item
                     return self.error_return_object
             else:
                 # Run in regular mode
-                item = func(item)
+                item = func(item) if stats is None else self.run_stage(step_index, func, item)
             if dev_mode:
                 print("Stage #{stg} Operation: {op} Result:\n{result}".format(stg=step_index, op=func.__name__, result=item))
-        return item
\ No newline at end of file
+        return item
+
+    def process_batch(self, items, dev_mode=False) -> []:
+        """
+        Passes a batch of items through constructed pipeline one stage at a time, results are in the order of items.
+        Error handling is the same as process_item, an item failing at a stage results in the error return object
+        """
+        items = list(items)
+        item_count = len(items)
+        stats = self.stats
+        # Positions of items still passing through the pipeline
+        positions = range(item_count)
+        for step_index, func in enumerate(self.process):
+            if self.error_handling:
+                # Run with protection, dropping failed items from later stages
+                next_positions, next_items = [], []
+                for position, item in zip(positions, items):
+                    try:
+                        next_items.append(func(item) if stats is None else self.run_stage(step_index, func, item))
+                        next_positions.append(position)
+                    except Exception as e:
+                        self.handle_exception(step_index, func, e)
+                positions, items = next_positions, next_items
+            else:
+                # Run in regular mode
+                if stats is None:
+                    items = [func(item) for item in items]
+                else:
+                    items = [self.run_stage(step_index, func, item) for item in items]
+            if dev_mode:
+                print("Stage #{stg} Operation: {op} Result:\n{result}".format(stg=step_index, op=func.__name__, result=items))
+        if not self.error_handling:
+            return items
+        # Fill in default item for failed items
+        results = [self.error_return_object] * item_count
+        for position, item in zip(positions, items):
+            results[position] = item
+        return results
+
+    def process_batch_with_stats(self, items) -> ([], [stage_stats]):
+        """Passes a batch through a copy of the pipeline in a pool worker, returning results & stats of the batch alone"""
+        self.take_stats()
+        return self.process_batch(items), self.take_stats()
+
+    def process_stream(self, items, batch_size=256, pool=None):
+        """
+        Passes an iterable of items through constructed pipeline in batches, yielding results in order.
+        Batches are spread across the workers of pool if given
+        """
+        batches = iter_batches(items, batch_size)
+        if pool is None:
+            for batch in batches:
+                yield from self.process_batch(batch)
+        elif self.stats is None:
+            for results in pool.imap(self.process_batch, batches):
+                yield from results
+        else:
+            # Collect stats recorded by workers
+            for results, stats in pool.imap(self.process_batch_with_stats, batches):
+                self.merge_stats(stats)
+                yield from results
+
+
+def iter_batches(items, batch_size: int):
+    """Splits an iterable into lists of at most batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
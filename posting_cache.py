@@ -0,0 +1,112 @@
+from collections import OrderedDict
+
+# Seeds of the hash rows in the frequency sketch
+sketch_seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+# Counters saturate at this value, like the 4 bit counters of TinyLFU
+max_frequency = 15
+
+
+class frequency_sketch:
+
+    def __init__(self, width=1 << 16, sample_factor=10):
+        """A count-min sketch estimating how often terms were requested, halved periodically so it ages"""
+        self.width = width
+        self.rows = [bytearray(width) for _ in sketch_seeds]
+        # Age all counters after this many increments
+        self.sample_size = sample_factor * width
+        self.additions = 0
+
+    def increment(self, key):
+        """Records one request of key"""
+        for seed, row in zip(sketch_seeds, self.rows):
+            index = hash((seed, key)) % self.width
+            if row[index] < max_frequency:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def frequency(self, key) -> int:
+        """Estimates how often key was requested recently"""
+        return min(row[hash((seed, key)) % self.width] for seed, row in zip(sketch_seeds, self.rows))
+
+    def reset(self):
+        """Halves all counters"""
+        for i, row in enumerate(self.rows):
+            self.rows[i] = bytearray(count >> 1 for count in row)
+        self.additions //= 2
+
+
+class posting_cache:
+
+    def __init__(self, byte_budget=64 * 1024 * 1024, policy='tinylfu'):
+        """
+        A cache of decoded postings bounded by an approximate byte budget.
+        Policy 'lru' admits everything & evicts the least recently used posting,
+        policy 'tinylfu' only admits a posting when it was requested more often than the postings it would evict
+        """
+        if policy not in ('lru', 'tinylfu'):
+            raise AttributeError('Invalid cache policy: {p}'.format(p=policy))
+        self.byte_budget, self.policy = byte_budget, policy
+        # Term -> (posting, size in bytes), least recently used first
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.sketch = frequency_sketch() if policy == 'tinylfu' else None
+        self.hits, self.misses, self.admissions, self.rejections, self.evictions = 0, 0, 0, 0, 0
+
+    def record_request(self, key):
+        """Counts a request of key towards admission without looking it up"""
+        if self.sketch:
+            self.sketch.increment(key)
+
+    def get(self, key):
+        """Gets a cached posting, None if not cached"""
+        self.record_request(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, posting, size: int):
+        """Offers a posting to the cache, evicting other postings if admitted"""
+        if size > self.byte_budget or key in self.entries:
+            return
+        # Collect least recently used postings that would have to make room
+        victims, freed = [], 0
+        for victim_key, (_, victim_size) in self.entries.items():
+            if self.bytes_used - freed + size <= self.byte_budget:
+                break
+            victims.append(victim_key)
+            freed += victim_size
+        # Only replace postings that were requested less often
+        if victims and self.sketch:
+            frequency = self.sketch.frequency(key)
+            if any(self.sketch.frequency(victim_key) >= frequency for victim_key in victims):
+                self.rejections += 1
+                return
+        for victim_key in victims:
+            self.bytes_used -= self.entries.pop(victim_key)[1]
+            self.evictions += 1
+        self.entries[key] = (posting, size)
+        self.bytes_used += size
+        self.admissions += 1
+
+    def clear(self):
+        """Drops all cached postings, request frequencies are kept"""
+        self.entries.clear()
+        self.bytes_used = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        """Gets counters of the cache"""
+        return {'policy': self.policy, 'hits': self.hits, 'misses': self.misses, 'admissions': self.admissions,
+                'rejections': self.rejections, 'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes_used': self.bytes_used, 'byte_budget': self.byte_budget}
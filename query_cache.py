@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+# Rough size of an entry besides its serials, for dict slot, tuple and array headers
+entry_overhead = 256
+
+
+class query_result_cache:
+
+    def __init__(self, byte_budget=32 * 1024 * 1024):
+        """A LRU cache of ranked page serials keyed on tokenized queries, bounded by an approximate byte budget"""
+        self.byte_budget = byte_budget
+        # Query tokens -> (ranked serials, total result count, size in bytes), least recently used first
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        # Index generation the cached rankings were computed on
+        self.generation = None
+        self.hits, self.misses, self.evictions, self.invalidations = 0, 0, 0, 0
+        # Guards entries when searches run on several threads
+        self.lock = threading.Lock()
+
+    def check_generation(self, generation: int):
+        """Drops all entries once the index changed"""
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes_used = 0
+            self.generation = generation
+
+    def get(self, key: tuple, generation: int):
+        """Gets (ranked serials, total result count) of a query, None if not cached"""
+        with self.lock:
+            self.check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: tuple, generation: int, ranked, total: int):
+        """Stores ranked serials of a query, evicting least recently used queries to stay in budget"""
+        size = ranked.itemsize * len(ranked) + sum(len(token) for token in key) + entry_overhead
+        # Never let a single query take over the cache
+        if size > self.byte_budget:
+            return
+        with self.lock:
+            self.check_generation(generation)
+            if key in self.entries:
+                self.bytes_used -= self.entries.pop(key)[2]
+            self.entries[key] = (ranked, total, size)
+            self.bytes_used += size
+            while self.bytes_used > self.byte_budget:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """Gets counters of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self.entries),
+                'bytes_used': self.bytes_used, 'byte_budget': self.byte_budget}
@@ -0,0 +1,101 @@
+import os
+import heapq
+import itertools
+import threading
+from term_dictionary import term_dictionary, write_term_dictionary
+
+# File locations of a segment, formatted with the segment name
+segment_index_loc = '{name}_index.bin'
+segment_dictionary_loc = '{name}_dictionary.bin'
+
+
+# Serializes seek & read where positional reads are not available
+seek_lock = threading.Lock()
+
+
+def read_at(file, offset: int, length: int) -> bytes:
+    """Reads bytes at a position of a file without moving its position, so concurrent readers can share it"""
+    if hasattr(os, 'pread'):
+        return os.pread(file.fileno(), length, offset)
+    with seek_lock:
+        file.seek(offset)
+        return file.read(length)
+
+
+def tag_source(source, source_index: int):
+    """Tags (term, encoded posting, document frequency) records with the position of their source"""
+    for key, data, df in source:
+        yield key, source_index, data, df
+
+
+def write_merged_index(sources: [], index_location: str, dictionary_location: str, combine):
+    """
+    Merges sorted (term, encoded posting, document frequency) sources in a single streaming k-way merge.
+    combine gets a term & its [(source index, encoded posting, document frequency)] in source order,
+    and returns (encoded posting, document frequency), or None to drop the term
+    """
+    merged_stream = heapq.merge(*[tag_source(source, i) for i, source in enumerate(sources)])
+    # Create columns of new reference table from term to location
+    new_terms, new_offsets, new_lengths, new_dfs = [], [], [], []
+    # Index for keeping write locations
+    merged_write_index = 0
+    with open(index_location, 'wb') as merged:
+        # Only postings of the current term are held in memory
+        current_key, current_items = None, []
+        for key, source_index, data, df in itertools.chain(merged_stream, [(None, 0, None, 0)]):
+            if key == current_key:
+                current_items.append((source_index, data, df))
+                continue
+            if current_key is not None:
+                combined = combine(current_key, current_items)
+                if combined is not None:
+                    item, write_df = combined
+                    # Write information
+                    merged.write(item)
+                    new_terms.append(current_key)
+                    new_offsets.append(merged_write_index)
+                    new_lengths.append(len(item))
+                    new_dfs.append(write_df)
+                    merged_write_index += len(item)
+            current_key, current_items = key, [(source_index, data, df)]
+    write_term_dictionary(dictionary_location, new_terms, new_offsets, new_lengths, new_dfs)
+
+
+class index_segment:
+
+    def __init__(self, name: str, doc_count: int, location=''):
+        """An immutable part of the index holding raw term weights of recently added pages, kept in the location directory"""
+        self.name, self.doc_count = name, doc_count
+        self.index_location = os.path.join(location, segment_index_loc.format(name=name))
+        self.dictionary_location = os.path.join(location, segment_dictionary_loc.format(name=name))
+        self.index = open(self.index_location, 'rb')
+        self.dictionary = term_dictionary(self.dictionary_location)
+
+    def get(self, term: str) -> (bytes, int):
+        """Gets encoded posting & document frequency of term, None if not in segment"""
+        entry = self.dictionary.get(term)
+        if entry is None:
+            return None
+        return read_at(self.index, entry[0], entry[1]), entry[2]
+
+    def items(self):
+        """Iterates over (term, encoded posting, document frequency) in ascending order, with a file handle of its own"""
+        with open(self.index_location, 'rb') as f:
+            for key, offset, length, df in self.dictionary.items():
+                f.seek(offset)
+                yield key, f.read(length), df
+
+    def close(self):
+        """Closes files of the segment"""
+        self.index.close()
+        self.dictionary.close()
+
+    def remove(self):
+        """Closes & deletes files of the segment"""
+        self.close()
+        os.remove(self.index_location)
+        os.remove(self.dictionary_location)
+
+    def to_json(self) -> dict:
+        """Gets the description of the segment stored in index agent configuration"""
+        return {'name': self.name, 'doc_count': self.doc_count}
@@ -0,0 +1,259 @@
+import os
+import time
+import asyncio
+import argparse
+import ujson
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from main import index_agent, make_query_tokenizing_pipeline, vector_space_search, stems
+from query_cache import query_result_cache
+
+# Default address of the search server
+server_host = '127.0.0.1'
+server_port = 8080
+# Results per page unless requested otherwise, & the most a request may ask for
+default_page_size = 10
+max_page_size = 100
+# Longest query accepted, in characters
+max_query_length = 512
+# Reason phrases of the status codes the server answers with
+status_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+# Search state of a worker, set by init_search_worker
+worker_agent = None
+worker_tokenize_ppl = None
+worker_result_cache = None
+
+
+def init_search_worker():
+    """Loads the index once per worker, thread workers share the state loaded by the first call"""
+    global worker_agent, worker_tokenize_ppl, worker_result_cache
+    if worker_agent is not None:
+        return
+    stems.load()
+    worker_tokenize_ppl = make_query_tokenizing_pipeline()
+    worker_result_cache = query_result_cache()
+    worker_agent = index_agent(read_only=True)
+
+
+def search_page(query: str, page: int, page_size: int) -> dict:
+    """Searches a query in a worker, returns one page of results with their titles"""
+    a = time.perf_counter()
+    # Only rank as deep as the requested page
+    results = vector_space_search(worker_agent, query, worker_tokenize_ppl, page * page_size, worker_result_cache)
+    serials = list(results[(page - 1) * page_size: page * page_size]) if results else []
+    return {'query': query, 'page': page, 'page_size': page_size, 'total': len(results) if results else 0,
+            'results': [{'url': url, 'title': worker_agent.get_page_title(serial)} for serial, url in zip(serials, worker_agent.get_urls(serials))],
+            'time_ms': 1000 * (time.perf_counter() - a)}
+
+
+class request_error(Exception):
+
+    def __init__(self, status: int, message: str):
+        """An error answered to the client with given http status"""
+        super().__init__(message)
+        self.status = status
+
+
+class search_server:
+
+    def __init__(self, host=server_host, port=server_port, workers=None, use_threads=False, max_inflight=None,
+                 max_queued=256, max_connections=1024, request_timeout=30., search_timeout=10.):
+        """
+        An asyncio http server answering GET /search?q=...&page=1&size=10 with json, ranking runs in a pool of workers.
+        At most max_inflight searches run at once & max_queued wait, later requests are answered with 503
+        """
+        self.host, self.port = host, port
+        self.workers = workers or os.cpu_count() or 1
+        self.use_threads = use_threads
+        self.max_inflight = max_inflight or 2 * self.workers
+        self.max_queued, self.max_connections = max_queued, max_connections
+        self.request_timeout, self.search_timeout = request_timeout, search_timeout
+        self.executor, self.server, self.slots = None, None, None
+        self.connections, self.queued = 0, 0
+        self.requests, self.searches, self.rejected, self.errors = 0, 0, 0, 0
+
+    async def start(self):
+        """Starts the worker pool & listens for connections"""
+        if self.use_threads:
+            # Threads share one index agent, posting reads are positional so they do not interfere
+            init_search_worker()
+            self.executor = ThreadPoolExecutor(self.workers)
+        else:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_search_worker)
+        self.slots = asyncio.Semaphore(self.max_inflight)
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print("Search server listening on http://{h}:{p} with {w} {k}".format(
+            h=self.host, p=self.port, w=self.workers, k='threads' if self.use_threads else 'processes'))
+
+    async def serve_forever(self):
+        """Starts & serves until cancelled"""
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops listening & shuts the worker pool down"""
+        if self.server:
+            self.server.close()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answers requests of a connection until the client closes it or asks to"""
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                self.rejected += 1
+                await self.respond(writer, 503, {'error': 'Too many connections'}, False)
+                return
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.request_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except request_error as e:
+                    await self.respond(writer, e.status, {'error': str(e)}, False)
+                    return
+                if request is None:
+                    return
+                method, target, keep_alive = request
+                status, body = await self.handle_request(method, target)
+                await self.respond(writer, status, body, keep_alive)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader) -> (str, str, bool):
+        """Reads request line & headers, returns (method, target, keep alive), None once the client closed"""
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise request_error(400, 'Malformed request line')
+        method, target, version = parts
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        # Discard request body
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise request_error(400, 'Invalid Content-Length')
+        if length:
+            await reader.readexactly(length)
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        return method, target, keep_alive
+
+    async def handle_request(self, method: str, target: str) -> (int, dict):
+        """Routes a request, returns http status & json body"""
+        self.requests += 1
+        if method != 'GET':
+            return 405, {'error': 'Only GET is supported'}
+        url = urlsplit(target)
+        if url.path == '/search':
+            try:
+                return 200, await self.search(parse_qs(url.query))
+            except request_error as e:
+                return e.status, {'error': str(e)}
+            except Exception as e:
+                self.errors += 1
+                return 500, {'error': type(e).__name__}
+        if url.path == '/stats':
+            return 200, self.stats()
+        return 404, {'error': 'Unknown path {p}'.format(p=url.path)}
+
+    async def search(self, arguments: dict) -> dict:
+        """Validates search arguments & ranks in the worker pool, queueing for a free slot"""
+        query = arguments.get('q', [''])[0].strip()
+        if not query:
+            raise request_error(400, 'Missing query parameter q')
+        if len(query) > max_query_length:
+            raise request_error(400, 'Query longer than {n} characters'.format(n=max_query_length))
+        try:
+            page = int(arguments.get('page', ['1'])[0])
+            page_size = int(arguments.get('size', [str(default_page_size)])[0])
+        except ValueError:
+            raise request_error(400, 'page & size must be integers')
+        if page < 1 or not 1 <= page_size <= max_page_size:
+            raise request_error(400, 'page must be positive & size between 1 & {n}'.format(n=max_page_size))
+        # Shed load once the queue is full instead of letting latency grow without bound
+        if self.slots.locked() and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise request_error(503, 'Server busy')
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, search_page, query, page, page_size)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the job ends, a search that timed out still occupies a worker
+        future.add_done_callback(self.finish_search)
+        try:
+            # Shielded so timing out does not cancel the future & release the slot of a running job
+            result = await asyncio.wait_for(asyncio.shield(future), self.search_timeout)
+        except asyncio.TimeoutError:
+            raise request_error(504, 'Search timed out')
+        self.searches += 1
+        return result
+
+    def finish_search(self, future: asyncio.Future):
+        """Frees the slot of a search once its job ended"""
+        self.slots.release()
+        # Errors of jobs nobody waits for anymore are dropped
+        if not future.cancelled():
+            future.exception()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, body: dict, keep_alive: bool):
+        """Writes a json response"""
+        data = ujson.dumps(body).encode()
+        head = 'HTTP/1.1 {s} {r}\r\nContent-Type: application/json\r\nContent-Length: {n}\r\nConnection: {c}\r\n\r\n'.format(
+            s=status, r=status_reasons[status], n=len(data), c='keep-alive' if keep_alive else 'close')
+        writer.write(head.encode() + data)
+        await writer.drain()
+
+    def stats(self) -> dict:
+        """Gets counters of the server"""
+        return {'requests': self.requests, 'searches': self.searches, 'rejected': self.rejected, 'errors': self.errors,
+                'connections': self.connections, 'queued': self.queued, 'workers': self.workers,
+                'max_inflight': self.max_inflight, 'max_queued': self.max_queued}
+
+
+def run_server(host=server_host, port=server_port, workers=None, use_threads=False, max_inflight=None, max_queued=256):
+    """Serves searches until interrupted"""
+    server = search_server(host, port, workers, use_threads, max_inflight, max_queued)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("Search server stopped: {s}".format(s=server.stats()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves json searches over the index in the current directory')
+    parser.add_argument('--host', default=server_host)
+    parser.add_argument('--port', type=int, default=server_port)
+    parser.add_argument('--workers', type=int, default=None, help='ranking workers, all cores by default')
+    parser.add_argument('--threads', action='store_true', help='rank on threads sharing one index instead of processes')
+    parser.add_argument('--max-inflight', type=int, default=None, help='searches running at once, twice the workers by default')
+    parser.add_argument('--max-queued', type=int, default=256, help='searches waiting for a slot before answering 503')
+    args = parser.parse_args()
+    run_server(args.host, args.port, args.workers, args.threads, args.max_inflight, args.max_queued)
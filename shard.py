@@ -0,0 +1,233 @@
+import time
+import heapq
+import argparse
+import itertools
+import threading
+import ujson
+from array import array
+from multiprocessing import Process, Pipe
+from main import index_agent, make_query_tokenizing_pipeline, multicore_indexer, get_all_paths, selected_stopwords, stems
+from parse import get_html_parser
+from term_dictionary import term_dictionary, write_term_dictionary
+from cython_defs import vector_space_ranking_hybrid, frozen_results
+
+# Directory of each shard, holding a complete index of its pages
+shard_loc = 'shard_{i}'
+# Shard count & page count of all shards
+shard_config_loc = 'shards.json'
+# Document frequencies of terms across all shards, a term dictionary without postings
+global_dictionary_loc = 'shard_dictionary.bin'
+
+
+def get_shard(serial: int, shard_count: int) -> int:
+    """Gets the shard a page belongs to, pages are dealt round robin so hosts are spread over shards"""
+    return serial % shard_count
+
+
+def write_global_dictionary(dictionaries: [term_dictionary], location: str):
+    """Writes document frequencies summed over the term dictionaries of all shards"""
+    terms, dfs = [], []
+    for term, entries in itertools.groupby(heapq.merge(*[dictionary.items() for dictionary in dictionaries]), key=lambda entry: entry[0]):
+        terms.append(term)
+        dfs.append(sum(entry[3] for entry in entries))
+    write_term_dictionary(location, terms, [0] * len(terms), [0] * len(terms), dfs)
+
+
+def init_sharded_index(shard_count=4, fast_parser=False, process_count=None) -> dict:
+    """
+    Builds a document partitioned index of shard_count shards, each with its own dictionary & postings.
+    Shards are scored with idf from page counts & document frequencies of all shards, returns seconds spent in each phase
+    """
+    parser = get_html_parser(fast_parser)
+    timings = dict()
+    a = time.time()
+    # Serials are assigned over all pages, so they stay unique across shards
+    all_paths, page_serial, inverse_page_serial, page_titles = get_all_paths(process_count, parser=parser)
+    timings['parse'] = time.time() - a
+    b = time.time()
+    agents = []
+    for position in range(shard_count):
+        print("Indexing shard {p} of {c}".format(p=position + 1, c=shard_count))
+        agent = index_agent(init=True, location=shard_loc.format(i=position))
+        paths = [path for path in all_paths if get_shard(inverse_page_serial[path], shard_count) == position]
+        multicore_indexer(agent, paths, {serial: url for serial, url in page_serial.items() if get_shard(serial, shard_count) == position},
+                          inverse_page_serial, process_count, parser=parser, instrument=False)
+        agents.append(agent)
+    timings['index'] = time.time() - b
+    b = time.time()
+    # Combine shard statistics, raw weights hold every page of a term
+    write_global_dictionary([agent.weight_table_index for agent in agents], global_dictionary_loc)
+    doc_count = sum(agent.live_doc_count() for agent in agents)
+    dfs = term_dictionary(global_dictionary_loc)
+    for position, agent in enumerate(agents):
+        agent.add_page_titles({serial: title for serial, title in page_titles.items() if get_shard(serial, shard_count) == position})
+        agent.set_shard(position, shard_count)
+        agent.construct_tf_idf(doc_count, dfs)
+    dfs.close()
+    with open(shard_config_loc, 'w') as f:
+        ujson.dump({'shard_count': shard_count, 'doc_count': doc_count}, f)
+    timings['tf_idf'] = time.time() - b
+    timings['total'] = time.time() - a
+    print("Time used: " + str(timings['total']))
+    return timings
+
+
+def rank_shard(agent: index_agent, terms: [str], dfs: [int], doc_count: int, k: int) -> (array, array, int):
+    """
+    Ranks the pages of a shard containing all terms with document frequencies & page count of all shards,
+    returns serials & scores of its k best pages & its result count
+    """
+    postings = []
+    for term in terms:
+        posting = agent.get_posting(term)
+        if not posting:
+            # No page of the shard contains all terms
+            return array('i'), array('d'), 0
+        postings.append(posting)
+    x = vector_space_ranking_hybrid(postings, doc_count, k, dfs, agent.get_multipliers())
+    return x.snapshot(), x.ranked_scores, len(x)
+
+
+def get_shard_pages(agent: index_agent, serials: [int]) -> [(str, str)]:
+    """Gets urls & titles of pages of a shard"""
+    return [(url, agent.get_page_title(serial)) for serial, url in zip(serials, agent.get_urls(serials))]
+
+
+# Requests answered by shards
+shard_requests = {'rank': rank_shard, 'pages': get_shard_pages}
+
+
+def answer_request(agent: index_agent, kind: str, args: tuple) -> (bool, object):
+    """Answers a request to a shard, returns whether it succeeded & its result or exception"""
+    try:
+        return True, shard_requests[kind](agent, *args)
+    except Exception as e:
+        return False, e
+
+
+def serve_shard(connection, location: str):
+    """Answers requests of the coordinator for one shard until it sends None, run in a process of its own"""
+    agent = index_agent(read_only=True, location=location)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        connection.send(answer_request(agent, *request))
+    connection.close()
+
+
+class shard_coordinator:
+
+    def __init__(self, use_processes=True):
+        """
+        Fans queries out to all shards & merges their partial rankings.
+        Each shard is served by a process of its own, or queried in turn by the calling thread without use_processes
+        """
+        with open(shard_config_loc) as f:
+            config = ujson.load(f)
+        self.shard_count, self.doc_count = config['shard_count'], config['doc_count']
+        # Global statistics, so every shard computes the scores a single index would
+        self.dfs = term_dictionary(global_dictionary_loc)
+        self.use_processes = use_processes
+        # Requests of concurrent callers are not interleaved on the pipes
+        self.lock = threading.Lock()
+        self.agents, self.connections, self.processes = [], [], []
+        for position in range(self.shard_count):
+            if use_processes:
+                connection, child_connection = Pipe()
+                process = Process(target=serve_shard, args=(child_connection, shard_loc.format(i=position)), daemon=True)
+                process.start()
+                self.connections.append(connection)
+                self.processes.append(process)
+            else:
+                self.agents.append(index_agent(read_only=True, location=shard_loc.format(i=position)))
+
+    def scatter(self, requests: [(int, str, tuple)]) -> []:
+        """Sends (shard, kind, args) requests to their shards at once & gathers results in request order"""
+        if not self.use_processes:
+            responses = [answer_request(self.agents[position], kind, args) for position, kind, args in requests]
+        else:
+            with self.lock:
+                # Shards work on their requests in parallel
+                for position, kind, args in requests:
+                    self.connections[position].send((kind, args))
+                responses = [self.connections[position].recv() for position, _, _ in requests]
+        for succeeded, result in responses:
+            if not succeeded:
+                raise result
+        return [result for _, result in responses]
+
+    def select_terms(self, query: [str]) -> ([str], [int]):
+        """Gets the terms of a tokenized query ranked & their document frequencies, like vector_space_rank on a single index"""
+        # Remove selected stopwords, terms no shard contains are ignored
+        terms = [(i, self.dfs.get(i)) for i in query if i not in selected_stopwords]
+        terms = [(term, entry[2]) for term, entry in terms if entry]
+        if not terms:
+            # Try including stopwords
+            terms = [(i, self.dfs.get(i)) for i in query if i in selected_stopwords]
+            terms = [(term, entry[2]) for term, entry in terms if entry]
+        return [term for term, _ in terms], [df for _, df in terms]
+
+    def rank(self, query: [str], k=10) -> [int]:
+        """Ranks pages of all shards for a tokenized query, the k best results are ranked up front"""
+        terms, dfs = self.select_terms(query)
+        # Return None if all postings are empty
+        if not terms:
+            return None
+        responses = self.scatter([(position, 'rank', (terms, dfs, self.doc_count, k)) for position in range(self.shard_count)])
+        # Shard rankings are in ranked order, higher score first & lower serial on ties
+        merged = heapq.merge(*[[(-score, serial) for serial, score in zip(serials, scores)] for serials, scores, _ in responses])
+        ranked = array('i', [serial for _, serial in itertools.islice(merged, k)])
+        # Ranking deeper asks every shard for more pages
+        return frozen_results(ranked, sum(total for _, _, total in responses), lambda depth: self.rank(query, depth))
+
+    def search(self, user_input: str, query_tokenizing_ppl, k=10) -> [int]:
+        """Performs a vector space search with user query over all shards, the k best results are ranked up front"""
+        return self.rank(query_tokenizing_ppl.process_item(user_input.split(' ')), k)
+
+    def get_pages(self, serials: [int]) -> [(str, str)]:
+        """Gets urls & titles of pages, asking each shard for its pages"""
+        by_shard = dict()
+        for serial in serials:
+            by_shard.setdefault(get_shard(serial, self.shard_count), []).append(serial)
+        positions = list(by_shard.keys())
+        pages = dict()
+        for position, result in zip(positions, self.scatter([(position, 'pages', (by_shard[position],)) for position in positions])):
+            pages.update(zip(by_shard[position], result))
+        return [pages[serial] for serial in serials]
+
+    def get_urls(self, serials: [int]) -> [str]:
+        """Get urls of pages"""
+        return [url for url, _ in self.get_pages(serials)]
+
+    def close(self):
+        """Stops shard processes"""
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+        self.dfs.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds or searches a document partitioned index in the current directory')
+    parser.add_argument('--build', type=int, metavar='SHARDS', help='build an index of this many shards from DEV/')
+    parser.add_argument('--fast-parser', action='store_true', help='parse pages with the fast html parser')
+    parser.add_argument('queries', nargs='*', help='queries to search, printing the 10 best urls of each')
+    args = parser.parse_args()
+    if args.build:
+        init_sharded_index(args.build, args.fast_parser)
+    if args.queries:
+        stems.load()
+        query_tokenizing_ppl = make_query_tokenizing_pipeline()
+        coordinator = shard_coordinator()
+        for user_input in args.queries:
+            a = time.time()
+            results = coordinator.search(user_input, query_tokenizing_ppl)
+            time_taken = time.time() - a
+            print("{q}: {n} results in {t}ms".format(q=user_input, n=len(results) if results else 0, t=1000 * time_taken))
+            for url, title in coordinator.get_pages(results[:10] if results else []):
+                print("      {u} {t}".format(u=url, t=title or ''))
+        coordinator.close()
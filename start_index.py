@@ -1,4 +1,9 @@
+import argparse
 from main import init_index_agent
 
 if __name__ == "__main__":
-    init_index_agent()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Builds the index in the current directory from DEV/')
+    parser.add_argument('--fast-parser', action='store_true', help='parse pages with the fast html parser')
+    parser.add_argument('--positions', action='store_true', help='record word positions for phrase & proximity queries')
+    args = parser.parse_args()
+    init_index_agent(args.fast_parser, positions=args.positions)
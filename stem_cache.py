@@ -0,0 +1,104 @@
+import os
+import struct
+from atomic_file import atomic_write
+
+# Default location of the persisted stem table
+stem_cache_loc = 'stem_cache.bin'
+
+# File layout:
+#   header:       magic, entry count, little endian
+#   entry table:  utf-8 lines of surface, shared prefix length & stem suffix separated by tabs, surfaces sorted
+# Tokens never contain whitespace, so tabs & newlines are free to use as separators
+header_format = struct.Struct('<4sI')
+magic = b'ICSS'
+
+
+def encode_entry(surface: str, stem: str) -> str:
+    """Encodes a surface form & its stem as the stem suffix after the prefix it shares with the surface"""
+    shared = 0
+    for a, b in zip(surface, stem):
+        if a != b:
+            break
+        shared += 1
+    return '{s}\t{k}\t{x}'.format(s=surface, k=shared, x=stem[shared:])
+
+
+class stem_cache:
+
+    def __init__(self, stemmer, max_entries=1 << 21):
+        """A memo of surface form -> stem, new surface forms are only cached while below max_entries"""
+        self.stemmer, self.max_entries = stemmer, max_entries
+        self.entries = dict()
+        # Surface forms stemmed since the last take_new
+        self.new_surfaces = []
+        # Location the cache was loaded from, None if never loaded
+        self.location = None
+        self.dirty = False
+        self.hits, self.misses = 0, 0
+
+    def stem(self, token: str) -> str:
+        """Stems a token, memoized"""
+        stem = self.entries.get(token)
+        if stem is not None:
+            self.hits += 1
+            return stem
+        self.misses += 1
+        stem = self.stemmer.stem(token)
+        if len(self.entries) < self.max_entries:
+            self.entries[token] = stem
+            self.new_surfaces.append(token)
+            self.dirty = True
+        return stem
+
+    def stem_all(self, tokens: [str]) -> [str]:
+        """Stems all tokens in list"""
+        entries, stem, misses = self.entries, self.stem, self.misses
+        # Only misses go through stem, hits are a single dict lookup
+        result = [entries.get(i) or stem(i) for i in tokens]
+        self.hits += len(tokens) - (self.misses - misses)
+        return result
+
+    def take_new(self) -> [(str, str)]:
+        """Gets (surface, stem) pairs stemmed since the last call, so pool workers can hand them to the parent"""
+        pairs = [(surface, self.entries[surface]) for surface in self.new_surfaces]
+        self.new_surfaces = []
+        return pairs
+
+    def update(self, pairs: [(str, str)]):
+        """Adds (surface, stem) pairs stemmed elsewhere"""
+        for surface, stem in pairs:
+            if surface not in self.entries and len(self.entries) < self.max_entries:
+                self.entries[surface] = stem
+                self.dirty = True
+
+    def load(self, location=stem_cache_loc):
+        """Loads a persisted stem table into the cache, once per location"""
+        if self.location == location or not os.path.isfile(location):
+            return
+        with open(location, 'rb') as f:
+            data = f.read()
+        file_magic, count = header_format.unpack_from(data, 0)
+        if file_magic != magic:
+            raise ValueError('Not a stem cache: {l}'.format(l=location))
+        if count:
+            for line in data[header_format.size:].decode().split('\n'):
+                surface, shared, suffix = line.split('\t')
+                self.entries.setdefault(surface, surface[:int(shared)] + suffix)
+        self.location = location
+
+    def save(self, location=stem_cache_loc):
+        """Persists the cache if it learned new stems"""
+        if not self.dirty and os.path.isfile(location):
+            return
+        table = '\n'.join([encode_entry(surface, self.entries[surface]) for surface in sorted(self.entries)]).encode()
+        with atomic_write(location) as f:
+            f.write(header_format.pack(magic, len(self.entries)))
+            f.write(table)
+        self.location, self.dirty = location, False
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        """Gets counters of the cache"""
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'max_entries': self.max_entries}
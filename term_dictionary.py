@@ -0,0 +1,144 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+# File layout, all integers little endian:
+#   header:           magic, term count
+#   string offsets:   (count + 1) x u64, start of each term in the string table
+#   posting offsets:  count x u64, byte offset of the posting in the index file
+#   posting lengths:  count x u32, byte length of the posting
+#   document freqs:   count x u32, number of pages in the posting
+#   string table:     utf-8 terms concatenated in sorted order
+header_format = struct.Struct('<4sI')
+magic = b'ICSD'
+u64 = struct.Struct('<Q')
+u32 = struct.Struct('<I')
+string_offset_pair = struct.Struct('<QQ')
+
+
+def write_term_dictionary(location: str, terms: [str], offsets: [int], lengths: [int], dfs: [int]):
+    """Writes a sorted term dictionary to file, terms must already be in ascending order"""
+    encoded = [term.encode() for term in terms]
+    # Compute location of each term in string table
+    string_offsets = array('Q', [0])
+    current = 0
+    for term in encoded:
+        current += len(term)
+        string_offsets.append(current)
+    columns = [string_offsets, array('Q', offsets), array('I', lengths), array('I', dfs)]
+    with open(location, 'wb') as f:
+        f.write(header_format.pack(magic, len(encoded)))
+        for column in columns:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            f.write(column.tobytes())
+        f.write(b''.join(encoded))
+
+
+class term_dictionary:
+
+    def __init__(self, location: str):
+        """A read only, memory mapped table from term to posting location & document frequency"""
+        self.location = location
+        self.file = open(location, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, self.count = header_format.unpack_from(self.map, 0)
+        if file_magic != magic:
+            raise ValueError('Not a term dictionary: {l}'.format(l=location))
+        # Locate each column
+        self.string_offsets_base = header_format.size
+        self.posting_offsets_base = self.string_offsets_base + 8 * (self.count + 1)
+        self.posting_lengths_base = self.posting_offsets_base + 8 * self.count
+        self.dfs_base = self.posting_lengths_base + 4 * self.count
+        self.strings_base = self.dfs_base + 4 * self.count
+
+    def close(self):
+        """Releases the memory map & file"""
+        self.map.close()
+        self.file.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def term_at(self, position: int) -> str:
+        """Gets the term stored at given position"""
+        start, end = string_offset_pair.unpack_from(self.map, self.string_offsets_base + 8 * position)
+        return self.map[self.strings_base + start: self.strings_base + end].decode()
+
+    def entry_at(self, position: int) -> (int, int, int):
+        """Gets posting offset, posting length & document frequency stored at given position"""
+        return (u64.unpack_from(self.map, self.posting_offsets_base + 8 * position)[0],
+                u32.unpack_from(self.map, self.posting_lengths_base + 4 * position)[0],
+                u32.unpack_from(self.map, self.dfs_base + 4 * position)[0])
+
+    def lower_bound(self, term: str) -> int:
+        """Binary search for the first position whose term is not less than given term"""
+        key = term.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, end = string_offset_pair.unpack_from(self.map, self.string_offsets_base + 8 * middle)
+            if self.map[self.strings_base + start: self.strings_base + end] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, term: str) -> int:
+        """Gets position of term, -1 if not found"""
+        position = self.lower_bound(term)
+        if position < self.count:
+            start, end = string_offset_pair.unpack_from(self.map, self.string_offsets_base + 8 * position)
+            if self.map[self.strings_base + start: self.strings_base + end] == term.encode():
+                return position
+        return -1
+
+    def get(self, term: str) -> (int, int, int):
+        """Gets posting offset, posting length & document frequency of term, None if not found"""
+        position = self.find(term)
+        if position < 0:
+            return None
+        return self.entry_at(position)
+
+    def __contains__(self, term: str) -> bool:
+        return self.find(term) >= 0
+
+    def __getitem__(self, term: str) -> (int, int, int):
+        entry = self.get(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry
+
+    def keys(self):
+        """Iterates over all terms in ascending order"""
+        for position in range(self.count):
+            yield self.term_at(position)
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        """Iterates over (term, posting offset, posting length, document frequency) in ascending order"""
+        for position in range(self.count):
+            yield (self.term_at(position),) + self.entry_at(position)
+
+    def prefix_items(self, prefix: str):
+        """Iterates over (term, posting offset, posting length, document frequency) of terms starting with prefix in ascending order"""
+        key = prefix.encode()
+        # Matching terms are contiguous from the lower bound of prefix
+        for position in range(self.lower_bound(prefix), self.count):
+            start, end = string_offset_pair.unpack_from(self.map, self.string_offsets_base + 8 * position)
+            term = self.map[self.strings_base + start: self.strings_base + end]
+            if not term.startswith(key):
+                return
+            yield (term.decode(),) + self.entry_at(position)
+
+
+def replace_term_dictionary(current: term_dictionary, temp_location: str) -> term_dictionary:
+    """Closes an open dictionary, moves a newly written one in its place & opens it"""
+    location = current.location
+    current.close()
+    os.replace(temp_location, location)
+    return term_dictionary(location)
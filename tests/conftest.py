@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the flat modules of the repository, cython_defs must be built in place with setup.py build_ext --inplace
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
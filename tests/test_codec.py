@@ -0,0 +1,41 @@
+import random
+from cython_defs import encode_posting, decode_posting, encode_serials, decode_serials
+
+
+def make_posting(rng: random.Random, count: int) -> ([int], [float]):
+    """Generates ascending serials with large gaps now & then & scores rounded like tf-idf"""
+    serials, serial = [], 0
+    for _ in range(count):
+        serial += rng.choice([1, 2, 3, 200, 70000])
+        serials.append(serial)
+    return serials, [round(rng.uniform(0, 20), 4) for _ in range(count)]
+
+
+def test_posting_round_trip():
+    """Serials come back exactly & scores within the fixed point step, across block boundaries"""
+    rng = random.Random(0)
+    for count in (1, 2, 127, 128, 129, 300, 1000):
+        serials, scores = make_posting(rng, count)
+        posting = decode_posting(encode_posting(serials, scores))
+        assert len(posting) == count
+        assert list(posting.serials) == serials
+        assert all(abs(a - b) < 1e-5 for a, b in zip(posting.scores, scores))
+        assert abs(posting.max_score - max(scores)) < 1e-5
+
+
+def test_posting_blocks_decode_in_any_order():
+    """Scores decoded before serials & blocks decoded out of order give the same posting"""
+    serials, scores = make_posting(random.Random(1), 700)
+    data = encode_posting(serials, scores)
+    posting = decode_posting(data)
+    decoded_scores = list(posting.scores)
+    assert list(posting.serials) == serials
+    assert decoded_scores == list(decode_posting(data).scores)
+
+
+def test_serials_round_trip():
+    """Standalone serial lists come back exactly"""
+    rng = random.Random(2)
+    for count in (0, 1, 500):
+        serials, _ = make_posting(rng, count)
+        assert list(decode_serials(encode_serials(serials))) == serials
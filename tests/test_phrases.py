@@ -0,0 +1,67 @@
+import random
+from array import array
+from cython_defs import encode_positions, concat_positions, phrase_match
+
+page_count = 400
+
+
+def make_pages(seed: int) -> [[str]]:
+    """Generates pages of words from a small vocabulary, so phrases of a few words occur often"""
+    rng = random.Random(seed)
+    return [rng.choices('abcdef', weights=[6, 5, 4, 3, 2, 1], k=rng.randint(1, 60)) for _ in range(page_count)]
+
+
+def make_streams(pages: [[str]], split: int) -> dict:
+    """Encodes word positions of every word, pages below & from split encoded apart & joined like position runs"""
+    streams = dict()
+    for word in 'abcdef':
+        parts = []
+        for serials in (range(split), range(split, page_count)):
+            serials = [serial for serial in serials if word in pages[serial]]
+            parts.append(encode_positions(serials, [[i for i, w in enumerate(pages[serial]) if w == word] for serial in serials]))
+        streams[word] = concat_positions(parts)
+    return streams
+
+
+def brute_force(pages: [[str]], words: [str], window: int) -> [int]:
+    """Gets pages holding a phrase by checking every position"""
+    found = []
+    for serial, page in enumerate(pages):
+        if window == 0:
+            if any(page[i:i + len(words)] == words for i in range(len(page) - len(words) + 1)):
+                found.append(serial)
+        elif any(all(word in page[i:i + window + 1] for word in words) for i in range(len(page))):
+            found.append(serial)
+    return found
+
+
+def test_concat_equals_single_encoding():
+    """Joining position streams of ascending page ranges gives the stream of all pages"""
+    pages = make_pages(0)
+    for split in (0, 1, 150, page_count):
+        streams = make_streams(pages, split)
+        assert streams == make_streams(pages, 0)
+
+
+def test_phrase_match_equals_brute_force():
+    """Exact phrases & proximity windows match the pages found by checking every position"""
+    rng = random.Random(1)
+    pages = make_pages(2)
+    streams = make_streams(pages, 123)
+    for _ in range(300):
+        words = rng.choices('abcdef', k=rng.randint(2, 4))
+        window = rng.choice([0, 0, 2, 5])
+        if window:
+            words = sorted(set(words))
+        candidates = array('i', [serial for serial, page in enumerate(pages) if all(word in page for word in words)])
+        kept = phrase_match([streams[word] for word in words], range(len(words)), candidates, window, page_count)
+        assert list(kept) == brute_force(pages, words, window), (words, window)
+
+
+def test_uncovered_candidates_are_kept():
+    """Candidates from covered on have no positions & are kept unchecked"""
+    pages = make_pages(3)
+    streams = make_streams(pages, 0)
+    candidates = array('i', range(page_count))
+    kept = phrase_match([streams['f'], streams['f']], range(2), candidates, 0, 200)
+    assert list(kept) == [serial for serial in brute_force(pages, ['f', 'f'], 0) if serial < 200] + list(range(200, page_count))
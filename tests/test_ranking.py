@@ -0,0 +1,74 @@
+import math
+import random
+from array import array
+from cython_defs import encode_posting, decode_posting, vector_space_ranking_hybrid, intersect_postings
+
+doc_count = 5000
+
+
+def make_postings(seed: int, sizes: [int]) -> []:
+    """Generates postings of random pages, skewed scores let block max pruning skip most pages"""
+    rng = random.Random(seed)
+    postings = []
+    for size in sizes:
+        serials = sorted(rng.sample(range(doc_count), size))
+        scores = [round(rng.paretovariate(2), 4) for _ in serials]
+        postings.append(decode_posting(encode_posting(serials, scores)))
+    return postings
+
+
+def exhaustive_scores(postings: [], multipliers: array) -> dict:
+    """Scores every page in all postings with the hybrid formula, without pruning"""
+    common = set(postings[0].serials)
+    for posting in postings[1:]:
+        common &= set(posting.serials)
+    tf_idf = [dict(zip(posting.serials, posting.scores)) for posting in postings]
+    query = [1 + math.log(doc_count / len(posting), 10) for posting in postings]
+    query_norm = math.sqrt(sum(q * q for q in query))
+    scores = dict()
+    for serial in common:
+        row = [weights[serial] for weights in tf_idf]
+        norm = math.sqrt(sum(x * x for x in row))
+        cosine = sum(x * q for x, q in zip(row, query)) / (norm * query_norm) if norm else 0
+        scores[serial] = sum(row) * multipliers[serial] + 2.5 * cosine
+    return scores
+
+
+def test_top_k_equals_full_ranking():
+    """The pruned top k is the head of the ranking of every page, also when paging past it"""
+    multipliers = array('d', [random.Random(3).choice([1., .5]) for _ in range(doc_count)])
+    for seed, sizes in enumerate([(300, 2000, 4000), (1500, 1500), (4000,), (50, 3000)]):
+        # Ranking every page up front leaves nothing to prune
+        full = vector_space_ranking_hybrid(make_postings(seed, sizes), doc_count, doc_count, multipliers=multipliers)
+        for k in (1, 10, 25):
+            top = vector_space_ranking_hybrid(make_postings(seed, sizes), doc_count, k, multipliers=multipliers)
+            assert len(top) == len(full)
+            assert list(top.snapshot()) == list(full[:k])
+            assert list(top[:4 * k]) == list(full[:4 * k])
+
+
+def test_top_k_scores_match_exhaustive_scores():
+    """Scores of the pruned top k match exhaustive scoring & no skipped page scores higher"""
+    multipliers = array('d', [random.Random(4).choice([1., .5]) for _ in range(doc_count)])
+    for seed, sizes in enumerate([(300, 2000, 4000), (1500, 1500), (4000,)]):
+        postings = make_postings(seed, sizes)
+        scores = exhaustive_scores(postings, multipliers)
+        top = vector_space_ranking_hybrid(postings, doc_count, 10, multipliers=multipliers)
+        for serial, score in zip(top.snapshot(), top.ranked_scores):
+            assert abs(scores[serial] - score) < 1e-4
+        best = sorted(scores.values(), reverse=True)[:10]
+        assert all(abs(a - b) < 1e-4 for a, b in zip(best, top.ranked_scores))
+
+
+def test_galloping_intersection_matches_set_intersection():
+    """Galloping over block skip pointers finds every common page & its position in each posting"""
+    for seed, sizes in enumerate([(10, 4000), (300, 2000, 4000), (1500, 1500), (1, 5000)]):
+        postings = sorted(make_postings(seed, sizes), key=len)
+        candidates, positions = intersect_postings(postings)
+        common = set(postings[0].serials)
+        for posting in postings[1:]:
+            common &= set(posting.serials)
+        assert list(candidates) == sorted(common)
+        for posting, posting_positions in zip(postings, positions):
+            serials = posting.serials
+            assert [serials[position] for position in posting_positions] == list(candidates)
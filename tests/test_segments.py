@@ -0,0 +1,96 @@
+import os
+import random
+from index_agent import index_agent
+
+# Index files a full build & an incremental one must write byte for byte alike
+compared_files = ('reverse_index.bin', 'index_dictionary.bin', 'reverse_weight_index.bin', 'weight_dictionary.bin',
+                  'reverse_standalone_index.bin', 'standalone_dictionary.bin', 'page_store.bin')
+
+
+def make_pages(seed: int, count: int) -> dict:
+    """Generates partial index entries {serial: {term: weight}} of pages with a zipf like vocabulary"""
+    rng = random.Random(seed)
+    vocabulary = ['term{i}'.format(i=i) for i in range(400)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    pages = dict()
+    for serial in range(count):
+        pages[serial] = dict()
+        for term in rng.choices(vocabulary, weights=weights, k=rng.randint(5, 60)):
+            pages[serial][term] = pages[serial].get(term, 0) + rng.choice([1, .5, 2])
+    return pages
+
+
+def to_partial_index(pages: dict, serials) -> dict:
+    """Gets the partial index {term: {serial: weight}} of some pages"""
+    partial_index = dict()
+    for serial in serials:
+        for term, weight in pages[serial].items():
+            partial_index.setdefault(term, dict())[serial] = weight
+    return partial_index
+
+
+def build(location: str, pages: dict, serials) -> index_agent:
+    """Builds an index of some pages in one go, like init_index_agent"""
+    agent = index_agent(init=True, location=location)
+    agent.merge_to(to_partial_index(pages, serials))
+    agent.add_page_serial({serial: 'https://host/{s}'.format(s=serial) for serial in serials})
+    agent.process_standalone_single_index()
+    agent.add_page_titles({serial: 'Page {s}'.format(s=serial) for serial in serials})
+    agent.construct_tf_idf()
+    return agent
+
+
+def get_all_postings(agent: index_agent, terms: [str]) -> dict:
+    """Gets serials & scores of terms across main index & segments, None for terms in no page"""
+    postings = dict()
+    for term in terms:
+        posting = agent.get_posting(term)
+        postings[term] = (list(posting.serials), list(posting.scores)) if posting else None
+    return postings
+
+
+def get_terms(agent: index_agent) -> [str]:
+    """Gets every term of main index"""
+    return [term for term, _, _, _ in agent.weight_table_index.items()]
+
+
+def test_add_and_fold_equals_full_build(tmp_path):
+    """Pages added as segments & folded into main index give the files of a build of all pages"""
+    pages = make_pages(0, 310)
+    full = build(str(tmp_path / 'full'), pages, range(310))
+    incremental = build(str(tmp_path / 'incremental'), pages, range(300))
+    terms = get_terms(full)
+    # Segments stay below the fold ratio, so they are searched as segments first
+    for start in (300, 305):
+        serials = range(start, start + 5)
+        incremental.add_segment(to_partial_index(pages, serials), {serial: 'https://host/{s}'.format(s=serial) for serial in serials},
+                                {serial: 'Page {s}'.format(s=serial) for serial in serials})
+        incremental.wait_for_merge()
+    # Searching segments rescores raw weights like the full build
+    assert len(incremental.segments) == 2
+    assert get_all_postings(incremental, terms) == get_all_postings(full, terms)
+    incremental.fold_segments()
+    assert not incremental.segments and not incremental.scores_outdated()
+    for loc in compared_files:
+        with open(os.path.join(full.location, loc), 'rb') as a, open(os.path.join(incremental.location, loc), 'rb') as b:
+            assert a.read() == b.read(), loc
+
+
+def test_delete_and_fold_equals_full_build(tmp_path):
+    """Deleted pages are gone from postings & idf, before & after folding"""
+    pages = make_pages(1, 300)
+    # Tombstones stay below the fold ratio, so deleted pages are filtered when searching first
+    deleted = set(random.Random(2).sample(range(300), 10))
+    live = [serial for serial in range(300) if serial not in deleted]
+    full = build(str(tmp_path / 'full'), pages, live)
+    incremental = build(str(tmp_path / 'incremental'), pages, range(300))
+    incremental.delete_pages(sorted(deleted))
+    incremental.wait_for_merge()
+    terms = get_terms(incremental)
+    expected = get_all_postings(full, terms)
+    assert incremental.deleted == deleted
+    assert get_all_postings(incremental, terms) == expected
+    incremental.fold_segments()
+    assert not incremental.deleted
+    assert get_all_postings(incremental, terms) == expected
+    assert incremental.get_urls(live) == full.get_urls(live)
@@ -0,0 +1,72 @@
+import re
+import string
+import nltk
+
+# Single pass tokenizer producing the tokens of the pipeline stages
+# remove_contents, to_lower, nltk.word_tokenize, remove_punctuations, break_by & remove_junk,
+# on precompiled regexes & translation tables instead of per character & per token passes
+
+# Characters dropped by remove_ascii after ascii encoding, those with an escaped repr
+removed_characters = str.maketrans('', '', ''.join(chr(i) for i in range(32)) + '\x7f\\')
+# Characters replaced by spaces in remove_contents
+separator_characters = str.maketrans('[]:\'"`|_~,-', ' ' * 11)
+# Ascii characters that are not alphanumeric, stripping them leaves nothing of a token without alphanumerics
+non_alphanumeric_characters = ''.join(c for c in map(chr, range(128)) if c not in string.ascii_letters + string.digits)
+# Element prefixes & contents dropped by remove_contents
+dropped_prefixes = ('/', '.', 'end ', 'wp')
+# Markers after backslash or caret
+marker_regex = re.compile(r'[\\^][a-zA-Z0-9_]*')
+# Words with urls & html markers
+trash_regex = re.compile('http|<|>')
+# Trailing characters that may follow the final period of a sentence
+final_period_trailers = ' ])}>"\''
+# Punctuation padded into tokens of its own by the word tokenizer
+padded_punctuation_regex = re.compile(r'\.{2,}|[;@#$%&?!*\[\](){}<>]')
+# Contractions split by the word tokenizer, those needing quotes never survive remove_contents
+contraction_regex = re.compile(r'\b(can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na(?:\s|$)))(not|me|na|ta)')
+# Tokens containing at least one alphanumeric character
+word_regex = re.compile(r'\S*[a-z0-9]\S*')
+
+
+def clean_text(texts: list) -> str:
+    """Same result as remove_contents followed by to_lower"""
+    cleaned = []
+    for text in texts:
+        text = text.strip()
+        if not text.isascii():
+            text = text.encode('ascii', 'ignore').decode()
+        text = text.translate(removed_characters)
+        # Keep elements with alphanumerics that are not paths, urls or markers
+        if text.strip(non_alphanumeric_characters) and not (text.startswith(dropped_prefixes) or '.com' in text or '.org' in text):
+            cleaned.append(text)
+    text = marker_regex.sub(' ', ' '.join(cleaned).translate(separator_characters))
+    return ' '.join([i for i in text.split(' ') if len(i) > 1 and not trash_regex.search(i)]).lower()
+
+
+def split_final_period(sentence: str) -> str:
+    """Separates the final period of a sentence like the word tokenizer"""
+    stripped = sentence.rstrip(final_period_trailers)
+    if len(stripped) > 1 and stripped[-1] == '.' and stripped[-2] != '.':
+        return stripped[:-1] + ' . ' + sentence[len(stripped):]
+    return sentence
+
+
+def split_sentences(text: str) -> [str]:
+    """Splits text into sentences with Punkt, which only matters for final periods"""
+    if '.' not in text:
+        return [text]
+    return nltk.sent_tokenize(text)
+
+
+def tokenize(texts: list) -> [str]:
+    """Tokenizes a list of text elements, stemming is left to the next stage"""
+    text = ' '.join([split_final_period(i) for i in split_sentences(clean_text(texts))])
+    text = contraction_regex.sub(r' \1 \2 ', padded_punctuation_regex.sub(r' \g<0> ', text))
+    tokens = []
+    for token in word_regex.findall(text):
+        # Break paths into parts, dropping parts with equal signs
+        if '/' in token:
+            tokens += [i for i in token.split('/') if i and '=' not in i]
+        elif '=' not in token:
+            tokens.append(token)
+    return tokens